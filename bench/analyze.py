@@ -0,0 +1,115 @@
+#!/usr/bin/env python3.11
+"""
+check/analyze.pyの動作確認
+main.pyのprint_logとLogWriterで実際の形式のログを書き，checker.pyと同じ形式のプローブの記録と合わせて集計させる
+"Connected in"の所要時間(小数点以下を含む)とサーバ，フェイルオーバーと通信断の対応付けが読み取れるかを確かめる
+
+使い方: python bench/analyze.py
+"""
+
+import sys
+import heapq
+import time
+import tempfile
+from zoneinfo import ZoneInfo
+from datetime import datetime, timedelta
+from pathlib import Path
+
+BENCH_DIR = Path(__file__).resolve().parent
+sys.path.insert(0, str(BENCH_DIR.parent))
+sys.path.insert(0, str(BENCH_DIR.parent.joinpath("check")))
+import main  # noqa: E402
+import logwriter  # noqa: E402
+import analyze  # noqa: E402
+
+TZ = ZoneInfo("Asia/Tokyo")
+SERVER = "203.0.113.5"
+
+
+def bench():
+    with tempfile.TemporaryDirectory(prefix="vpngate-sim-") as d:
+        log_dir = Path(d).joinpath("log")
+        check_dir = Path(d).joinpath("check_log")
+        (connect_ms, failover_at) = write_router_log(log_dir)
+        write_probe_log(check_dir, failover_at)
+        failed = 0
+        for check in (check_connected, check_report):
+            try:
+                check(log_dir, check_dir, connect_ms)
+                print(f"ok    {check.__name__}")
+            except AssertionError as e:
+                failed += 1
+                print(f"FAIL  {check.__name__}: {e}")
+    if failed > 0:
+        sys.exit(1)
+
+
+def write_router_log(log_dir: Path) -> (float, datetime):
+    """
+    接続→フェイルオーバー→再接続の順にmain.pyのログを書く
+
+    Returns:
+        float: 再接続時に記録した所要時間(ms)
+        datetime: フェイルオーバーを始めた時刻
+    """
+    main.logger = logwriter.LogWriter(log_dir, TZ)
+    main.print_log("IP Configuration OK. WAN IP: 198.51.100.1")
+    main.set_td()
+    main.print_log(f"Connected in {main.get_td()}ms  Server: 192.0.2.1")
+    time.sleep(0.2)
+    failover_at = datetime.now(TZ)
+    main.print_log("Failover started.")
+    main.set_td()
+    time.sleep(0.1)
+    main.print_log("IP Configuration OK. WAN IP: 198.51.100.2")
+    td = main.get_td()  # start_session()と同じく小数点以下3桁の文字列
+    main.print_log(f"Connected in {td}ms  Server: {SERVER}")
+    main.logger.close()
+    return (float(td), failover_at)
+
+
+def write_probe_log(check_dir: Path, failover_at: datetime):
+    """
+    フェイルオーバーの前後1秒にわたって失敗するwebプローブの記録を書く
+    """
+    check_dir.mkdir()
+    start = failover_at - timedelta(seconds=5)
+    lines = []
+    for i in range(20):
+        dt = start + timedelta(seconds=i * 0.5)
+        if abs((dt - failover_at).total_seconds()) <= 1:
+            lines.append(f"{dt}; 1; TimeoutError()")
+        else:
+            ip = "198.51.100.1" if dt < failover_at else "198.51.100.2"
+            lines.append(f"{dt}; 0; {ip}; 12.345")
+    check_dir.joinpath(f"web-{start.date()}.txt").write_text("\n".join(lines) + "\n")
+
+
+def check_connected(log_dir: Path, check_dir: Path, connect_ms: float):
+    files = analyze.log_files(log_dir).get("log", [])
+    assert len(files) == 1, f"router log not found in {log_dir}"
+    events = [e for e in analyze.router_events(files[0]) if e[1] == "connected"]
+    assert len(events) == 2, f"{len(events)} of 2 'Connected in' lines were parsed"
+    (ms, server) = events[-1][2]
+    assert ms == connect_ms, f"connect time parsed as {ms}, logged {connect_ms}"
+    assert server == SERVER, f"server parsed as {server}"
+
+
+def check_report(log_dir: Path, check_dir: Path, connect_ms: float):
+    streams = [analyze.router_events(f) for f in analyze.log_files(log_dir).get("log", [])]
+    for (name, files) in analyze.log_files(check_dir).items():
+        streams.append(analyze.reorder(analyze.probe_events(name, files)))
+    analyzer = analyze.Analyzer()
+    for event in heapq.merge(*streams, key=lambda e: e[0]):
+        analyzer.feed(*event)
+    report = analyzer.report()
+    assert report["failover"]["mttr"]["count"] == 1, f"failovers: {report['failover']['mttr']}"
+    assert analyzer.failovers[0]["connect_ms"] == connect_ms, "connect time was not attached to the failover"
+    assert report["blackouts"]["web"]["with_failover"]["count"] == 1, "the blackout was not matched to the failover"
+    servers = report["servers"]
+    assert servers[SERVER]["sessions"] == 1 and servers["192.0.2.1"]["failovers"] == 1, f"servers: {servers}"
+    assert servers[SERVER]["wan_ips"] == ["198.51.100.2"], f"WAN IPs: {servers[SERVER]['wan_ips']}"
+
+
+if __name__ == "__main__":
+    bench()
@@ -0,0 +1,226 @@
+#!/usr/bin/env python3.11
+"""
+dhcpc.Clientの動作確認
+AF_PACKETソケットの代わりに，送られたフレームを検査して台本どおりに応答するソケットを渡し，次の点を確かめる
+
+  discover  DISCOVER/REQUESTのIP・UDP・BOOTPの組み立て(チェックサム，ブロードキャスト)と，ACKからのリースの取り出し
+  renew     更新はサーバのアドレス・MACアドレスへのユニキャスト，T2以降はブロードキャストで送る
+  nak       NAKを受けたら取得・更新ともNoneを返す
+  release   RELEASEをサーバへユニキャストで送る
+  options   オプションの分解(Pad，分割されたオプションの連結，途中で切れたデータ)とチェックサムの計算
+
+NICはMACアドレスを読むためだけに使う(既定はlo)．送受信は行わないため権限は不要
+
+使い方: python bench/dhcp_client.py [NIC]
+"""
+
+import sys
+import time
+import socket
+import struct
+from pathlib import Path
+from types import SimpleNamespace
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+import dhcpc  # noqa: E402
+
+SERVER = "10.211.254.254"
+SERVER_MAC = bytes.fromhex("5e0000000001")
+ADDRESS = "10.211.3.4"
+
+
+def parse_frame(data: bytes, addr: tuple) -> SimpleNamespace:
+    """
+    クライアントが送ったフレームを検査して分解する
+    """
+    assert len(data) >= dhcpc.IPHDR.size, "frame is shorter than an IP header"
+    (ver_ihl, _, length, _, _, ttl, proto, _, src, dst) = dhcpc.IPHDR.unpack_from(data)
+    assert ver_ihl == 0x45, f"unexpected version/IHL {ver_ihl:#x}"
+    assert length == len(data), f"IP total length {length} != frame length {len(data)}"
+    assert dhcpc.checksum(data[:dhcpc.IPHDR.size]) == 0, "IP header checksum does not verify"
+    assert proto == socket.IPPROTO_UDP and ttl > 0, "not a UDP packet"
+    (sport, dport, udp_len, _) = dhcpc.UDPHDR.unpack_from(data, dhcpc.IPHDR.size)
+    assert (sport, dport) == (dhcpc.CLIENT_PORT, dhcpc.SERVER_PORT), f"unexpected ports {sport}->{dport}"
+    assert udp_len == len(data) - dhcpc.IPHDR.size, "UDP length does not match"
+    offset = dhcpc.IPHDR.size + dhcpc.UDPHDR.size
+    (op, htype, hlen, _, xid, _, flags, ciaddr, _, _, _, chaddr, _, _, cookie) = dhcpc.BOOTP.unpack_from(data, offset)
+    assert (op, htype, hlen, cookie) == (1, 1, 6, dhcpc.MAGIC_COOKIE), "malformed BOOTP request"
+    opts = dhcpc.parse_options(data[offset + dhcpc.BOOTP.size:])
+    assert data.rstrip(b"\0").endswith(bytes([dhcpc.OPT_END])), "options are not terminated"
+    return SimpleNamespace(
+        src=socket.inet_ntoa(src), dst=socket.inet_ntoa(dst), mac=addr[4], xid=xid, flags=flags,
+        ciaddr=socket.inet_ntoa(ciaddr), chaddr=chaddr[:6], opts=opts, kind=opts[dhcpc.OPT_MESSAGE_TYPE][0],
+    )
+
+
+def reply(req: SimpleNamespace, kind: int, options: list[tuple[int, bytes]] = (), xid: int = None) -> bytes:
+    """
+    reqへのサーバの応答(IPヘッダから)を組み立てる
+    """
+    yiaddr = ADDRESS if kind in (dhcpc.DHCPOFFER, dhcpc.DHCPACK) else "0.0.0.0"
+    bootp = dhcpc.BOOTP.pack(
+        2, 1, 6, 0, req.xid if xid is None else xid, 0, req.flags, socket.inet_aton(req.ciaddr),
+        socket.inet_aton(yiaddr), bytes(4), bytes(4), req.chaddr, b"", b"", dhcpc.MAGIC_COOKIE,
+    )
+    payload = bootp + dhcpc.pack_options([(dhcpc.OPT_MESSAGE_TYPE, bytes([kind])), *options])
+    udp = dhcpc.UDPHDR.pack(dhcpc.SERVER_PORT, dhcpc.CLIENT_PORT, dhcpc.UDPHDR.size + len(payload), 0) + payload
+    header = dhcpc.IPHDR.pack(0x45, 0, dhcpc.IPHDR.size + len(udp), 0, 0, 64, socket.IPPROTO_UDP, 0,
+                              socket.inet_aton(SERVER), socket.inet_aton("255.255.255.255"))
+    return header + udp
+
+
+def ack_options() -> list[tuple[int, bytes]]:
+    # ルータは2つに分割して送る(RFC 3396)．T1/T2は省略し，リース時間からの既定値を使わせる
+    return [
+        (dhcpc.OPT_SERVER_ID, socket.inet_aton(SERVER)),
+        (dhcpc.OPT_SUBNET_MASK, socket.inet_aton("255.255.0.0")),
+        (dhcpc.OPT_ROUTER, socket.inet_aton(SERVER)[:2]),
+        (dhcpc.OPT_ROUTER, socket.inet_aton(SERVER)[2:]),
+        (dhcpc.OPT_LEASE_TIME, struct.pack("!I", 7200)),
+    ]
+
+
+class ScriptedSocket:
+    """
+    AF_PACKETソケットの代わり．送信ごとに台本の関数を1つ呼び，返ったフレームを受信側に積む
+    """
+
+    def __init__(self, script: list):
+        (self.inner, self.outer) = socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.script = list(script)
+        self.sent: list[SimpleNamespace] = []
+
+    def sendto(self, data: bytes, addr: tuple):
+        req = parse_frame(data, addr)
+        self.sent.append(req)
+        assert len(self.script) > 0, f"unexpected message type {req.kind}"
+        for frame in self.script.pop(0)(req):
+            self.outer.send(frame)
+
+    def recvfrom(self, size: int) -> (bytes, tuple):
+        return (self.inner.recv(size), ("lo", dhcpc.ETH_P_IP, 0, 1, SERVER_MAC))
+
+    def fileno(self) -> int:
+        return self.inner.fileno()
+
+    def close(self):
+        self.inner.close()
+        self.outer.close()
+
+
+def offer(req):
+    assert req.kind == dhcpc.DHCPDISCOVER, f"expected DISCOVER, got {req.kind}"
+    # 別のクライアント宛て(xid違い)の応答は読み捨てさせる
+    return [reply(req, dhcpc.DHCPOFFER, ack_options(), xid=req.xid ^ 1), reply(req, dhcpc.DHCPOFFER, ack_options())]
+
+
+def ack(req):
+    assert req.kind == dhcpc.DHCPREQUEST, f"expected REQUEST, got {req.kind}"
+    return [reply(req, dhcpc.DHCPACK, ack_options())]
+
+
+def nak(req):
+    assert req.kind == dhcpc.DHCPREQUEST, f"expected REQUEST, got {req.kind}"
+    return [reply(req, dhcpc.DHCPNAK, [(dhcpc.OPT_SERVER_ID, socket.inet_aton(SERVER))])]
+
+
+def silent(req):
+    return []
+
+
+def make_lease(age: float = 0.0) -> dhcpc.Lease:
+    return dhcpc.Lease(ADDRESS, 16, SERVER, SERVER, 7200, 3600, 6300, time.monotonic() - age, SERVER_MAC.hex(":"))
+
+
+def bench():
+    nic = sys.argv[1] if len(sys.argv) > 1 else "lo"
+    checks = [check_discover, check_renew, check_nak, check_release, check_options]
+    failed = 0
+    for check in checks:
+        try:
+            check(nic)
+            print(f"ok    {check.__name__}")
+        except AssertionError as e:
+            failed += 1
+            print(f"FAIL  {check.__name__}: {e}")
+    if failed > 0:
+        sys.exit(1)
+
+
+def run(nic: str, script: list, func) -> (object, list[SimpleNamespace]):
+    sock = ScriptedSocket(script)
+    client = dhcpc.Client(nic, timeout=0.5, sock=sock)
+    try:
+        return (func(client), sock.sent)
+    finally:
+        client.close()
+
+
+def check_discover(nic: str):
+    (lease, sent) = run(nic, [offer, ack], lambda c: c.discover())
+    mac = dhcpc.get_mac(nic)
+    assert [r.kind for r in sent] == [dhcpc.DHCPDISCOVER, dhcpc.DHCPREQUEST], f"sent {[r.kind for r in sent]}"
+    for r in sent:
+        assert (r.src, r.dst, r.mac) == ("0.0.0.0", "255.255.255.255", dhcpc.BROADCAST_MAC), "not sent as broadcast"
+        assert r.flags == 0x8000 and r.ciaddr == "0.0.0.0", "the broadcast flag is not set without an address"
+        assert r.chaddr == mac and r.opts[dhcpc.OPT_CLIENT_ID] == b"\x01" + mac, "client identifier does not match"
+    request = sent[1]
+    assert request.xid == sent[0].xid, "REQUEST does not reuse the DISCOVER xid"
+    assert request.opts[dhcpc.OPT_REQUESTED_IP] == socket.inet_aton(ADDRESS), "requested address is not the offer"
+    assert request.opts[dhcpc.OPT_SERVER_ID] == socket.inet_aton(SERVER), "server identifier is missing"
+    assert lease is not None, "no lease from ACK"
+    got = (lease.address, lease.prefixlen, lease.router, lease.server, lease.lease_time, lease.t1, lease.t2)
+    assert got == (ADDRESS, 16, SERVER, SERVER, 7200, 3600, 6300), f"unexpected lease {lease!r}"
+    assert lease.server_mac == SERVER_MAC.hex(":"), f"server MAC was recorded as {lease.server_mac}"
+    restored = dhcpc.Lease.load({**lease.dump(), "dns": ["192.0.2.53"]})  # 以前の版で保存したリース
+    assert abs(restored.renew_at - lease.renew_at) < 0.1, "dump/load moved the renewal time"
+
+
+def check_renew(nic: str):
+    (lease, sent) = run(nic, [ack], lambda c: c.renew(make_lease()))
+    r = sent[0]
+    assert r.kind == dhcpc.DHCPREQUEST and r.ciaddr == ADDRESS and r.flags == 0, "RENEW is not a REQUEST from ciaddr"
+    assert (r.src, r.dst, r.mac) == (ADDRESS, SERVER, SERVER_MAC), f"RENEW went to {r.dst} / {r.mac.hex(':')}"
+    assert dhcpc.OPT_REQUESTED_IP not in r.opts, "RENEW must not carry a requested address"
+    assert lease is not None and lease.address == ADDRESS, "RENEW did not return the lease"
+    (lease, sent) = run(nic, [ack], lambda c: c.renew(make_lease(age=6400)))
+    r = sent[0]
+    assert (r.src, r.dst, r.mac) == (ADDRESS, "255.255.255.255", dhcpc.BROADCAST_MAC), "REBIND is not broadcast"
+    assert lease is not None, "REBIND did not return the lease"
+    legacy = make_lease()
+    legacy.server_mac = None
+    (_, sent) = run(nic, [ack], lambda c: c.renew(legacy))
+    assert (sent[0].dst, sent[0].mac) == (SERVER, dhcpc.BROADCAST_MAC), "RENEW without a known MAC is not L2 broadcast"
+
+
+def check_nak(nic: str):
+    (lease, sent) = run(nic, [offer, nak], lambda c: c.discover())
+    assert lease is None and len(sent) == 2, "NAK to REQUEST was not reported as a failure"
+    start = time.monotonic()
+    (lease, _) = run(nic, [nak], lambda c: c.renew(make_lease()))
+    assert lease is None, "NAK to RENEW was not reported as a failure"
+    assert time.monotonic() - start < 0.4, "NAK was not handled until the timeout"
+
+
+def check_release(nic: str):
+    (_, sent) = run(nic, [silent], lambda c: c.release(make_lease()))
+    assert len(sent) == 1 and sent[0].kind == dhcpc.DHCPRELEASE, "RELEASE was not sent"
+    r = sent[0]
+    assert (r.src, r.dst, r.mac, r.ciaddr) == (ADDRESS, SERVER, SERVER_MAC, ADDRESS), "RELEASE is not unicast to the server"
+    assert r.opts[dhcpc.OPT_SERVER_ID] == socket.inet_aton(SERVER), "RELEASE has no server identifier"
+
+
+def check_options(nic: str):
+    data = bytes([0, 0, dhcpc.OPT_ROUTER, 2, 10, 211, 0, dhcpc.OPT_ROUTER, 2, 254, 254, dhcpc.OPT_END, 1, 4])
+    assert dhcpc.parse_options(data) == {dhcpc.OPT_ROUTER: bytes([10, 211, 254, 254])}, "pads or concatenation broken"
+    assert dhcpc.parse_options(bytes([dhcpc.OPT_LEASE_TIME])) == {}, "a truncated option was parsed"
+    assert dhcpc.parse_options(bytes([dhcpc.OPT_LEASE_TIME, 4, 0, 0])) == {dhcpc.OPT_LEASE_TIME: b"\0\0"}, \
+        "a short option value was not cut at the end of data"
+    # RFC 1071の計算例と同じ値になるか(IPヘッダ)
+    header = bytes.fromhex("450000730000400040110000c0a80001c0a800c7")
+    assert dhcpc.checksum(header) == 0xB861, f"checksum {dhcpc.checksum(header):#06x} != 0xb861"
+    assert dhcpc.checksum(b"\x01") == 0xFEFF, "odd-length data is not padded"
+
+
+if __name__ == "__main__":
+    bench()
@@ -0,0 +1,140 @@
+#!/usr/bin/env python3.11
+"""
+電子ペーパー描画のベンチマーク
+実機の代わりに，送られたバッファと処理時間(2.13inch V4の実測に近い値)を記録するMockEPDを使い，
+旧実装(変化のたびにinit→全体更新→sleep)とepdrender.Rendererのパネル占有時間を比較する
+
+使い方: python bench/display.py [フェイルオーバー回数]
+"""
+
+import sys
+import time
+from pathlib import Path
+from PIL import Image, ImageDraw, ImageFont
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+import epdrender  # noqa: E402
+
+# 各操作でパネルがビジーになる時間(秒)
+TIMING = {
+    "init": 0.1,
+    "display": 2.0,
+    "displayPartBaseImage": 2.0,
+    "displayPartial": 0.3,
+    "sleep": 2.0,  # ドライバ内で2秒待つ
+}
+
+
+class MockEPD:
+    """
+    waveshareのepd2in13_V4.EPDの代わり．呼ばれた操作とバッファを記録する
+    init後は部分更新の基準画像が消えるため，displayPartBaseImageより前のdisplayPartialはエラーにする
+    """
+    width = 122
+    height = 250
+
+    def __init__(self):
+        self.calls: list[str] = []
+        self.buffers: list[bytes] = []
+        self.has_base = False
+
+    def getbuffer(self, image: Image.Image) -> bytes:
+        return image.tobytes()
+
+    def init(self):
+        self.calls.append("init")
+        self.has_base = False
+
+    def display(self, buffer: bytes):
+        self.calls.append("display")
+        self.buffers.append(buffer)
+
+    def displayPartBaseImage(self, buffer: bytes):
+        self.calls.append("displayPartBaseImage")
+        self.buffers.append(buffer)
+        self.has_base = True
+
+    def displayPartial(self, buffer: bytes):
+        if not self.has_base:
+            raise RuntimeError("displayPartial without a base image since init")
+        self.calls.append("displayPartial")
+        self.buffers.append(buffer)
+
+    def sleep(self):
+        self.calls.append("sleep")
+
+    def busy(self) -> float:
+        return sum(TIMING[c] for c in self.calls)
+
+
+def states(failovers: int) -> list[tuple[str, str]]:
+    """
+    フェイルオーバーごとに表示が変わる順序(切断→接続試行→接続完了)
+    """
+    res = [(" 192.168.  1. 10", "Connected.\nvpn0")]
+    for i in range(failovers):
+        res.append((" 192.168.  1. 10", "Failover"))
+        res.append((" 192.168.  1. 10", f"Connecting\nvpn{i + 1}"))
+        res.append((" 192.168.  1. 10", f"Connected.\nvpn{i + 1}"))
+    return res
+
+
+def draw_frame(image: Image.Image, ip: str, vpn: str, clock: str, labels: bool):
+    font = ImageFont.load_default()
+    draw = ImageDraw.Draw(image)
+    if labels:
+        draw.text((5, 5), "eth0: ", font=font, fill=0)
+        draw.text((5, 35), "★VPN★", font=font, fill=0)
+        draw.text((5, image.height - 16), "Last update: ", font=font, fill=0)
+    draw.text((5 + draw.textlength("eth0: ", font=font), 5), ip, font=font, fill=0)
+    draw.text((5, 35), f"\n{vpn}", font=font, fill=0)
+    draw.text((5 + draw.textlength("Last update: ", font=font), image.height - 16), clock, font=font, fill=0)
+
+
+def clock_box(image: Image.Image) -> tuple[int, int, int, int]:
+    draw = ImageDraw.Draw(image)
+    x = int(5 + draw.textlength("Last update: ", font=ImageFont.load_default()))
+    return (x, image.height - 16, image.width, image.height)
+
+
+def legacy(epd: MockEPD, seq: list[tuple[str, str]]):
+    for (n, (ip, vpn)) in enumerate(seq):
+        epd.init()
+        image = Image.new("1", (epd.height, epd.width), 255)
+        draw_frame(image, ip, vpn, f"00:00:{n:02d}", labels=True)
+        epd.display(epd.getbuffer(image))
+        epd.sleep()
+
+
+def rendered(epd: MockEPD, seq: list[tuple[str, str]]):
+    base = Image.new("1", (epd.height, epd.width), 255)
+    draw_frame(base, "", "", "", labels=True)
+    renderer = epdrender.Renderer(epd, base, ignore=clock_box(base))
+    for (n, (ip, vpn)) in enumerate(seq):
+        for clock in (f"00:00:{n:02d}", f"00:01:{n:02d}"):
+            image = renderer.frame()
+            draw_frame(image, ip, vpn, clock, labels=False)
+            renderer.show(image)  # 時刻だけが変わったフレームは送らない
+        if n % 3 == 0:
+            renderer.sleep()  # フェイルオーバーが落ち着いたらスリープ
+
+
+def measure(name: str, func, seq: list[tuple[str, str]]):
+    epd = MockEPD()
+    start = time.perf_counter()
+    func(epd, seq)
+    end = time.perf_counter()
+    counts = {c: epd.calls.count(c) for c in TIMING if c in epd.calls}
+    print(f"{name:8s} panel busy {epd.busy():7.1f}s  cpu {(end - start) * 1000:7.1f}ms  {counts}")
+
+
+def bench():
+    failovers = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    seq = states(failovers)
+    print(f"{len(seq)} display changes ({failovers} failovers)")
+    measure("legacy", legacy, seq)
+    measure("renderer", rendered, seq)
+
+
+if __name__ == "__main__":
+    bench()
@@ -0,0 +1,350 @@
+#!/usr/bin/env python3.11
+"""
+フェイルオーバーのベンチマーク
+vpncmd・ip・iptables・curlを遅延と失敗率を設定できる偽物に，DHCPを偽のクライアントに置き換え，
+ローカルで配信するサーバリストを使って実際のmain()を動かす
+接続するたびに現用系のセッションを切断させ，検知・再接続までの時間とサブプロセスの起動回数を計測する
+サーバリストは記録したCSV(既定はserverlist.pyのフィクスチャ)の各サーバをループバックアドレスに置き換えて使う
+
+使い方: python bench/failover.py [-n 回数] [--standby] [--connect-fail 0.2] ...
+"""
+
+import os
+import sys
+import csv
+import json
+import math
+import time
+import queue
+import base64
+import socket
+import random
+import argparse
+import tempfile
+import threading
+import subprocess
+from collections import Counter
+from functools import partial
+from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
+from pathlib import Path
+
+BENCH_DIR = Path(__file__).resolve().parent
+sys.path.insert(0, str(BENCH_DIR.parent))
+import main  # noqa: E402
+import dhcpc  # noqa: E402
+import logwriter  # noqa: E402
+import state  # noqa: E402
+from serverlist import make_fixture, FIXTURE_PATH  # noqa: E402
+
+# 偽のコマンドの出力(get_gw・get_addr・get_nwの正規表現に合うもの)
+IP_SHOW = "default via 192.168.1.1 dev eth0\\n    inet 192.168.1.10/24 brd 192.168.1.255 scope global eth0"
+WAN_IP = "198.51.100.1"
+
+
+def bench():
+    parser = argparse.ArgumentParser(description="Failover benchmark on simulated vpncmd, ip, iptables and DHCP")
+    parser.add_argument("-n", "--failovers", type=int, default=10)
+    parser.add_argument("--standby", action="store_true", help="enable the hot-standby tunnel")
+    parser.add_argument("--fixture", type=Path, help="recorded VPNGate CSV (default: generated fixture)")
+    parser.add_argument("--rows", type=int, default=5000, help="rows of the generated fixture")
+    parser.add_argument("--vpncmd-latency", type=float, default=0.02, help="seconds per vpncmd command")
+    parser.add_argument("--connect-latency", type=float, default=1.0, help="seconds until a session is established")
+    parser.add_argument("--connect-fail", type=float, default=0.1, help="probability a session never establishes")
+    parser.add_argument("--cmd-latency", type=float, default=0.002, help="seconds per ip/iptables/curl run")
+    parser.add_argument("--cmd-fail", type=float, default=0.0, help="probability ip/iptables fail (fatal)")
+    parser.add_argument("--dhcp-latency", type=float, default=0.2, help="seconds per DHCP exchange")
+    parser.add_argument("--dhcp-fail", type=float, default=0.0, help="probability a DHCP exchange fails")
+    parser.add_argument("--hold", type=float, default=2.0, help="seconds to stay connected before each failure")
+    parser.add_argument("--verbose", action="store_true", help="show the router output")
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory(prefix="vpngate-sim-") as d:
+        run(args, Path(d))
+
+
+def run(args, sim: Path):
+    bin_dir = sim.joinpath("bin")
+    bin_dir.mkdir()
+    install_fakes(bin_dir, args)
+    os.environ["PATH"] = f"{bin_dir}:{os.environ['PATH']}"
+    os.environ.update(
+        SIM_DIR=str(sim),
+        SIM_VPNCMD_LATENCY=str(args.vpncmd_latency),
+        SIM_CONNECT_LATENCY=str(args.connect_latency),
+        SIM_CONNECT_FAIL=str(args.connect_fail),
+    )
+    # 中継サーバの代わりに，接続遅延の計測を受けるリスナ
+    listener = socket.create_server(("0.0.0.0", 0), backlog=1024)
+    threading.Thread(target=accept_forever, args=(listener,), daemon=True).start()
+    servers = rewrite_fixture(args.fixture or default_fixture(args.rows), sim.joinpath("api.csv"),
+                              listener.getsockname()[1])
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), partial(QuietHandler, directory=str(sim)))
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    setup_router(args, sim, f"http://127.0.0.1:{httpd.server_address[1]}/api.csv")
+    (events, counts) = instrument()
+    print(f"{servers} servers in the fixture, {args.failovers} failovers"
+          f"{' with standby' if args.standby else ''}")
+    out = sys.stdout
+    if not args.verbose:
+        sys.stdout = open(os.devnull, "w")
+    router = threading.Thread(target=run_router, args=(events,), daemon=True)
+    router.start()
+    try:
+        results = drive(args, sim, events, counts, out)
+    finally:
+        sys.stdout = out
+    report(results)
+
+
+def install_fakes(bin_dir: Path, args):
+    """
+    偽のコマンドをPATHの先頭に置く．rebootも偽物にし，実機を再起動させない
+    """
+    fail = f'[ "$(od -An -N2 -tu2 /dev/urandom)" -lt {int(args.cmd_fail * 65536)} ] && ' \
+           '{ echo "simulated failure" >&2; exit 2; }\n' if args.cmd_fail > 0 else ""
+    sleep = f"sleep {args.cmd_latency}\n" if args.cmd_latency > 0 else ""
+    fakes = {
+        "ip": f'{sleep}{fail}case "$*" in *show*) printf "{IP_SHOW}\\n";; esac\n',
+        "iptables": f'{sleep}{fail}case "$*" in *-C*) exit 1;; esac\n',  # 規則の確認(-C)には「ない」と答える
+        "iptables-restore": f"{sleep}{fail}cat >/dev/null\n",
+        "curl": f"{sleep}echo {WAN_IP}\n",
+        "reboot": "",
+        "vpncmd": f'exec "{sys.executable}" "{BENCH_DIR.joinpath("fake_vpncmd.py")}" "$@"\n',
+    }
+    for (name, body) in fakes.items():
+        path = bin_dir.joinpath(name)
+        path.write_text(f"#!/bin/sh\n{body}")
+        path.chmod(0o755)
+
+
+def default_fixture(rows: int) -> Path:
+    if not FIXTURE_PATH.is_file():
+        make_fixture(FIXTURE_PATH, rows)
+    return FIXTURE_PATH
+
+
+def rewrite_fixture(src: Path, dst: Path, port: int) -> int:
+    """
+    サーバのIPアドレスをループバックアドレス(127.1.0.0/16)に，TCPポートをリスナに置き換える
+    IPアドレスが変わるため，OpenVPN設定は接続先の行だけを残して作り直す
+    """
+    n = 0
+    with open(src, "r", encoding="utf-8", newline="") as fin, open(dst, "w", encoding="utf-8", newline="") as fout:
+        w = csv.writer(fout, delimiter=",", lineterminator="\r\n")
+        for line in fin:
+            if line.startswith(("*", "#")):
+                fout.write(line)
+                continue
+            for row in csv.reader([line]):
+                if len(row) < 15:
+                    continue
+                n += 1
+                ip = f"127.1.{n // 250}.{n % 250 + 1}"
+                ovpn = f"client\r\ndev tun\r\nproto tcp\r\nremote {ip} {port}\r\n"
+                w.writerow([*row[:1], ip, *row[2:14], base64.b64encode(ovpn.encode()).decode()])
+    return n
+
+
+def accept_forever(listener: socket.socket):
+    while True:
+        (conn, _) = listener.accept()
+        conn.close()
+
+
+class QuietHandler(SimpleHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeDhcpClient:
+    """
+    dhcpc.Clientの代わり．設定した遅延の後にリースを返す
+    """
+    latency = 0.0
+    fail = 0.0
+    rnd = random.Random(0)
+    seq = 0
+
+    def __init__(self, nic: str, timeout: float = None):
+        self.nic = nic
+
+    def discover(self) -> dhcpc.Lease:
+        time.sleep(self.latency)
+        if self.rnd.random() < self.fail:
+            return None
+        FakeDhcpClient.seq += 1
+        return dhcpc.Lease(f"10.211.{self.seq // 250}.{self.seq % 250 + 2}", 16, "10.211.254.254",
+                           "10.211.254.254", 7200, 3600, 6300, time.monotonic(), "5e:00:00:00:00:01")
+
+    def renew(self, lease: dhcpc.Lease) -> dhcpc.Lease:
+        time.sleep(self.latency)
+        return dhcpc.Lease(lease.address, lease.prefixlen, lease.router, lease.server,
+                           lease.lease_time, lease.t1, lease.t2, time.monotonic(), lease.server_mac)
+
+    def release(self, lease: dhcpc.Lease):
+        pass
+
+    def close(self):
+        pass
+
+
+def setup_router(args, sim: Path, csv_url: str):
+    """
+    main.pyのファイル・ソケットの出力先をすべて一時ディレクトリに向ける
+    """
+    with open(main.get_path(main.JSON_PATH), "r") as f:
+        config = json.load(f)
+    config.update(
+        network={"backend": "command"},  # netlinkは実機のNICを操作するため使わない
+        metrics={"enable": False},
+        detect={**config.get("detect", {}), "probe": False},  # 偽のNICにはpingできない
+        standby={**config.get("standby", {}), "enable": args.standby},
+        qualify={"enable": False},
+        quality={"enable": False},
+        bond={**config.get("bond", {}), "enable": False},  # ip ruleとsysctlは実機の設定になるため使わない
+        bypass={**config.get("bypass", {}), "enable": False},
+        dns={**config.get("dns", {}), "enable": False},  # 53番ポートとbr_eth1のアドレスは実機の設定になるため使わない
+    )
+    config_path = sim.joinpath("config.json")
+    config_path.write_text(json.dumps(config))
+    main.JSON_PATH = str(config_path)
+    main.CSV_URL = csv_url
+    main.VPNCMD_PATH = str(sim.joinpath("bin/vpncmd"))
+    main.SERVERLIST_CACHE = str(sim.joinpath("serverlist.csv"))
+    main.SERVERLIST_META = str(sim.joinpath("serverlist.json"))
+    main.REPUTATION_DB = str(sim.joinpath("reputation.db"))
+    main.RESUME_STATE = str(sim.joinpath("session.json"))
+    main.logger = logwriter.LogWriter(sim.joinpath("log"), main.ZoneInfo("Asia/Tokyo"))
+    main.state.Publisher = partial(state.Publisher, str(sim.joinpath("state.sock")))
+    FakeDhcpClient.latency = args.dhcp_latency
+    FakeDhcpClient.fail = args.dhcp_fail
+    main.dhcpc.Client = FakeDhcpClient
+
+
+def instrument() -> (queue.Queue, Counter):
+    """
+    切断の検知，接続完了，異常終了を記録し，サブプロセスの起動とvpncmdのコマンドを数える
+    """
+    events = queue.Queue()
+    counts = Counter()
+    report_failure = main.report_failure
+    start_session = main.start_session
+    runvpncmd = main.runvpncmd
+
+    def counted_report_failure(sid: int, reason: str, source: str):
+        was = main.is_connected and sid == main.session_id
+        report_failure(sid, reason, source)
+        if was and not main.is_connected:
+            events.put(("detected", time.perf_counter(), source))
+
+    def counted_start_session():
+        start_session()
+        events.put(("connected", time.perf_counter(), main.vpngate_ip_list[-1]))
+
+    def counted_runvpncmd(command: list[str], log_disp_out: bool = True):
+        counts[f"vpncmd {command[0]}"] += 1
+        return runvpncmd(command, log_disp_out=log_disp_out)
+
+    def fatal():
+        events.put(("fatal", time.perf_counter(), None))
+        raise SystemExit(1)
+
+    class CountingPopen(subprocess.Popen):
+        def __init__(self, command, *args, **kwargs):
+            counts[f"exec {os.path.basename(command[0])}"] += 1
+            super().__init__(command, *args, **kwargs)
+
+    subprocess.Popen = CountingPopen
+    main.report_failure = counted_report_failure
+    main.start_session = counted_start_session
+    main.runvpncmd = counted_runvpncmd
+    main.err_exit = fatal
+    return (events, counts)
+
+
+def run_router(events: queue.Queue):
+    """
+    main()が戻った場合や例外で終了した場合も，待っている計測を止める
+    """
+    try:
+        main.main()
+    finally:
+        events.put(("fatal", time.perf_counter(), None))
+
+
+def wait_event(events: queue.Queue, kind: str, timeout: float = 120.0) -> tuple:
+    deadline = time.monotonic() + timeout
+    while True:
+        remain = deadline - time.monotonic()
+        if remain <= 0:
+            raise TimeoutError(f"No {kind} event within {timeout}s")
+        (k, t, value) = events.get(timeout=remain)
+        if k == "fatal":
+            raise RuntimeError("The router exited with a fatal error")
+        if k == kind:
+            return (t, value)
+
+
+def drive(args, sim: Path, events: queue.Queue, counts: Counter, out) -> dict:
+    """
+    接続完了を待ってから現用系のセッションを切断させることを繰り返す
+    """
+    rnd = random.Random(0)
+    start = time.perf_counter()
+    results = {"initial": None, "failovers": [], "error": None}
+    try:
+        (t, server) = wait_event(events, "connected")
+        results["initial"] = t - start
+        print(f"initial connect {results['initial'] * 1000:8.1f}ms  ({server})", file=out)
+        for i in range(args.failovers):
+            time.sleep(args.hold + rnd.random())  # 状態確認の周期のどこで切れるかをばらつかせる
+            before = Counter(counts)
+            injected = time.perf_counter()
+            sim.joinpath(f"kill-{main.vpn_account}").touch()
+            (detected, source) = wait_event(events, "detected")
+            (connected, server) = wait_event(events, "connected")
+            calls = Counter(counts)
+            calls.subtract(before)
+            r = {
+                "detect": detected - injected,
+                "reconnect": connected - detected,
+                "calls": +calls,
+                "source": source,
+            }
+            results["failovers"].append(r)
+            print(f"failover {i + 1:3d}  detect {r['detect'] * 1000:8.1f}ms  reconnect {r['reconnect'] * 1000:8.1f}ms"
+                  f"  exec {sum(v for (k, v) in calls.items() if k.startswith('exec')):3d}"
+                  f"  vpncmd {sum(v for (k, v) in calls.items() if k.startswith('vpncmd')):3d}  ({server})", file=out)
+    except (TimeoutError, RuntimeError, queue.Empty) as e:
+        results["error"] = str(e) or "timeout"
+    return results
+
+
+def percentiles(values: list[float]) -> str:
+    values = sorted(values)
+
+    def pct(q: float) -> float:
+        return values[max(0, math.ceil(len(values) * q) - 1)]
+
+    return (f"mean {sum(values) / len(values) * 1000:8.1f}ms  p50 {pct(0.5) * 1000:8.1f}ms  "
+            f"p90 {pct(0.9) * 1000:8.1f}ms  max {values[-1] * 1000:8.1f}ms")
+
+
+def report(results: dict):
+    f = results["failovers"]
+    if results["error"] is not None:
+        print(f"stopped: {results['error']}")
+    if len(f) == 0:
+        return
+    print(f"detect     {percentiles([r['detect'] for r in f])}")
+    print(f"reconnect  {percentiles([r['reconnect'] for r in f])}")
+    print(f"total      {percentiles([r['detect'] + r['reconnect'] for r in f])}")
+    total = Counter()
+    for r in f:
+        total.update(r["calls"])
+    print("per failover (mean):")
+    for (name, n) in sorted(total.items()):
+        print(f"  {name:28s} {n / len(f):8.2f}")
+
+
+if __name__ == "__main__":
+    bench()
@@ -0,0 +1,157 @@
+#!/usr/bin/env python3.11
+"""
+偽のvpncmd(対話モード)
+VpncmdSessionが使うコマンドだけを実装する
+接続状態は実機のvpnclientと同じくルータの再起動をまたいで残るよう，接続設定ごとにSIM_DIRのファイルに保存する
+遅延・失敗率は環境変数で受け取る
+
+  SIM_VPNCMD_LATENCY  コマンド1回の応答時間(秒)．応答の本文を書いてからプロンプトを書くまでの時間
+  SIM_CONNECT_LATENCY accountconnectからセッション確立までの時間(秒)
+  SIM_CONNECT_FAIL    セッションが確立しない確率(0～1)
+  SIM_DIR             このディレクトリのファイルで障害を起こす．起動するたびにstartsに1行追記する
+                        kill-{接続設定名}  そのセッションを切断する
+                        down               vpnclientが停止しているものとして，起動直後にError code 1で終了する
+                        hang               次のコマンドに応答しない
+                        crash              次のコマンドで応答せずに終了する
+                      hangとcrashは中身の数値の回数(空なら1回)だけ起こし，使い切ったらファイルを消す
+"""
+
+import os
+import sys
+import json
+import fcntl
+import time
+import random
+
+PROMPT = "VPN Client>"
+OK = "The command completed successfully."
+COMPLETED = "Connection Completed (Session Established)"
+
+latency = float(os.environ.get("SIM_VPNCMD_LATENCY", "0"))
+connect_latency = float(os.environ.get("SIM_CONNECT_LATENCY", "0"))
+connect_fail = float(os.environ.get("SIM_CONNECT_FAIL", "0"))
+sim_dir = os.environ.get("SIM_DIR", ".")
+rnd = random.Random(int(os.environ.get("SIM_SEED", "0")))
+state_path = os.path.join(sim_dir, "vpnclient.json")
+accounts: dict[str, dict] = {}  # 接続設定名: {"server", "established_at"(確立しない場合はNone), "bytes"}
+
+
+def load():
+    accounts.clear()
+    try:
+        with open(state_path, "r") as f:
+            accounts.update(json.load(f))
+    except (FileNotFoundError, json.decoder.JSONDecodeError):
+        pass
+
+
+def save():
+    tmp = f"{state_path}.tmp"
+    with open(tmp, "w") as f:
+        json.dump(accounts, f)
+    os.replace(tmp, state_path)
+
+
+def reply(text: str):
+    sys.stdout.write(f"{text}\n\n")
+    sys.stdout.flush()
+    time.sleep(latency)  # プロンプトが本文と別に届く場合を作る
+    sys.stdout.write(f"{PROMPT} ")
+    sys.stdout.flush()
+
+
+def inject(name: str) -> bool:
+    """
+    SIM_DIRにnameのファイルがあれば1回分消費してTrueを返す
+    """
+    path = os.path.join(sim_dir, name)
+    try:
+        with open(path, "r+") as f:
+            count = int(f.read().strip() or "1") - 1
+            f.seek(0)
+            f.truncate()
+            f.write(str(count))
+    except FileNotFoundError:
+        return False
+    if count <= 0:
+        os.remove(path)
+    return True
+
+
+def status(name: str) -> str:
+    a = accounts.get(name)
+    kill = os.path.join(sim_dir, f"kill-{name}")
+    if a is not None and os.path.exists(kill):
+        os.remove(kill)
+        a["established_at"] = None  # 中継サーバ側で切断された
+    if a is None:
+        return "Error occurred. (Error code: 37)\nThe specified VPN Connection Setting is not connected."
+    if a["established_at"] is None or time.monotonic() < a["established_at"]:
+        session = "Retrying" if a["established_at"] is None else "Connecting to the VPN Server"
+    else:
+        session = COMPLETED
+        a["bytes"] += rnd.randint(10 ** 5, 10 ** 7)
+    rows = [
+        ("VPN Connection Setting Name", name),
+        ("Session Status", session),
+        ("Server Name", a["server"]),
+        ("Outgoing Data Size", f"{a['bytes'] // 10:,} bytes"),
+        ("Incoming Data Size", f"{a['bytes']:,} bytes"),
+    ]
+    table = "\n".join(f"{k:<42s}|{v}" for (k, v) in rows)
+    return f"Item                                      |Value\n{'-' * 42}+{'-' * 20}\n{table}\n{OK}"
+
+
+def execute(args: list[str]) -> str:
+    command = args[0].lower()
+    name = args[1] if len(args) > 1 else ""
+    if command == "accountset":
+        server = next((a[len("/server:"):] for a in args if a.lower().startswith("/server:")), "")
+        accounts[name] = {"server": server, "established_at": None, "bytes": 0}
+        return OK
+    if command == "accountconnect":
+        a = accounts.setdefault(name, {"server": "", "established_at": None, "bytes": 0})
+        a["established_at"] = None if rnd.random() < connect_fail else time.monotonic() + connect_latency
+        a["bytes"] = 0
+        return OK
+    if command == "accountdisconnect":
+        accounts.pop(name, None)
+        return OK
+    if command == "accountstatusget":
+        return status(name)
+    return f"Error occurred. (Error code: 29)\nUnknown command \"{args[0]}\"."
+
+
+def main():
+    with open(os.path.join(sim_dir, "starts"), "a") as f:
+        f.write(f"{os.getpid()}\n")
+    sys.stdout.write("vpncmd command - SoftEther VPN Command Line Management Utility (simulated)\n\n")
+    if os.path.exists(os.path.join(sim_dir, "down")):
+        sys.stdout.write("Error occurred. (Error code: 1)\n"
+                         "Connection to the server failed. Check network connection and make sure that "
+                         "address and port number of destination server are correct.\n")
+        sys.stdout.flush()
+        sys.exit(1)
+    sys.stdout.write("Connected to VPN Client \"localhost\".\n\n")
+    reply("")
+    for line in sys.stdin:
+        args = line.split()
+        if len(args) == 0:
+            reply("")
+            continue
+        if args[0].lower() == "exit":
+            return
+        if inject("crash"):
+            os._exit(1)
+        if inject("hang"):
+            time.sleep(3600)
+        with open(f"{state_path}.lock", "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)  # 同時に動く別のvpncmdと状態を取り合わないため
+            load()  # established_atはtime.monotonic()のため，プロセスをまたいでもそのまま比べられる
+            res = execute(args)
+            save()
+        reply(res)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+#!/usr/bin/env python3.11
+"""
+フェイルオーバー時のネットワーク再設定のベンチマーク
+ipreset + ipconfig相当の処理(経路・アドレスの削除と設定，ゲートウェイの取得)を繰り返し，
+netlinkバックエンドとip/iptablesコマンドのバックエンドの所要時間を比較する
+デフォルトルートはテスト用NICに向けると通信できなくなるため対象外
+
+使い方: sudo python bench/ipconfig.py [テスト用NIC] [上流NIC] [回数]
+テスト用NICは使用していないもの(ifb0など)を指定し，実行中はアップ状態にする
+"""
+
+import sys
+import time
+import shutil
+import statistics
+import subprocess
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+import netconf  # noqa: E402
+
+RELAY_IP = "198.51.100.7"  # 中継サーバの代わり(TEST-NET-2)
+ADDRESS = "10.211.3.4"  # VPNGateのDHCPで得るアドレスの代わり
+
+
+def runcmd(command: list[str], log_disp_out: bool = True, input: str = None) -> subprocess.CompletedProcess:
+    return subprocess.run(command, check=False, capture_output=True, text=True, input=input)
+
+
+def failover(net, nic: str, upstream: str, nat: bool):
+    """
+    1回分のフェイルオーバーでの再設定(ipreset → ipconfig)
+    """
+    net.route_del(RELAY_IP)
+    net.addr_flush(nic)
+    if nat:
+        net.masquerade(net.get_nw(upstream), add=[nic], delete=[nic])
+    gateway = net.get_gw(upstream)
+    net.route_add(RELAY_IP, gateway, upstream)
+    net.addr_add(nic, ADDRESS, 16)
+
+
+def measure(net, nic: str, upstream: str, count: int, nat: bool):
+    net.route_add(RELAY_IP, net.get_gw(upstream), upstream)
+    net.addr_add(nic, ADDRESS, 16)
+    if nat:
+        net.masquerade(net.get_nw(upstream), add=[nic])
+    times = []
+    try:
+        for _ in range(count):
+            start = time.perf_counter()
+            failover(net, nic, upstream, nat)
+            times.append((time.perf_counter() - start) * 1000)
+    finally:
+        net.route_del(RELAY_IP)
+        net.addr_flush(nic)
+        if nat:
+            net.masquerade(net.get_nw(upstream), delete=[nic])
+    print(f"{net.name:8s} mean {statistics.mean(times):8.2f}ms  "
+          f"median {statistics.median(times):8.2f}ms  max {max(times):8.2f}ms")
+
+
+def bench():
+    nic = sys.argv[1] if len(sys.argv) > 1 else "ifb0"
+    upstream = sys.argv[2] if len(sys.argv) > 2 else "eth0"
+    count = int(sys.argv[3]) if len(sys.argv) > 3 else 100
+    nat = shutil.which("iptables") is not None and shutil.which("iptables-restore") is not None
+    print(f"NIC: {nic}  Upstream: {upstream}  {count} times  NAT: {'yes' if nat else 'no (iptables not found)'}")
+    runcmd(["ip", "link", "set", nic, "up"])
+    try:
+        for backend in (netconf.CommandBackend, netconf.NetlinkBackend):
+            net = backend(runcmd)
+            try:
+                measure(net, nic, upstream, count, nat)
+            finally:
+                net.close()
+    finally:
+        runcmd(["ip", "link", "set", nic, "down"])
+
+
+if __name__ == "__main__":
+    bench()
@@ -0,0 +1,74 @@
+#!/usr/bin/env python3.11
+"""
+ログ出力のベンチマーク
+serverlist.pyと同じフィクスチャでget_server_listを実行し，
+旧実装(1件ごとにファイルを開いて追記)，LogWriterのdebugレベル，infoレベルの処理時間を比較する
+書き込みスレッドが書き終えるまでの時間も含める
+
+使い方: python bench/log.py [行数]
+"""
+
+import sys
+import os
+import time
+import tempfile
+from zoneinfo import ZoneInfo
+from datetime import datetime
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+import main  # noqa: E402
+import logwriter  # noqa: E402
+from serverlist import make_fixture, FIXTURE_PATH  # noqa: E402
+
+
+class LegacyLogWriter:
+    """
+    変更前のlog_write相当の処理(メッセージごとにパスを求めてファイルを開く)
+    """
+
+    def __init__(self, directory: Path):
+        self.directory = directory
+        self.level = logwriter.DEBUG
+
+    def enabled(self, level: int) -> bool:
+        return True
+
+    def write(self, level: int, msg: str):
+        dt = datetime.now(ZoneInfo("Asia/Tokyo"))
+        path = self.directory.joinpath(f"log-{dt.date()}.txt")
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, mode="a", encoding="utf-8") as f:
+            f.write(f"[{dt}] {logwriter.PREFIX[level]}{msg}\n")
+
+    def close(self):
+        pass
+
+
+def measure(name: str, logger):
+    main.logger = logger
+    main.server_table = None  # 毎回パースさせる
+    start = time.perf_counter()
+    table = main.get_server_list()
+    end = time.perf_counter()
+    logger.close()
+    flushed = time.perf_counter()
+    print(f"{name:8s} {len(table):6d} servers  {(end - start) * 1000:9.1f}ms  "
+          f"(written {(flushed - start) * 1000:9.1f}ms)")
+
+
+def bench():
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    make_fixture(FIXTURE_PATH, rows)
+    print(f"Fixture: {FIXTURE_PATH} ({rows} rows)")
+    main.VPNGATE_COUNTRY = None  # 全行をログに出す
+    main.open_server_list = lambda: open(FIXTURE_PATH, "r", encoding="utf-8", newline="")
+    tz = ZoneInfo("Asia/Tokyo")
+    with tempfile.TemporaryDirectory() as d:
+        measure("legacy", LegacyLogWriter(Path(d, "legacy")))
+        measure("debug", logwriter.LogWriter(Path(d, "debug"), tz, level=logwriter.DEBUG))
+        measure("info", logwriter.LogWriter(Path(d, "info"), tz, level=logwriter.INFO))
+
+
+if __name__ == "__main__":
+    bench()
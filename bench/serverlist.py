@@ -0,0 +1,108 @@
+#!/usr/bin/env python3.11
+"""
+サーバリストのパース処理のベンチマーク
+VPNGateのCSVと同じ形式のフィクスチャを生成し，
+旧実装(全体をデコードしてからフィルタ)と，現在のget_server_listから候補選択(find_candidates)までの
+処理時間とピークメモリを比較する
+
+使い方: python bench/serverlist.py [行数]
+"""
+
+import sys
+import os
+import csv
+import time
+import base64
+import random
+import tracemalloc
+from io import StringIO
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+import main  # noqa: E402
+
+FIXTURE_PATH = Path(__file__).resolve().parent.joinpath("fixture/serverlist.csv")
+COUNTRIES = [("Japan", "JP"), ("Korea Republic of", "KR"), ("United States", "US"), ("Thailand", "TH")]
+
+
+def make_fixture(path: Path, rows: int):
+    """
+    VPNGateのCSVと同じ形式のフィクスチャを生成する(乱数は固定)
+    """
+    rnd = random.Random(0)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, "w", encoding="utf-8", newline="") as f:
+        f.write("*vpn_servers\r\n")
+        f.write("#HostName,IP,Score,Ping,Speed,CountryLong,CountryShort,NumVpnSessions,Uptime,"
+                "TotalUsers,TotalTraffic,LogType,Operator,Message,OpenVPN_ConfigData_Base64\r\n")
+        w = csv.writer(f, delimiter=",", lineterminator="\r\n")
+        for i in range(rows):
+            ip = f"{rnd.randint(1, 223)}.{rnd.randint(0, 255)}.{rnd.randint(0, 255)}.{rnd.randint(1, 254)}"
+            port = rnd.choice([443, 992, 1194, 5555])
+            (clong, cshort) = rnd.choice(COUNTRIES)
+            ovpn = f"client\r\ndev tun\r\nproto tcp\r\nremote {ip} {port}\r\n" + "#" * 2000
+            w.writerow([
+                f"vpn{i}", ip, rnd.randint(1000, 3000000), rnd.randint(1, 100), rnd.randint(1000000, 900000000),
+                clong, cshort, rnd.randint(0, 300), rnd.randint(1000, 90000000), rnd.randint(1, 900000),
+                rnd.randint(1, 10 ** 13), "2weeks", rnd.choice(["owner", "Daiyuu Nobori_ Japan. Academic Use Only."]),
+                "", base64.b64encode(ovpn.encode()).decode(),
+            ])
+        f.write("*\r\n")
+
+
+def legacy_get_server_list(content: str):
+    """
+    変更前のget_server_list相当の処理(ログ出力を除く)
+    """
+    res = []
+    server_list = list(csv.reader(StringIO(content), delimiter=","))[2:-1]
+    for s in server_list:
+        sinfo = main.ServerConnectInfo(
+            s[0], s[1], main.get_port_from_openvpn(s[14]), main.str2int(s[2]), main.str2int(s[3]),
+            main.str2int(s[4]), s[6], main.str2int(s[7]), main.str2int(s[8]), s[12],
+        )
+        if main.VPNGATE_COUNTRY is not None and sinfo.country != main.VPNGATE_COUNTRY:
+            continue
+        if len(main.VPNGATE_EXCEPTION_BY_OP) > 0 and sinfo.operator in main.VPNGATE_EXCEPTION_BY_OP:
+            continue
+        res.append(sinfo)
+    res.sort(key=lambda x: x.score, reverse=True)
+    return res
+
+
+def measure(name: str, func):
+    tracemalloc.start()
+    start = time.perf_counter()
+    res = func()
+    end = time.perf_counter()
+    (_, peak) = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"{name:10s} {len(res):6d} servers  {(end - start) * 1000:9.1f}ms  peak {peak / 1000000:7.2f}MB")
+
+
+def bench():
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    make_fixture(FIXTURE_PATH, rows)
+    print(f"Fixture: {FIXTURE_PATH} ({os.path.getsize(FIXTURE_PATH) / 1000000:.2f}MB, {rows} rows)")
+    # ログ出力はベンチマーク対象外
+    main.print_debug = lambda *args, **kwargs: None
+    main.print_error = lambda *args, **kwargs: None
+    main.print_log = lambda *args, **kwargs: None
+    main.reputation = main.ReputationStore(":memory:")  # 接続実績なし
+    main.open_server_list = lambda: open(FIXTURE_PATH, "r", encoding="utf-8", newline="")
+
+    def legacy():
+        with open(FIXTURE_PATH, "rb") as f:
+            return legacy_get_server_list(f.read().decode("utf-8"))
+
+    def streaming():
+        main.server_table = None  # 毎回パースさせる
+        return main.find_candidates(required=False)
+
+    measure("legacy", legacy)
+    measure("streaming", streaming)
+    measure("cached", lambda: main.find_candidates(required=False))
+
+
+if __name__ == "__main__":
+    bench()
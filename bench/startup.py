@@ -0,0 +1,189 @@
+#!/usr/bin/env python3.11
+"""
+起動から接続完了までのベンチマーク
+failover.pyと同じ偽のvpncmd・ip・iptables・DHCPとローカルで配信するサーバリストを使い，main.pyを毎回別のプロセスで起動する
+インポートを含めて，プロセスの起動から最初のセッション確立までの時間を起動方法ごとに計測する
+
+  cold    サーバリストのキャッシュも前回の状態もない(初回起動)
+  cached  サーバリストのキャッシュはあるが，前回の状態がない
+  resume  前回は正常終了した(前回のサーバに直接接続し直す)
+  adopt   前回は異常終了し，セッションが確立したまま残っている(そのまま引き取る)
+
+使い方: python bench/startup.py [-n 回数] [--connect-latency 1.0] ...
+"""
+
+import os
+import sys
+import math
+import time
+import signal
+import socket
+import argparse
+import tempfile
+import threading
+import subprocess
+from functools import partial
+from http.server import ThreadingHTTPServer
+from pathlib import Path
+
+BENCH_DIR = Path(__file__).resolve().parent
+MODES = ["cold", "cached", "resume", "adopt"]
+
+
+def bench():
+    parser = argparse.ArgumentParser(description="Startup benchmark on simulated vpncmd, ip, iptables and DHCP")
+    parser.add_argument("-n", "--rounds", type=int, default=5)
+    parser.add_argument("--fixture", type=Path, help="recorded VPNGate CSV (default: generated fixture)")
+    parser.add_argument("--rows", type=int, default=5000, help="rows of the generated fixture")
+    parser.add_argument("--vpncmd-latency", type=float, default=0.02, help="seconds per vpncmd command")
+    parser.add_argument("--connect-latency", type=float, default=1.0, help="seconds until a session is established")
+    parser.add_argument("--cmd-latency", type=float, default=0.002, help="seconds per ip/iptables/curl run")
+    parser.add_argument("--dhcp-latency", type=float, default=0.2, help="seconds per DHCP exchange")
+    parser.add_argument("--verbose", action="store_true", help="show the router output")
+    parser.add_argument("--child", type=Path, help=argparse.SUPPRESS)  # 計測対象のルータとして動く
+    parser.add_argument("--csv-url", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child is not None:
+        child(args)
+        return
+    with tempfile.TemporaryDirectory(prefix="vpngate-sim-") as d:
+        run(args, Path(d))
+
+
+def run(args, sim: Path):
+    sys.path.insert(0, str(BENCH_DIR))
+    from failover import install_fakes, rewrite_fixture, default_fixture, accept_forever, QuietHandler
+    bin_dir = sim.joinpath("bin")
+    bin_dir.mkdir()
+    install_fakes(bin_dir, argparse.Namespace(cmd_fail=0.0, cmd_latency=args.cmd_latency))
+    os.environ["PATH"] = f"{bin_dir}:{os.environ['PATH']}"
+    os.environ.update(
+        SIM_DIR=str(sim),
+        SIM_VPNCMD_LATENCY=str(args.vpncmd_latency),
+        SIM_CONNECT_LATENCY=str(args.connect_latency),
+        SIM_CONNECT_FAIL="0",  # 起動方法による違いだけを比べる
+    )
+    listener = socket.create_server(("0.0.0.0", 0), backlog=1024)
+    threading.Thread(target=accept_forever, args=(listener,), daemon=True).start()
+    servers = rewrite_fixture(args.fixture or default_fixture(args.rows), sim.joinpath("api.csv"),
+                              listener.getsockname()[1])
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), partial(QuietHandler, directory=str(sim)))
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    csv_url = f"http://127.0.0.1:{httpd.server_address[1]}/api.csv"
+    print(f"{servers} servers in the fixture, {args.rounds} rounds")
+    results = {mode: [] for mode in MODES}
+    try:
+        for i in range(args.rounds):
+            for mode in MODES:
+                prepare(sim, mode)
+                # adoptの前はセッションを残したまま異常終了させる
+                r = start_router(args, sim, csv_url, kill=signal.SIGKILL if mode == "resume" else signal.SIGINT)
+                results[mode].append(r)
+                print(f"round {i + 1:3d}  {mode:6s}  import {r['import'] * 1000:8.1f}ms"
+                      f"  connected {r['connected'] * 1000:8.1f}ms  ({r['server']})")
+    except (TimeoutError, RuntimeError) as e:
+        print(f"stopped: {e}")
+    report(results)
+
+
+def prepare(sim: Path, mode: str):
+    """
+    起動方法に合わせて，サーバリストのキャッシュ・前回の状態・vpnclientの接続状態を消す
+    resumeとadoptは直前の起動(cachedとresume)が残したものをそのまま使う
+    """
+    names = {
+        "cold": ["serverlist.csv", "serverlist.json", "session.json", "vpnclient.json"],
+        "cached": ["session.json", "vpnclient.json"],
+    }.get(mode, [])
+    for name in names:
+        sim.joinpath(name).unlink(missing_ok=True)
+
+
+def start_router(args, sim: Path, csv_url: str, kill: int, timeout: float = 120.0) -> dict:
+    """
+    ルータのプロセスを起動して接続完了を待ち，killのシグナルで終了させる
+    """
+    command = [sys.executable, __file__, "--child", str(sim), "--csv-url", csv_url,
+               "--dhcp-latency", str(args.dhcp_latency)] + (["--verbose"] if args.verbose else [])
+    start = time.perf_counter()
+    p = subprocess.Popen(command, stdout=subprocess.PIPE, text=True)
+    res = {}
+    timer = threading.Timer(timeout, p.kill)
+    timer.start()
+    try:
+        for line in p.stdout:
+            (kind, _, value) = line.rstrip("\n").partition(" ")
+            if kind == "imported":
+                res["import"] = time.perf_counter() - start
+            elif kind == "connected":
+                res["connected"] = time.perf_counter() - start
+                res["server"] = value
+                break
+            elif args.verbose:
+                print(line, end="")  # ルータの出力
+        if "connected" not in res:
+            raise RuntimeError("The router exited before connecting")
+        p.send_signal(kill)
+        rest = p.stdout.read()  # 終了処理(切断・設定の解除)が終わるまで待つ
+        if args.verbose:
+            print(rest, end="")
+        p.wait()
+    finally:
+        timer.cancel()
+        if p.poll() is None:
+            p.kill()
+            p.wait()
+    return res
+
+
+def child(args):
+    """
+    failover.pyと同じ設定でmain()を動かし，インポートの完了と接続完了を標準出力で親に知らせる
+    """
+    out = sys.stdout
+    sys.path.insert(0, str(BENCH_DIR))
+    import failover  # main.pyのインポートを含む
+    import main
+    out.write("imported\n")
+    out.flush()
+    failover.setup_router(argparse.Namespace(standby=False, dhcp_latency=args.dhcp_latency, dhcp_fail=0.0),
+                          args.child, args.csv_url)
+    (events, _) = failover.instrument()
+
+    def notify():
+        while True:
+            (kind, _, value) = events.get()
+            if kind == "connected":
+                out.write(f"connected {value}\n")
+                out.flush()
+                return
+
+    threading.Thread(target=notify, daemon=True).start()
+    if not args.verbose:
+        sys.stdout = open(os.devnull, "w")
+    main.main()  # SIGINTはKeyboardInterruptとしてmain()が受け取り，正常終了する
+
+
+def percentiles(values: list[float]) -> str:
+    values = sorted(values)
+
+    def pct(q: float) -> float:
+        return values[max(0, math.ceil(len(values) * q) - 1)]
+
+    return (f"mean {sum(values) / len(values) * 1000:8.1f}ms  p50 {pct(0.5) * 1000:8.1f}ms  "
+            f"p90 {pct(0.9) * 1000:8.1f}ms  max {values[-1] * 1000:8.1f}ms")
+
+
+def report(results: dict):
+    print("startup to connected:")
+    for (mode, r) in results.items():
+        if len(r) > 0:
+            print(f"  {mode:6s}  {percentiles([x['connected'] for x in r])}")
+    print("startup to imported:")
+    for (mode, r) in results.items():
+        if len(r) > 0:
+            print(f"  {mode:6s}  {percentiles([x['import'] for x in r])}")
+
+
+if __name__ == "__main__":
+    bench()
@@ -0,0 +1,154 @@
+#!/usr/bin/env python3.11
+"""
+VpncmdSessionの動作確認
+fake_vpncmd.pyを対話モードのvpncmdとして起動し，次の点を確かめる
+
+  prompt   起動時のバナーを読み捨て，プロンプトが本文と別に届いても1コマンド分の応答だけを返す
+  timeout  応答がないと状態・一覧の取得はquery_timeout秒(既定は5秒)，それ以外はtimeout秒(既定は60秒)で諦め，
+           プロセスを待たずに終了させて起動し直し，コマンドを再送する
+  restart  プロセスが落ちた場合は1回だけ起動し直して再送し，2回続けて落ちたら失敗を返す
+  down     vpnclientが停止している場合，"(Error code: 1)"を含む出力を返す
+
+最後に，常駐させた場合とコマンドごとにプロセスを起動した場合の1コマンドあたりの時間を比べる
+
+使い方: python bench/vpncmd_session.py [--timeout 1.0] [--latency 0.05] [-n 回数]
+"""
+
+import os
+import sys
+import time
+import argparse
+import tempfile
+import subprocess
+from pathlib import Path
+
+BENCH_DIR = Path(__file__).resolve().parent
+sys.path.insert(0, str(BENCH_DIR.parent))
+import main  # noqa: E402
+
+STATUS = ["accountstatusget", "vpngate"]
+
+
+def bench():
+    parser = argparse.ArgumentParser(description="Check VpncmdSession against a simulated interactive vpncmd")
+    parser.add_argument("--timeout", type=float, default=1.0,
+                        help=f"query timeout for the timeout check; other commands get twice this"
+                             f" (router default: {main.VPNCMD_QUERY_TIMEOUT:g}s / {main.VPNCMD_TIMEOUT:g}s)")
+    parser.add_argument("--latency", type=float, default=0.05, help="seconds per vpncmd command")
+    parser.add_argument("-n", "--rounds", type=int, default=50, help="commands for the latency comparison")
+    args = parser.parse_args()
+    main.log_write = lambda *args, **kwargs: None  # リポジトリのlog/に書かない
+    with tempfile.TemporaryDirectory(prefix="vpngate-sim-") as d:
+        sim = Path(d)
+        path = sim.joinpath("vpncmd")
+        path.write_text(f'#!/bin/sh\nexec "{sys.executable}" "{BENCH_DIR.joinpath("fake_vpncmd.py")}" "$@"\n')
+        path.chmod(0o755)
+        os.environ.update(SIM_DIR=str(sim), SIM_VPNCMD_LATENCY=str(args.latency))
+        checks = [check_prompt, check_timeout, check_restart, check_down]
+        failed = 0
+        for check in checks:
+            sim.joinpath("starts").unlink(missing_ok=True)
+            session = main.VpncmdSession(str(path), timeout=args.timeout * 2, query_timeout=args.timeout)
+            try:
+                check(session, sim, args)
+                print(f"ok    {check.__name__}")
+            except AssertionError as e:
+                failed += 1
+                print(f"FAIL  {check.__name__}: {e}")
+            finally:
+                session.close()
+        compare(main.VpncmdSession(str(path)), path, args)
+    if failed > 0:
+        sys.exit(1)
+
+
+def starts(sim: Path) -> int:
+    path = sim.joinpath("starts")
+    return len(path.read_text().splitlines()) if path.exists() else 0
+
+
+def check_prompt(session, sim: Path, args):
+    default = main.VpncmdSession(session.path)
+    assert default.timeout == main.VPNCMD_TIMEOUT == 60, "default timeout is not 60s"
+    assert default.query_timeout == main.VPNCMD_QUERY_TIMEOUT <= 5, "default query timeout is over 5s"
+    res = session.run(["accountset", "vpngate", "/server:192.0.2.1:443", "/hub:VPNGATE"])
+    assert res.returncode == 0, f"accountset failed: {res.stdout!r}"
+    assert "simulated" not in res.stdout, "the banner leaked into the first reply"
+    assert res.stdout.strip() == "The command completed successfully.", f"unexpected reply: {res.stdout!r}"
+    res = session.run(STATUS)
+    assert session.PROMPT not in res.stdout, "the prompt leaked into the reply"
+    assert "Server Name" in res.stdout and "192.0.2.1:443" in res.stdout, f"unexpected reply: {res.stdout!r}"
+    res = session.run(["accountdisconnect", "vpngate"])
+    assert "Server Name" not in res.stdout, "the previous reply leaked into the next one"
+    assert starts(sim) == 1, f"vpncmd was started {starts(sim)} times for 3 commands"
+
+
+def check_timeout(session, sim: Path, args):
+    session.run(["accountset", "vpngate", "/server:192.0.2.1:443"])
+    sim.joinpath("hang").write_text("1")
+    start = time.monotonic()
+    res = session.run(STATUS)
+    elapsed = time.monotonic() - start
+    # 応答しないプロセスは待たずに終了させるため，exitの待ち時間(1秒)は掛からない
+    assert args.timeout <= elapsed < args.timeout + 0.9, f"gave up after {elapsed:.2f}s (timeout {args.timeout:g}s)"
+    assert starts(sim) == 2, f"vpncmd was started {starts(sim)} times"
+    # 接続設定はvpnclient側(SIM_DIR)に残るため，起動し直したvpncmdからも同じ応答が返る
+    assert res.returncode == 0 and "192.0.2.1:443" in res.stdout, f"the command was not resent: {res.stdout!r}"
+    # 状態・一覧の取得以外(接続・設定)は長いtimeoutを使う
+    sim.joinpath("hang").write_text("1")
+    start = time.monotonic()
+    res = session.run(["accountset", "vpngate", "/server:192.0.2.1:443"])
+    elapsed = time.monotonic() - start
+    assert session.timeout <= elapsed < session.timeout + 0.9, \
+        f"accountset gave up after {elapsed:.2f}s (timeout {session.timeout:g}s)"
+    assert res.returncode == 0 and starts(sim) == 3, "accountset was not resent after the timeout"
+
+
+def check_restart(session, sim: Path, args):
+    session.run(["accountset", "vpngate", "/server:192.0.2.2:443"])
+    sim.joinpath("crash").write_text("1")
+    res = session.run(STATUS)
+    assert res.returncode == 0 and "192.0.2.2:443" in res.stdout, f"the command was not resent: {res.stdout!r}"
+    assert starts(sim) == 2, f"vpncmd was started {starts(sim)} times after one crash"
+    sim.joinpath("crash").write_text("3")
+    res = session.run(STATUS)
+    assert res.returncode == 1, "a command that crashed vpncmd twice was reported as successful"
+    assert starts(sim) == 3, f"vpncmd was restarted {starts(sim) - 2} times, expected once"
+    sim.joinpath("crash").unlink(missing_ok=True)
+    res = session.run(STATUS)
+    assert res.returncode == 0 and starts(sim) == 4, "the session did not recover after giving up"
+
+
+def check_down(session, sim: Path, args):
+    sim.joinpath("down").touch()
+    try:
+        res = session.run(STATUS)
+    finally:
+        sim.joinpath("down").unlink()
+    assert res.returncode == 1 and "(Error code: 1)" in res.stdout, f"unexpected output: {res.stdout!r}"
+    res = session.run(STATUS)
+    assert res.returncode == 0, "the session did not start after vpnclient came back"
+
+
+def compare(session, path: Path, args):
+    """
+    常駐させた場合とコマンドごとにプロセスを起動した場合の1コマンドあたりの時間
+    """
+    try:
+        session.run(STATUS)  # 起動の時間を含めない
+        start = time.perf_counter()
+        for _ in range(args.rounds):
+            session.run(STATUS, log_disp_out=False)
+        persistent = (time.perf_counter() - start) / args.rounds
+    finally:
+        session.close()
+    start = time.perf_counter()
+    for _ in range(args.rounds):
+        subprocess.run([str(path), "localhost", "/client"], input="accountstatusget vpngate\nexit\n",
+                       capture_output=True, text=True)
+    oneshot = (time.perf_counter() - start) / args.rounds
+    print(f"per command: persistent {persistent * 1000:8.1f}ms  one-shot {oneshot * 1000:8.1f}ms")
+
+
+if __name__ == "__main__":
+    bench()
@@ -0,0 +1,402 @@
+#!/usr/bin/env python3.11
+"""
+checker.pyのログ(check_log/)とmain.pyのログ(log/)を突き合わせ，通信断とフェイルオーバーの統計を出す
+ログは1行ずつ読み，時刻順に混ぜながら集計するため，数か月分あっても全体をメモリに載せない
+
+使い方: python check/analyze.py [--from 2025-01-01] [--to 2025-01-31] [--json]
+"""
+
+import re
+import sys
+import json
+import math
+import heapq
+import bisect
+import argparse
+from zoneinfo import ZoneInfo
+from datetime import datetime, date, timedelta
+from pathlib import Path
+
+TZ = ZoneInfo("Asia/Tokyo")  # 時差のない古いログはこのタイムゾーンとみなす
+BASE_DIR = Path(__file__).resolve().parent
+CHECK_DIR = BASE_DIR.joinpath("check_log")
+LOG_DIR = BASE_DIR.parent.joinpath("log")
+REORDER_WINDOW = 60.0  # checker.pyは完了順に書くため，この秒数の範囲で並べ直す
+SLACK = 10.0  # 通信断とフェイルオーバーを対応付ける際に許す時刻のずれ(秒)
+WAN_PROBE = "web"  # この名前で始まるプローブの応答をWAN IPとして扱う
+BLACKOUT_BUCKETS = [1, 5, 15, 60, 300]  # 通信断の長さの分布の区切り(秒)
+
+# checker.pyの結果コード
+OK = 0
+SKIPPED = 4
+
+RE_FILE = re.compile(r"^(.+)-(\d{4}-\d{2}-\d{2})\.txt$")
+RE_RECORD = re.compile(r"^\[(\d{4}-\d{2}-\d{2} [\d:.]+(?:[+-]\d{2}:\d{2})?)\] (.*)$")
+RE_CONNECTED = re.compile(r"^Connected in (\d+(?:\.\d+)?)ms(?:\s+Server: (\S+))?")
+RE_WANIP = re.compile(r"^IP Configuration OK\. WAN IP: (\S+)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Blackout and failover analysis over checker and router logs")
+    parser.add_argument("--from", dest="since", type=date.fromisoformat, help="first date (YYYY-MM-DD)")
+    parser.add_argument("--to", dest="until", type=date.fromisoformat, help="last date (YYYY-MM-DD)")
+    parser.add_argument("--check-dir", type=Path, default=CHECK_DIR)
+    parser.add_argument("--log-dir", type=Path, default=LOG_DIR)
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    args = parser.parse_args()
+    streams = [router_events(f) for f in log_files(args.log_dir, args.since, args.until).get("log", [])]
+    for (name, files) in log_files(args.check_dir, args.since, args.until).items():
+        streams.append(reorder(probe_events(name, files)))
+    analyzer = Analyzer()
+    for event in heapq.merge(*streams, key=lambda e: e[0]):
+        analyzer.feed(*event)
+    report = analyzer.report()
+    if args.json:
+        json.dump(report, sys.stdout, indent=2, default=str)
+        print()
+    else:
+        print_report(report)
+
+
+def log_files(directory: Path, since: date = None, until: date = None) -> dict[str, list[Path]]:
+    """
+    {name}-{date}.txtを名前ごとに日付順で返す．範囲外の日付のファイルは開かない
+    """
+    res = {}
+    if not directory.is_dir():
+        return res
+    for path in sorted(directory.iterdir()):
+        match = RE_FILE.match(path.name)
+        if not match:
+            continue
+        d = date.fromisoformat(match.group(2))
+        if (since is not None and d < since) or (until is not None and d > until):
+            continue
+        res.setdefault(match.group(1), []).append(path)
+    return res
+
+
+def parse_dt(s: str) -> datetime:
+    dt = datetime.fromisoformat(s)
+    return dt if dt.tzinfo is not None else dt.replace(tzinfo=TZ)
+
+
+def router_events(path: Path):
+    """
+    main.pyのログから必要な行だけを(時刻, 種類, 値)で返す．複数行にわたる記録の続きは読み飛ばす
+    """
+    with open(path, "r", encoding="utf-8", errors="replace") as f:
+        for line in f:
+            match = RE_RECORD.match(line.rstrip("\n"))
+            if not match:
+                continue
+            msg = match.group(2)
+            if msg == "Failover started.":
+                kind = ("failover", None)
+            elif msg.startswith("Connected in "):
+                m = RE_CONNECTED.match(msg)
+                kind = ("connected", (float(m.group(1)), m.group(2))) if m else None
+            elif msg.startswith("Switching to standby connection"):
+                kind = ("standby", None)
+            elif msg.startswith("IP Configuration OK."):
+                m = RE_WANIP.match(msg)
+                kind = ("wanip", m.group(1)) if m else None
+            elif msg in ("Exiting...", "Terminating due to error..."):
+                kind = ("exit", None)
+            else:
+                kind = None
+            if kind is not None:
+                try:
+                    yield (parse_dt(match.group(1)), *kind)
+                except ValueError:
+                    continue
+
+
+def probe_events(name: str, files: list[Path]):
+    """
+    checker.pyのログを(時刻, "probe", (名前, 結果コード, メッセージ))で返す
+    """
+    for path in files:
+        with open(path, "r", encoding="utf-8", errors="replace") as f:
+            for line in f:
+                fields = line.rstrip("\n").split("; ", 2)
+                if len(fields) < 2:
+                    continue
+                try:
+                    yield (parse_dt(fields[0]), "probe", (name, int(fields[1]), fields[2] if len(fields) > 2 else ""))
+                except ValueError:
+                    continue
+
+
+def reorder(events, window: float = REORDER_WINDOW):
+    """
+    多少前後している記録を時刻順に並べ直す．window秒より古いものから順に出す
+    """
+    heap = []
+    n = 0
+    for event in events:
+        heapq.heappush(heap, (event[0], n, event))
+        n += 1
+        while heap[0][0] < event[0] and (event[0] - heap[0][0]).total_seconds() > window:
+            yield heapq.heappop(heap)[2]
+    while len(heap) > 0:
+        yield heapq.heappop(heap)[2]
+
+
+class LogHistogram:
+    """
+    対数間隔のバケットで値を数える．件数によらずメモリは一定で，百分位数の誤差は約2%
+    """
+    RATIO = math.log(1.02)
+
+    def __init__(self):
+        self.buckets: dict[int, int] = {}
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def add(self, value: float):
+        key = int(math.log(max(value, 0.001)) / self.RATIO)
+        self.buckets[key] = self.buckets.get(key, 0) + 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def percentile(self, q: float) -> float:
+        rank = math.ceil(self.count * q)
+        seen = 0
+        for key in sorted(self.buckets):
+            seen += self.buckets[key]
+            if seen >= rank:
+                return min(math.exp((key + 0.5) * self.RATIO), self.max)
+        return self.max
+
+    def summary(self) -> dict:
+        if self.count == 0:
+            return {"count": 0}
+        return {
+            "count": self.count,
+            "mean": self.sum / self.count,
+            "p50": self.percentile(0.5),
+            "p90": self.percentile(0.9),
+            "p99": self.percentile(0.99),
+            "max": self.max,
+        }
+
+
+def summarize(values: list[float]) -> dict:
+    """
+    件数の少ない値(通信断・フェイルオーバー)の正確な統計
+    """
+    if len(values) == 0:
+        return {"count": 0}
+    values = sorted(values)
+
+    def pct(q: float) -> float:
+        return values[max(0, math.ceil(len(values) * q) - 1)]
+
+    return {
+        "count": len(values),
+        "mean": sum(values) / len(values),
+        "p50": pct(0.5),
+        "p90": pct(0.9),
+        "p99": pct(0.99),
+        "max": values[-1],
+    }
+
+
+class Analyzer:
+    def __init__(self):
+        self.down_since: dict[str, datetime] = {}  # プローブ名: 失敗し始めた時刻
+        self.blackouts: list[tuple[str, datetime, datetime]] = []  # (プローブ名, 開始, 終了)
+        self.latency: dict[str, LogHistogram] = {}
+        self.failovers: list[dict] = []
+        self.failover: dict = None  # 復旧待ちのフェイルオーバー
+        self.session: dict = None  # 接続中のセッション
+        self.servers: dict[str, dict] = {}
+        self.wan_ip: str = None  # 直近のipconfigで得たWAN IP
+        self.last: datetime = None
+
+    def feed(self, dt: datetime, kind: str, value):
+        self.last = dt
+        if kind == "probe":
+            self.probe(dt, *value)
+        elif kind == "failover":
+            self.end_session(dt, failed=True)
+            self.failover = {"start": dt, "method": "reconnect"}
+        elif kind == "standby":
+            if self.failover is not None:
+                self.failover["method"] = "standby"
+        elif kind == "wanip":
+            self.wan_ip = value
+        elif kind == "connected":
+            (connect_ms, server) = value
+            self.end_session(dt, failed=False)  # 終了の記録がないまま再起動した場合
+            if self.failover is not None:
+                self.failover.update(end=dt, connect_ms=connect_ms, server=server)
+                self.failovers.append(self.failover)
+                self.failover = None
+            self.session = {"server": server or "unknown", "start": dt, "wan_ip": self.wan_ip}
+            self.server_stats(self.session["server"])["sessions"] += 1
+            self.observe_wan_ip(self.wan_ip)
+            self.wan_ip = None
+        elif kind == "exit":
+            self.end_session(dt, failed=False)
+            self.failover = None
+
+    def probe(self, dt: datetime, name: str, code: int, msg: str):
+        if code == SKIPPED:
+            return
+        if code != OK:
+            self.down_since.setdefault(name, dt)
+            return
+        start = self.down_since.pop(name, None)
+        if start is not None:
+            self.blackouts.append((name, start, dt))
+        fields = msg.split("; ")
+        try:
+            self.latency.setdefault(name, LogHistogram()).add(float(fields[-1]))
+        except ValueError:
+            pass
+        if name.startswith(WAN_PROBE) and self.session is not None:
+            self.observe_wan_ip(fields[0])
+
+    def observe_wan_ip(self, ip: str):
+        if ip is None or self.session is None:
+            return
+        stats = self.server_stats(self.session["server"])
+        stats["wan_ips"].add(ip)
+        stats["observations"] += 1
+        if self.session["wan_ip"] is not None and self.session["wan_ip"] != ip:
+            stats["ip_changes"] += 1
+        self.session["wan_ip"] = ip
+
+    def server_stats(self, server: str) -> dict:
+        if server not in self.servers:
+            self.servers[server] = {
+                "sessions": 0, "failovers": 0, "uptime": 0.0, "wan_ips": set(), "observations": 0, "ip_changes": 0,
+            }
+        return self.servers[server]
+
+    def end_session(self, dt: datetime, failed: bool):
+        if self.session is None:
+            return
+        stats = self.server_stats(self.session["server"])
+        stats["uptime"] += (dt - self.session["start"]).total_seconds()
+        if failed:
+            stats["failovers"] += 1
+        self.session = None
+
+    def correlate(self) -> list[dict]:
+        """
+        各通信断に，その間(前後SLACK秒を含む)に始まったフェイルオーバーを対応付ける
+        """
+        res = []
+        starts = [f["start"] for f in self.failovers]
+        slack = timedelta(seconds=SLACK)
+        for (name, start, end) in self.blackouts:
+            i = bisect.bisect_left(starts, start - slack)
+            if i == len(starts) or starts[i] > end + slack:
+                i = None
+            res.append({
+                "probe": name,
+                "start": start,
+                "end": end,
+                "duration": (end - start).total_seconds(),
+                "failover": self.failovers[i] if i is not None else None,
+            })
+        return res
+
+    def report(self) -> dict:
+        if self.last is not None:
+            # 集計期間の終わりで続いている通信断・セッションも数える
+            for (name, start) in self.down_since.items():
+                self.blackouts.append((name, start, self.last))
+            self.down_since = {}
+            self.end_session(self.last, failed=False)
+        self.blackouts.sort(key=lambda b: b[1])
+        blackouts = self.correlate()
+        by_probe = {}
+        for b in blackouts:
+            by_probe.setdefault(b["probe"], []).append(b)
+        mttr = [(f["end"] - f["start"]).total_seconds() for f in self.failovers]
+        # 検知時間: いずれかのプローブが失敗し始めてからフェイルオーバーを始めるまで
+        first_failure = {}
+        for b in blackouts:
+            if b["failover"] is not None and b["failover"]["start"] >= b["start"]:
+                first_failure.setdefault(id(b["failover"]), (b["failover"], b["start"]))
+        detect = [(f["start"] - start).total_seconds() for (f, start) in first_failure.values()]
+        return {
+            "blackouts": {
+                name: {
+                    "all": summarize([b["duration"] for b in bs]),
+                    "with_failover": summarize([b["duration"] for b in bs if b["failover"] is not None]),
+                    "without_failover": summarize([b["duration"] for b in bs if b["failover"] is None]),
+                    "distribution": distribution([b["duration"] for b in bs]),
+                }
+                for (name, bs) in by_probe.items()
+            },
+            "latency_ms": {name: h.summary() for (name, h) in sorted(self.latency.items())},
+            "failover": {
+                "mttr": summarize(mttr),
+                "by_method": {
+                    method: summarize([(f["end"] - f["start"]).total_seconds()
+                                       for f in self.failovers if f["method"] == method])
+                    for method in sorted({f["method"] for f in self.failovers})
+                },
+                "detect": summarize(detect),
+                "unrecovered": 1 if self.failover is not None else 0,
+            },
+            "servers": {
+                server: {**s, "wan_ips": sorted(s["wan_ips"])}
+                for (server, s) in sorted(self.servers.items(), key=lambda kv: -kv[1]["uptime"])
+            },
+        }
+
+
+def distribution(durations: list[float]) -> dict[str, int]:
+    res = {}
+    lower = 0
+    for upper in BLACKOUT_BUCKETS + [None]:
+        label = f"{lower}-{upper}s" if upper is not None else f">{lower}s"
+        res[label] = sum(1 for d in durations if d >= lower and (upper is None or d < upper))
+        lower = upper
+    return res
+
+
+def format_summary(s: dict, unit: str = "s") -> str:
+    if s["count"] == 0:
+        return "n=0"
+    return (f"n={s['count']}  mean={s['mean']:.2f}{unit}  p50={s['p50']:.2f}{unit}  "
+            f"p90={s['p90']:.2f}{unit}  p99={s['p99']:.2f}{unit}  max={s['max']:.2f}{unit}")
+
+
+def print_report(report: dict):
+    print("== Blackouts ==")
+    if len(report["blackouts"]) == 0:
+        print("  none")
+    for (name, b) in report["blackouts"].items():
+        print(f"[{name}]")
+        print(f"  all               {format_summary(b['all'])}")
+        print(f"  with failover     {format_summary(b['with_failover'])}")
+        print(f"  without failover  {format_summary(b['without_failover'])}")
+        print("  " + "  ".join(f"{k}:{v}" for (k, v) in b["distribution"].items()))
+    print("== Latency ==")
+    for (name, s) in report["latency_ms"].items():
+        print(f"[{name}] {format_summary(s, 'ms')}")
+    f = report["failover"]
+    print("== Failover ==")
+    print(f"  MTTR              {format_summary(f['mttr'])}")
+    for (method, s) in f["by_method"].items():
+        print(f"    {method:15s} {format_summary(s)}")
+    print(f"  detect            {format_summary(f['detect'])}")
+    if f["unrecovered"]:
+        print("  (the last failover had not recovered at the end of the logs)")
+    print("== Servers ==")
+    for (server, s) in report["servers"].items():
+        print(f"{server:15s} sessions={s['sessions']}  failovers={s['failovers']}  uptime={s['uptime'] / 3600:.2f}h  "
+              f"wan_ips={len(s['wan_ips'])}  ip_changes={s['ip_changes']}/{s['observations']}")
+
+
+if __name__ == "__main__":
+    main()
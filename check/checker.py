@@ -1,89 +1,330 @@
 #!/usr/bin/env python3.11
 
 import os
-import requests
+import sys
 import re
+import json
+import time
+import struct
+import socket
+import asyncio
 from zoneinfo import ZoneInfo
-from datetime import datetime, timedelta
+from datetime import datetime
 from pathlib import Path
-import time
-from threading import Thread
-import dns.resolver
+from urllib.parse import urlsplit
+import dns.asyncresolver
 
+CONFIG_PATH = "checker.json"  # 同じディレクトリにあれば読み込む．なければ以下の既定値
 CHECK_URL = "http://104.16.132.229/cdn-cgi/trace"
 DNS_DOMAIN = "www.google.com"
 DNS_NAMESERVERS = ["1.1.1.1"]
-INTERVAL = 5
+INTERVAL = 5.0  # 既定の実行間隔(秒)
+MAX_INFLIGHT = 32  # 同時に実行中にできるプローブ数の上限
+KEEPALIVE_IDLE = 4.0  # これより長く空いていた接続はサーバ側で閉じられているおそれがあるため使い回さない(秒)
+TZ = ZoneInfo("Asia/Tokyo")
+
+# 結果コード
+OK = 0
+ERROR = 1  # 例外，タイムアウト
+PARSE_ERROR = 2
+HTTP_ERROR = 3
+SKIPPED = 4  # 実行中のプローブが多すぎて実行しなかった
 
 
 def main():
-    wc = Thread(target=worker, daemon=True)
-    wc.start()
-    while wc.is_alive():
-        time.sleep(1)
+    probes = load_config()
+    for p in probes:
+        print(f"[{p.name}] {p.describe()} every {p.interval}s (timeout {p.timeout}s)")
+    try:
+        asyncio.run(run(probes))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for f in log_files.values():
+            f.close()
+
 
+def load_config() -> list["Probe"]:
+    """
+    checker.jsonからプローブの一覧を作る
+    {"interval": 0.5, "max_inflight": 32,
+     "probes": [{"type": "web", "url": "..."}, {"type": "dns", "fqdn": "...", "nameservers": ["..."]},
+                {"type": "icmp", "host": "..."}]}
+    各プローブには"name"(ログファイル名，既定値はtype)，"interval"，"timeout"(既定値はinterval)を指定できる
+    """
+    global INTERVAL
+    global MAX_INFLIGHT
+    path = Path(__file__).resolve().parent.joinpath(CONFIG_PATH)
+    try:
+        with open(path, "r") as f:
+            j: dict = json.load(f)
+    except FileNotFoundError:
+        j = {}
+    INTERVAL = float(j.get("interval", INTERVAL))
+    MAX_INFLIGHT = int(j.get("max_inflight", MAX_INFLIGHT))
+    specs = j.get("probes", [
+        {"type": "web", "url": CHECK_URL},
+        {"type": "dns", "fqdn": DNS_DOMAIN, "nameservers": DNS_NAMESERVERS},
+    ])
+    res = []
+    for (i, spec) in enumerate(specs):
+        kind = spec.get("type")
+        if kind not in PROBE_TYPES:
+            print(f"Unknown probe type \"{kind}\"")
+            sys.exit(1)
+        res.append(PROBE_TYPES[kind](i, spec))
+    return res
 
-def worker():
+
+async def run(probes: list["Probe"]):
+    inflight = asyncio.Semaphore(MAX_INFLIGHT)
+    await asyncio.gather(*(schedule(p, inflight) for p in probes))
+
+
+async def schedule(probe: "Probe", inflight: asyncio.Semaphore):
+    """
+    プローブを一定間隔で起動する．前回の実行を待たないため，応答が遅くても間隔はずれない
+    上限まで実行中の場合は待たずにその回を飛ばし，実行中のプローブが際限なく増えないようにする
+    """
+    tasks = set()
+    start = time.monotonic()
+    n = 0
     while True:
-        t = Thread(target=web_con, args=(CHECK_URL,), daemon=True)
-        t.start()
-        t2 = Thread(target=dns_check, args=(DNS_DOMAIN, DNS_NAMESERVERS), daemon=True)
-        t2.start()
-        time.sleep(INTERVAL)
+        dt = datetime.now(TZ)
+        if inflight.locked():
+            log_write(dt, probe.name, SKIPPED, "Too many probes in flight")
+        else:
+            task = asyncio.create_task(execute(probe, inflight, dt))
+            tasks.add(task)  # 実行中のタスクが回収されないよう参照を持つ
+            task.add_done_callback(tasks.discard)
+        n += 1
+        await asyncio.sleep(max(0.0, start + n * probe.interval - time.monotonic()))
+
 
+async def execute(probe: "Probe", inflight: asyncio.Semaphore, dt: datetime):
+    async with inflight:
+        try:
+            (code, msg) = await asyncio.wait_for(probe.check(), timeout=probe.timeout)
+        except (asyncio.TimeoutError, TimeoutError):
+            (code, msg) = (ERROR, "Timeout")
+        except Exception as ex:
+            (code, msg) = (ERROR, ex)
+    log_write(dt, probe.name, code, msg)
 
-def web_con(url: str):
-    dt = datetime.now(ZoneInfo("Asia/Tokyo"))
+
+class Probe:
+    type: str = None
+
+    def __init__(self, index: int, spec: dict):
+        self.index = index
+        self.name = spec.get("name", self.type)
+        self.interval = float(spec.get("interval", INTERVAL))
+        self.timeout = float(spec.get("timeout", self.interval))
+
+    def describe(self) -> str:
+        raise NotImplementedError
+
+    async def check(self) -> (int, str):
+        """
+        1回分の確認を行い，(結果コード, メッセージ)を返す
+        応答が遅いと同じプローブの前回分と並行して呼ばれることがある
+        """
+        raise NotImplementedError
+
+
+class WebProbe(Probe):
+    """
+    HTTP/1.1のkeep-aliveで接続を使い回し，接続確立を毎回行わない
+    正常に応答を読み切った接続だけを戻し，失敗・タイムアウトした接続は捨てる
+    失敗した場合はフェイルオーバーなどで経路が変わった可能性があるため，空いている接続もすべて捨てる
+    """
     type = "web"
-    try:
+
+    def __init__(self, index: int, spec: dict):
+        super().__init__(index, spec)
+        self.url = spec.get("url", CHECK_URL)
+        u = urlsplit(self.url)
+        if u.scheme != "http":
+            print(f"Only http is supported: {self.url}")
+            sys.exit(1)
+        self.host = u.hostname
+        self.port = u.port or 80
+        self.path = (u.path or "/") + (f"?{u.query}" if u.query else "")
+        self.request = f"GET {self.path} HTTP/1.1\r\nHost: {self.host}\r\nConnection: keep-alive\r\n\r\n".encode()
+        self.idle: list[tuple[asyncio.StreamReader, asyncio.StreamWriter, float]] = []  # 空いている接続と空いた時刻
+
+    def describe(self) -> str:
+        return self.url
+
+    async def check(self) -> (int, str):
         start = time.perf_counter()
-        res = requests.get(url, timeout=INTERVAL)
+        (reader, writer) = await self.acquire()
+        try:
+            writer.write(self.request)
+            await writer.drain()
+            (status, headers, body) = await read_response(reader)
+        except BaseException:  # タイムアウト時のキャンセルを含む
+            writer.close()
+            self.reset()
+            raise
         end = time.perf_counter()
-    except Exception as ex:
-        # エラー
-        log_write(dt, type, 1, ex)
-    else:
-        if res.status_code == 200:
-            match = re.search(r"^ip=([^\s]+)", res.text, re.MULTILINE)
-            if match:
-                ms = (end - start) * 1000
-                ip = match.group(1)
-                log_write(dt, type, 0, f"{ip}; {ms:.3f}")
-            else:
-                # データのパースに失敗．ほぼ起こり得ないはず．
-                log_write(dt, type, 2, "Parse error")
+        if headers.get("connection", "").lower() == "close":
+            writer.close()
         else:
+            self.idle.append((reader, writer, time.monotonic()))
+        if status != 200:
             # ステータスコードが200でない．サーバサイドの問題で起こり得る
-            log_write(dt, type, 3, res.status_code)
+            return (HTTP_ERROR, status)
+        match = re.search(r"^ip=([^\s]+)", body, re.MULTILINE)
+        if not match:
+            # データのパースに失敗．ほぼ起こり得ないはず．
+            return (PARSE_ERROR, "Parse error")
+        return (OK, f"{match.group(1)}; {(end - start) * 1000:.3f}")
 
+    async def acquire(self) -> (asyncio.StreamReader, asyncio.StreamWriter):
+        """
+        空いている接続のうち，空いてからKEEPALIVE_IDLE秒以内のものを返す．なければ新しく接続する
+        """
+        now = time.monotonic()
+        while len(self.idle) > 0:
+            (reader, writer, released) = self.idle.pop()
+            if now - released <= KEEPALIVE_IDLE and not reader.at_eof():
+                return (reader, writer)
+            writer.close()
+        return await asyncio.open_connection(self.host, self.port)
 
-def dns_check(fqdn: str, ns: list[str]):
-    dt = datetime.now(ZoneInfo("Asia/Tokyo"))
+    def reset(self):
+        for (_, writer, _) in self.idle:
+            writer.close()
+        self.idle = []
+
+
+async def read_response(reader: asyncio.StreamReader) -> (int, dict, str):
+    line = await reader.readline()
+    if not line:
+        raise ConnectionError("Connection closed by server")
+    status = int(line.split()[1])
+    headers = {}
+    while True:
+        line = (await reader.readline()).decode("latin-1").strip()
+        if not line:
+            break
+        (k, _, v) = line.partition(":")
+        headers[k.strip().lower()] = v.strip()
+    if headers.get("transfer-encoding", "").lower() == "chunked":
+        body = b""
+        while True:
+            size = int((await reader.readline()).split(b";")[0], 16)
+            chunk = await reader.readexactly(size + 2)  # 末尾のCRLFを含む
+            if size == 0:
+                break
+            body += chunk[:-2]
+    else:
+        body = await reader.readexactly(int(headers.get("content-length", 0)))
+    return (status, headers, body.decode(errors="replace"))
+
+
+class DnsProbe(Probe):
     type = "dns"
-    try:
-        resolver = dns.resolver.Resolver()
-        resolver.nameservers = ns
-        resolver.timeout = 5
+
+    def __init__(self, index: int, spec: dict):
+        super().__init__(index, spec)
+        self.fqdn = spec.get("fqdn", DNS_DOMAIN)
+        self.resolver = dns.asyncresolver.Resolver(configure=False)
+        self.resolver.nameservers = spec.get("nameservers", DNS_NAMESERVERS)
+        self.resolver.port = int(spec.get("port", 53))
+        self.resolver.lifetime = self.timeout
+        self.resolver.cache = None  # 毎回問い合わせる
+
+    def describe(self) -> str:
+        return f"{self.fqdn} @{','.join(self.resolver.nameservers)}"
+
+    async def check(self) -> (int, str):
         start = time.perf_counter()
-        answers = resolver.resolve(fqdn, 'a')
+        answers = await self.resolver.resolve(self.fqdn, "a")
         end = time.perf_counter()
-    except Exception as ex:
-        # エラー
-        log_write(dt, type, 1, ex)
-    else:
-        ms = (end - start) * 1000
         a = ", ".join([rdata.address for rdata in answers])
-        log_write(dt, type, 0, f"{a}; {ms:.3f}")
+        return (OK, f"{a}; {(end - start) * 1000:.3f}")
+
+
+class IcmpProbe(Probe):
+    """
+    ICMP echo(要root)．応答は1つの受信処理で受け取り，順序番号で待っている回に渡す
+    """
+    type = "icmp"
+
+    def __init__(self, index: int, spec: dict):
+        super().__init__(index, spec)
+        self.host = spec["host"]
+        self.ident = (os.getpid() + index) & 0xFFFF
+        self.seq = 0
+        self.waiting: dict[int, asyncio.Future] = {}  # 順序番号: 応答を待っているFuture
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_RAW, socket.IPPROTO_ICMP)
+        self.sock.setblocking(False)
+        self.reading = False
+
+    def describe(self) -> str:
+        return self.host
+
+    async def check(self) -> (int, str):
+        loop = asyncio.get_running_loop()
+        if not self.reading:
+            loop.add_reader(self.sock, self.receive)
+            self.reading = True
+        self.seq = (self.seq + 1) & 0xFFFF
+        seq = self.seq
+        header = struct.pack("!BBHHH", 8, 0, 0, self.ident, seq)
+        packet = struct.pack("!BBHHH", 8, 0, icmp_checksum(header), self.ident, seq)
+        reply = self.waiting[seq] = loop.create_future()
+        try:
+            start = time.perf_counter()
+            await loop.sock_sendto(self.sock, packet, (self.host, 0))
+            await reply
+            return (OK, f"{self.host}; {(time.perf_counter() - start) * 1000:.3f}")
+        finally:
+            self.waiting.pop(seq, None)
+
+    def receive(self):
+        while True:
+            try:
+                (data, addr) = self.sock.recvfrom(1024)
+            except BlockingIOError:
+                return
+            ihl = (data[0] & 0x0F) * 4  # IPヘッダ長
+            if len(data) < ihl + 8 or addr[0] != self.host:
+                continue
+            (kind, _, _, r_ident, r_seq) = struct.unpack("!BBHHH", data[ihl:ihl + 8])
+            reply = self.waiting.get(r_seq)
+            if kind == 0 and r_ident == self.ident and reply is not None and not reply.done():
+                reply.set_result(None)
+
+
+def icmp_checksum(data: bytes) -> int:
+    if len(data) % 2:
+        data += b"\0"
+    total = sum(struct.unpack(f"!{len(data) // 2}H", data))
+    total = (total >> 16) + (total & 0xFFFF)
+    total += total >> 16
+    return ~total & 0xFFFF
+
+
+PROBE_TYPES = {p.type: p for p in (WebProbe, DnsProbe, IcmpProbe)}
+log_files = {}  # ログファイル名: 開いたままのファイル
 
 
 def log_write(dt, type: str, code: int, msg: str):
     path = Path(__file__).resolve().parent.joinpath(f"check_log/{type}-{dt.date()}.txt")
-    os.makedirs(os.path.dirname(path), exist_ok=True)
-    with open(path, mode="a", encoding="utf-8", newline='\n') as f:
-        f.write(f"{dt}; {code}; {msg}\n")
+    f = log_files.get(type)
+    if f is None or f.name != str(path):
+        # 初回と日付が変わった時だけ開き直す
+        if f is not None:
+            f.close()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        f = log_files[type] = open(path, mode="a", encoding="utf-8", newline='\n', buffering=1)
+    f.write(f"{dt}; {code}; {msg}\n")
     print(f"[{type}] {dt}; {code}; {msg}")
 
 
 if __name__ == "__main__":
     os.system("")  # Windowsにて、色付き文字を出力するためのおまじない
-    main()
\ No newline at end of file
+    main()
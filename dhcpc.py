@@ -0,0 +1,282 @@
+"""
+仮想NIC用の最小限のDHCPクライアント
+dhclientを起動せず，AF_PACKETソケットでDISCOVER/REQUESTを送り，リースをLeaseとして返す
+アドレス未設定のNICでも送受信できるよう，IP/UDPヘッダは自前で組み立てる
+"""
+
+import time
+import random
+import select
+import socket
+import struct
+
+ETH_P_IP = 0x0800
+BROADCAST_MAC = b"\xff" * 6
+CLIENT_PORT = 68
+SERVER_PORT = 67
+MAGIC_COOKIE = 0x63825363
+
+DHCPDISCOVER = 1
+DHCPOFFER = 2
+DHCPREQUEST = 3
+DHCPDECLINE = 4
+DHCPACK = 5
+DHCPNAK = 6
+DHCPRELEASE = 7
+
+OPT_SUBNET_MASK = 1
+OPT_ROUTER = 3
+OPT_DNS = 6
+OPT_REQUESTED_IP = 50
+OPT_LEASE_TIME = 51
+OPT_MESSAGE_TYPE = 53
+OPT_SERVER_ID = 54
+OPT_PARAMS = 55
+OPT_RENEWAL_TIME = 58
+OPT_REBINDING_TIME = 59
+OPT_CLIENT_ID = 61
+OPT_END = 255
+
+IPHDR = struct.Struct("!BBHHHBBH4s4s")  # ver_ihl, tos, len, id, frag, ttl, proto, checksum, src, dst
+UDPHDR = struct.Struct("!HHHH")  # sport, dport, len, checksum
+BOOTP = struct.Struct("!BBBBIHH4s4s4s4s16s64s128sI")  # op, htype, hlen, hops, xid, secs, flags, ciaddr, yiaddr, siaddr, giaddr, chaddr, sname, file, cookie
+
+
+class Lease:
+    """
+    DHCPサーバから得たリース
+    """
+    __slots__ = ("address", "prefixlen", "router", "server", "lease_time", "t1", "t2", "obtained_at", "server_mac")
+
+    def __init__(self, address: str, prefixlen: int, router: str, server: str,
+                 lease_time: int, t1: int, t2: int, obtained_at: float, server_mac: str = None):
+        self.address = address
+        self.prefixlen = prefixlen
+        self.router = router
+        self.server = server  # DHCPサーバ(Server Identifier)
+        self.lease_time = lease_time  # 秒
+        self.t1 = t1  # 更新を始めるまでの時間(秒)
+        self.t2 = t2  # 任意のサーバに再要求を始めるまでの時間(秒)
+        self.obtained_at = obtained_at  # time.monotonic()
+        self.server_mac = server_mac  # ACKの送信元MACアドレス(aa:bb:cc:dd:ee:ff)．更新をユニキャストで送る
+
+    @property
+    def renew_at(self) -> float:
+        return self.obtained_at + self.t1
+
+    @property
+    def rebind_at(self) -> float:
+        return self.obtained_at + self.t2
+
+    @property
+    def expire_at(self) -> float:
+        return self.obtained_at + self.lease_time
+
+    def dump(self) -> dict:
+        """
+        保存用の辞書．obtained_atはプロセスをまたいで使えるよう時刻(time.time())に直す
+        """
+        res = {k: getattr(self, k) for k in self.__slots__}
+        res["obtained_at"] = time.time() - (time.monotonic() - self.obtained_at)
+        return res
+
+    @classmethod
+    def load(cls, d: dict) -> "Lease":
+        """
+        dumpで保存したリースを戻す．以前の版で保存した項目は無視する
+        """
+        d = {k: v for (k, v) in d.items() if k in cls.__slots__}
+        return cls(**{**d, "obtained_at": time.monotonic() - (time.time() - d["obtained_at"])})
+
+    def __repr__(self):
+        return (f"{self.address}/{self.prefixlen} GW:{self.router} Server:{self.server} "
+                f"Lease:{self.lease_time}s T1:{self.t1}s T2:{self.t2}s")
+
+
+def checksum(data: bytes) -> int:
+    if len(data) % 2:
+        data += b"\0"
+    total = sum(struct.unpack(f"!{len(data) // 2}H", data))
+    total = (total >> 16) + (total & 0xFFFF)
+    total += total >> 16
+    return ~total & 0xFFFF
+
+
+def pack_options(options: list[tuple[int, bytes]]) -> bytes:
+    return b"".join(struct.pack("!BB", code, len(value)) + value for (code, value) in options) + bytes([OPT_END])
+
+
+def parse_options(data: bytes) -> dict[int, bytes]:
+    """
+    オプションを{コード: 値}に分解する．同じコードが複数ある場合は連結する(RFC 3396)
+    """
+    opts = {}
+    i = 0
+    while i < len(data):
+        code = data[i]
+        if code == OPT_END:
+            break
+        if code == 0:  # Pad
+            i += 1
+            continue
+        if i + 1 >= len(data):
+            break
+        length = data[i + 1]
+        opts[code] = opts.get(code, b"") + data[i + 2:i + 2 + length]
+        i += 2 + length
+    return opts
+
+
+def get_mac(nic: str) -> bytes:
+    with open(f"/sys/class/net/{nic}/address", "r") as f:
+        return bytes.fromhex(f.read().strip().replace(":", ""))
+
+
+def server_hwaddr(lease: Lease) -> bytes:
+    """
+    リースを得たサーバのMACアドレス．不明な場合(以前の版で保存したリース)はブロードキャスト
+    """
+    return bytes.fromhex(lease.server_mac.replace(":", "")) if lease.server_mac else BROADCAST_MAC
+
+
+class Client:
+    """
+    1つのNICでDHCPのやり取りを行う
+    失敗した場合(応答なし，NAK)はNoneを返す
+    sockには，AF_PACKETソケットの代わりに同じsendto/recvfrom/filenoを持つものを渡せる(動作確認用)
+    """
+
+    def __init__(self, nic: str, timeout: float = 10.0, sock: socket.socket = None):
+        self.nic = nic
+        self.timeout = timeout  # 1回の取得・更新で応答を待つ合計時間(秒)
+        self.mac = get_mac(nic)
+        if sock is None:
+            sock = socket.socket(socket.AF_PACKET, socket.SOCK_DGRAM, socket.htons(ETH_P_IP))
+            sock.bind((nic, ETH_P_IP))
+        self.sock = sock
+
+    def discover(self) -> Lease:
+        """
+        DISCOVER→OFFER→REQUEST→ACKで新たにリースを得る
+        """
+        xid = random.getrandbits(32)
+        offer = self.exchange(xid, self.build(xid, DHCPDISCOVER), (DHCPOFFER,))
+        if offer is None:
+            return None
+        (yiaddr, opts, _) = offer
+        server = socket.inet_ntoa(opts[OPT_SERVER_ID]) if OPT_SERVER_ID in opts else None
+        extra = [(OPT_REQUESTED_IP, socket.inet_aton(yiaddr))]
+        if server is not None:
+            extra.append((OPT_SERVER_ID, socket.inet_aton(server)))
+        return self.request(xid, self.build(xid, DHCPREQUEST, extra=extra))
+
+    def renew(self, lease: Lease) -> Lease:
+        """
+        リースを更新する．T2を過ぎていれば送信先を限定せずに再要求(REBINDING)する
+        更新(RENEWING)はサーバへのユニキャストで，宛先MACにはACKの送信元を使う(不明な場合はブロードキャスト)
+        """
+        xid = random.getrandbits(32)
+        ciaddr = lease.address
+        if time.monotonic() < lease.rebind_at and lease.server:
+            (dst, mac) = (lease.server, server_hwaddr(lease))
+        else:
+            (dst, mac) = ("255.255.255.255", BROADCAST_MAC)
+        return self.request(xid, self.build(xid, DHCPREQUEST, ciaddr=ciaddr), src=ciaddr, dst=dst, mac=mac)
+
+    def release(self, lease: Lease):
+        """
+        リースを返す．応答はない
+        """
+        if lease.server is None:
+            return
+        xid = random.getrandbits(32)
+        packet = self.build(xid, DHCPRELEASE, ciaddr=lease.address, extra=[(OPT_SERVER_ID, socket.inet_aton(lease.server))])
+        self.send(packet, src=lease.address, dst=lease.server, mac=server_hwaddr(lease))
+
+    def request(self, xid: int, packet: bytes, src: str = "0.0.0.0", dst: str = "255.255.255.255",
+                mac: bytes = BROADCAST_MAC) -> Lease:
+        res = self.exchange(xid, packet, (DHCPACK, DHCPNAK), src=src, dst=dst, mac=mac)
+        if res is None:
+            return None
+        (yiaddr, opts, server_mac) = res
+        if opts[OPT_MESSAGE_TYPE][0] == DHCPNAK:
+            return None
+        mask = opts.get(OPT_SUBNET_MASK)
+        prefixlen = bin(struct.unpack("!I", mask)[0]).count("1") if mask and len(mask) == 4 else 16
+        router = socket.inet_ntoa(opts[OPT_ROUTER][:4]) if len(opts.get(OPT_ROUTER, b"")) >= 4 else None
+        server = socket.inet_ntoa(opts[OPT_SERVER_ID]) if len(opts.get(OPT_SERVER_ID, b"")) == 4 else None
+        lease_time = struct.unpack("!I", opts[OPT_LEASE_TIME])[0] if len(opts.get(OPT_LEASE_TIME, b"")) == 4 else 3600
+        t1 = struct.unpack("!I", opts[OPT_RENEWAL_TIME])[0] if len(opts.get(OPT_RENEWAL_TIME, b"")) == 4 else lease_time // 2
+        t2 = struct.unpack("!I", opts[OPT_REBINDING_TIME])[0] if len(opts.get(OPT_REBINDING_TIME, b"")) == 4 else lease_time * 7 // 8
+        return Lease(yiaddr, prefixlen, router, server, lease_time, t1, t2, time.monotonic(), server_mac.hex(":"))
+
+    def build(self, xid: int, kind: int, ciaddr: str = "0.0.0.0", extra: list[tuple[int, bytes]] = ()) -> bytes:
+        """
+        BOOTPメッセージを組み立てる．アドレスがない間は応答をブロードキャストで要求する
+        """
+        flags = 0x8000 if ciaddr == "0.0.0.0" else 0
+        bootp = BOOTP.pack(
+            1, 1, 6, 0, xid, 0, flags, socket.inet_aton(ciaddr), bytes(4), bytes(4), bytes(4),
+            self.mac, b"", b"", MAGIC_COOKIE,
+        )
+        options = [
+            (OPT_MESSAGE_TYPE, bytes([kind])),
+            (OPT_CLIENT_ID, b"\x01" + self.mac),
+            *extra,
+            (OPT_PARAMS, bytes([OPT_SUBNET_MASK, OPT_ROUTER, OPT_LEASE_TIME, OPT_RENEWAL_TIME, OPT_REBINDING_TIME])),
+        ]
+        return bootp + pack_options(options)
+
+    def send(self, payload: bytes, src: str = "0.0.0.0", dst: str = "255.255.255.255", mac: bytes = BROADCAST_MAC):
+        udp = UDPHDR.pack(CLIENT_PORT, SERVER_PORT, UDPHDR.size + len(payload), 0) + payload  # IPv4ではUDPチェックサムは省略可
+        length = IPHDR.size + len(udp)
+        header = IPHDR.pack(0x45, 0, length, 0, 0, 64, socket.IPPROTO_UDP, 0, socket.inet_aton(src), socket.inet_aton(dst))
+        header = header[:10] + struct.pack("!H", checksum(header)) + header[12:]
+        self.sock.sendto(header + udp, (self.nic, ETH_P_IP, 0, 0, mac))
+
+    def exchange(self, xid: int, packet: bytes, kinds: tuple[int], src: str = "0.0.0.0",
+                 dst: str = "255.255.255.255", mac: bytes = BROADCAST_MAC) -> (str, dict[int, bytes], bytes):
+        """
+        応答が来るまで間隔を倍々に伸ばしながら再送する
+
+        Returns:
+            str: 割り当てられたアドレス(yiaddr)
+            dict[int, bytes]: オプション
+            bytes: 応答の送信元MACアドレス
+        """
+        deadline = time.monotonic() + self.timeout
+        interval = 1.0
+        while time.monotonic() < deadline:
+            self.send(packet, src=src, dst=dst, mac=mac)
+            res = self.receive(xid, kinds, min(time.monotonic() + interval, deadline))
+            if res is not None:
+                return res
+            interval = min(interval * 2, 8.0)
+        return None
+
+    def receive(self, xid: int, kinds: tuple[int], deadline: float) -> (str, dict[int, bytes], bytes):
+        while True:
+            remain = deadline - time.monotonic()
+            if remain <= 0:
+                return None
+            (r, _, _) = select.select([self.sock], [], [], remain)
+            if not r:
+                return None
+            (data, addr) = self.sock.recvfrom(4096)
+            ihl = (data[0] & 0x0F) * 4
+            if len(data) < ihl + UDPHDR.size + BOOTP.size or data[9] != socket.IPPROTO_UDP:
+                continue
+            (_, dport, _, _) = UDPHDR.unpack_from(data, ihl)
+            if dport != CLIENT_PORT:
+                continue
+            offset = ihl + UDPHDR.size
+            (op, _, _, _, r_xid, _, _, _, yiaddr, _, _, chaddr, _, _, cookie) = BOOTP.unpack_from(data, offset)
+            if op != 2 or r_xid != xid or chaddr[:6] != self.mac or cookie != MAGIC_COOKIE:
+                continue
+            opts = parse_options(data[offset + BOOTP.size:])
+            if OPT_MESSAGE_TYPE not in opts or opts[OPT_MESSAGE_TYPE][0] not in kinds:
+                continue
+            return (socket.inet_ntoa(yiaddr), opts, addr[4])
+
+    def close(self):
+        self.sock.close()
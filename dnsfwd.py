@@ -0,0 +1,446 @@
+"""
+LANのクライアント向けのキャッシュ付きDNSフォワーダ
+asyncioでUDP/TCPの問い合わせを受け，上流のDNSサーバに転送する．上流への通信はVPNの仮想NICに結び付け，
+切替中や接続前に上流NICから平文で漏れないようにする
+応答はTTLに従ってLRUでキャッシュし，よく引かれる名前は期限切れの前に取得し直す(プリフェッチ)
+上流に届かない場合(フェイルオーバー中など)は，期限切れのキャッシュを短いTTLで返す(serve-stale，RFC 8767)
+"""
+
+import time
+import random
+import socket
+import struct
+import asyncio
+from collections import OrderedDict
+from threading import Thread
+
+HEADER = struct.Struct("!HHHHHH")  # id, flags, qdcount, ancount, nscount, arcount
+RR = struct.Struct("!HHIH")  # type, class, ttl, rdlength
+LENGTH = struct.Struct("!H")  # TCPのメッセージ長
+
+FLAG_QR = 0x8000
+FLAG_TC = 0x0200
+FLAG_RD = 0x0100
+FLAG_RA = 0x0080
+FLAG_CD = 0x0010
+OPCODE_MASK = 0x7800
+RCODE_MASK = 0x000F
+RCODE_NOERROR = 0
+RCODE_SERVFAIL = 2
+RCODE_NXDOMAIN = 3
+TYPE_SOA = 6
+TYPE_OPT = 41
+EDNS_DO = 0x8000  # OPTのTTL欄のDOビット
+
+UDP_MIN = 512  # EDNSがない場合のUDPの最大長
+MAX_TTL = 86400  # キャッシュする最大時間(秒)
+NEG_TTL = 300  # 否定応答(NXDOMAIN，NODATA)をキャッシュする最大時間(秒)
+STALE_TTL = 30  # 期限切れの応答を返す時のTTL(RFC 8767の推奨値)
+STALE_WAIT = 1.8  # 期限切れの応答がある場合に，上流の応答を待つ時間(RFC 8767の推奨値)
+PREFETCH_RATIO = 0.1  # 残りのTTLが元のTTLのこの割合を切ったらプリフェッチする
+PREFETCH_HITS = 3  # 取得してからこの回数以上引かれた名前だけプリフェッチする
+
+
+def skip_name(data: bytes, offset: int) -> int:
+    """
+    名前(圧縮を含む)の次の位置を返す
+    """
+    while True:
+        length = data[offset]
+        if length & 0xC0 == 0xC0:
+            return offset + 2
+        if length == 0:
+            return offset + 1
+        offset += 1 + length
+
+
+def parse_rrs(data: bytes, offset: int, count: int) -> (list[tuple[int, int, int, int]], int):
+    """
+    リソースレコードをcount個読み，[(種類, クラス, TTLの位置, TTL)]と次の位置を返す
+    """
+    res = []
+    for _ in range(count):
+        offset = skip_name(data, offset)
+        (kind, klass, ttl, rdlength) = RR.unpack_from(data, offset)
+        res.append((kind, klass, offset + 4, ttl))
+        offset += RR.size + rdlength
+    if offset > len(data):
+        raise ValueError("truncated message")
+    return (res, offset)
+
+
+class Query:
+    """
+    クライアントからの問い合わせ
+    """
+    __slots__ = ("data", "id", "question", "key", "limit")
+
+    def __init__(self, data: bytes):
+        (self.id, flags, qdcount, ancount, nscount, arcount) = HEADER.unpack_from(data)
+        if flags & (FLAG_QR | OPCODE_MASK) or qdcount != 1:
+            raise ValueError("not a standard query")
+        end = skip_name(data, HEADER.size) + 4
+        (rrs, _) = parse_rrs(data, end, ancount + nscount + arcount)
+        self.data = data
+        self.question = data[HEADER.size:end]
+        self.limit = UDP_MIN
+        do = 0
+        for (kind, klass, _, ttl) in rrs:
+            if kind == TYPE_OPT:
+                self.limit = max(UDP_MIN, klass)  # OPTのクラス欄はクライアントが受け取れるUDPの長さ
+                do = 1 if ttl & EDNS_DO else 0
+        # DNSSECの署名の有無で応答が変わるため，DO・CDビットもキーに含める
+        self.key = self.question.lower() + bytes([do, 1 if flags & FLAG_CD else 0])
+
+
+class Entry:
+    """
+    キャッシュした応答
+    """
+    __slots__ = ("response", "ttls", "stored", "ttl", "hits", "refreshing")
+
+    def __init__(self, response: bytes, ttls: list[tuple[int, int]], ttl: int):
+        self.response = response
+        self.ttls = ttls  # [(TTLの位置, 元のTTL)]
+        self.stored = time.monotonic()
+        self.ttl = ttl  # 応答全体の有効期間(秒)．レコードの最小のTTL
+        self.hits = 0
+        self.refreshing = False  # プリフェッチ・再取得中か
+
+    def remaining(self, now: float) -> float:
+        return self.stored + self.ttl - now
+
+    def render(self, query: Query, now: float, stale: bool = False) -> bytes:
+        """
+        クライアントのIDと問い合わせ(名前の大文字小文字を含む)に合わせ，TTLを経過時間だけ減らした応答を返す
+        """
+        res = bytearray(self.response)
+        res[0:2] = struct.pack("!H", query.id)
+        res[HEADER.size:HEADER.size + len(query.question)] = query.question
+        elapsed = int(now - self.stored)
+        for (offset, ttl) in self.ttls:
+            struct.pack_into("!I", res, offset, STALE_TTL if stale else max(0, min(ttl, self.ttl) - elapsed))
+        return bytes(res)
+
+
+def make_entry(response: bytes) -> Entry:
+    """
+    上流の応答をキャッシュ用に解析する．キャッシュできない応答(SERVFAIL，切り詰め，TTLなし)はNone
+    """
+    (_, flags, qdcount, ancount, nscount, arcount) = HEADER.unpack_from(response)
+    rcode = flags & RCODE_MASK
+    if flags & FLAG_TC or rcode not in (RCODE_NOERROR, RCODE_NXDOMAIN):
+        return None
+    offset = HEADER.size
+    for _ in range(qdcount):
+        offset = skip_name(response, offset) + 4
+    (rrs, _) = parse_rrs(response, offset, ancount + nscount + arcount)
+    ttls = [(pos, ttl) for (kind, _, pos, ttl) in rrs if kind != TYPE_OPT]
+    if rcode == RCODE_NXDOMAIN or ancount == 0:
+        # 否定応答はSOAのTTLに従う(RFC 2308)．SOAがなければキャッシュしない
+        soas = [ttl for (kind, _, _, ttl) in rrs[ancount:ancount + nscount] if kind == TYPE_SOA]
+        ttl = min(min(soas), NEG_TTL) if len(soas) > 0 else 0
+    else:
+        ttl = min(min(t for (_, t) in ttls), MAX_TTL)
+    if ttl <= 0:
+        return None
+    return Entry(response, ttls, ttl)
+
+
+def parse_server(server: str) -> (str, int):
+    """
+    上流の"アドレス"または"アドレス:ポート"を分ける
+    """
+    (host, _, port) = server.partition(":")
+    return (host, int(port) if port else 53)
+
+
+def truncate(response: bytes, query: Query) -> bytes:
+    """
+    UDPで返せない長さの応答の代わりに，TCPでの再問い合わせを促す応答を返す
+    """
+    flags = HEADER.unpack_from(response)[1]
+    return HEADER.pack(query.id, flags | FLAG_TC, 1, 0, 0, 0) + query.question
+
+
+def servfail(query: Query) -> bytes:
+    """
+    上流に問い合わせられない場合の応答．クライアントはすぐに別のDNSサーバを試せる
+    """
+    rd = HEADER.unpack_from(query.data)[1] & FLAG_RD
+    return HEADER.pack(query.id, FLAG_QR | rd | FLAG_RA | RCODE_SERVFAIL, 1, 0, 0, 0) + query.question
+
+
+class UpstreamProtocol(asyncio.DatagramProtocol):
+    """
+    上流への1回の問い合わせ．IDと問い合わせが一致する応答だけを受け取る
+    """
+
+    def __init__(self, id: int, question: bytes):
+        self.id = id
+        self.question = question.lower()
+        self.answer = asyncio.get_running_loop().create_future()
+
+    def datagram_received(self, data: bytes, addr):
+        if self.answer.done() or len(data) < HEADER.size:
+            return
+        end = HEADER.size + len(self.question)
+        if HEADER.unpack_from(data)[0] == self.id and data[HEADER.size:end].lower() == self.question:
+            self.answer.set_result(data)
+
+    def error_received(self, exc: Exception):
+        if not self.answer.done():
+            self.answer.set_exception(exc)
+
+
+class Forwarder:
+    """
+    キャッシュ付きDNSフォワーダ．イベントループは専用のスレッドで動かす
+    onlineとdeviceは呼び出し元(main.py)が設定する．onlineがFalseの間は上流に一切問い合わせず，
+    キャッシュ(期限切れを含む)から返し，なければSERVFAILを返す
+    上流へのソケットはdeviceのNICに結び付ける(SO_BINDTODEVICE)．Noneの場合は経路表に従う
+    """
+
+    def __init__(
+        self,
+        upstreams: list[str],
+        size: int = 10000,
+        timeout: float = 2.0,
+        max_stale: float = 86400.0,
+        on_query=None,
+    ):
+        self.upstreams = upstreams
+        self.size = size
+        self.timeout = timeout  # 上流1つあたりの応答待ち時間(秒)
+        self.max_stale = max_stale  # 期限切れの応答を返す最大時間(秒)
+        self.on_query = on_query  # on_query(結果, 所要時間(秒))．結果はhit, miss, stale, prefetch, error
+        self.online = True
+        self.device: str = None  # 上流への問い合わせに使うNIC
+        self.cache: OrderedDict[bytes, Entry] = OrderedDict()
+        self.inflight: dict[bytes, asyncio.Task] = {}  # 同じ問い合わせを上流へ同時に送らないため
+        self.tasks: set[asyncio.Task] = set()  # 実行中のタスク(ガベージコレクションされないよう保持する)
+        self.loop: asyncio.AbstractEventLoop = None
+
+    def start(self, host: str, port: int):
+        """
+        デーモンスレッドでイベントループを動かし，待受を始める．待ち受けられない場合はOSErrorを送出する
+        """
+        self.loop = asyncio.new_event_loop()
+        Thread(target=self.loop.run_forever, daemon=True).start()
+        asyncio.run_coroutine_threadsafe(self.listen(host, port), self.loop).result()
+
+    async def listen(self, host: str, port: int):
+        loop = asyncio.get_running_loop()
+        await loop.create_datagram_endpoint(lambda: ServerProtocol(self), local_addr=(host, port))
+        await asyncio.start_server(self.serve_tcp, host, port)
+
+    def spawn(self, coro) -> asyncio.Task:
+        task = asyncio.ensure_future(coro)
+        self.tasks.add(task)
+        task.add_done_callback(self.done)
+        return task
+
+    def done(self, task: asyncio.Task):
+        # 応答を待たずに続けた上流への問い合わせが失敗しても，キャッシュを更新しないだけでよい
+        self.tasks.discard(task)
+        if not task.cancelled():
+            task.exception()
+
+    async def serve_udp(self, transport: asyncio.DatagramTransport, data: bytes, addr):
+        try:
+            query = Query(data)
+        except (ValueError, IndexError, struct.error):
+            return  # 壊れた問い合わせには応答しない
+        res = await self.answer(query)
+        if res is not None:
+            transport.sendto(res if len(res) <= query.limit else truncate(res, query), addr)
+
+    async def serve_tcp(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                (length,) = LENGTH.unpack(await reader.readexactly(LENGTH.size))
+                query = Query(await reader.readexactly(length))
+                res = await self.answer(query)
+                if res is None:
+                    break
+                writer.write(LENGTH.pack(len(res)) + res)
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ValueError, IndexError, struct.error, OSError):
+            pass
+        finally:
+            writer.close()
+
+    async def answer(self, query: Query) -> bytes:
+        """
+        キャッシュか上流から応答を返す．どちらからも得られない場合はNone
+        """
+        start = time.monotonic()
+        entry = self.cache.get(query.key)
+        if entry is not None:
+            self.cache.move_to_end(query.key)
+            entry.hits += 1
+            remaining = entry.remaining(start)
+            if remaining > 0:
+                if (self.online and remaining < entry.ttl * PREFETCH_RATIO and entry.hits >= PREFETCH_HITS
+                        and not entry.refreshing):
+                    entry.refreshing = True
+                    self.spawn(self.refresh(query))
+                self.report("hit", start)
+                return entry.render(query, start)
+            if -remaining > self.max_stale:
+                del self.cache[query.key]
+                entry = None
+        if not self.online:
+            # 上流に届かない間(フェイルオーバー中，接続前)は問い合わせを送らない
+            if entry is not None:
+                self.report("stale", start)
+                return entry.render(query, start, stale=True)
+            self.report("error", start)
+            return servfail(query)
+        fetch = self.fetch(query)
+        if entry is not None:
+            # 期限切れの応答がある場合は，上流をしばらく待ってからそれを返す
+            # 上流への問い合わせはそのまま続け，応答が得られればキャッシュを更新する
+            task = self.spawn(fetch)
+            try:
+                res = await asyncio.wait_for(asyncio.shield(task), STALE_WAIT)
+            except (asyncio.TimeoutError, OSError):
+                res = None
+            if res is not None:
+                self.report("miss", start)
+                return struct.pack("!H", query.id) + res[2:]
+            self.report("stale", start)
+            return entry.render(query, time.monotonic(), stale=True)
+        try:
+            res = await fetch
+        except OSError:
+            self.report("error", start)
+            return None
+        self.report("miss", start)
+        return struct.pack("!H", query.id) + res[2:]
+
+    async def refresh(self, query: Query):
+        """
+        期限切れの前に取得し直す(プリフェッチ)
+        """
+        start = time.monotonic()
+        try:
+            await self.fetch(query)
+        except OSError:
+            entry = self.cache.get(query.key)
+            if entry is not None:
+                entry.refreshing = False  # 次に引かれた時に再試行する
+            return
+        self.report("prefetch", start)
+
+    async def fetch(self, query: Query) -> bytes:
+        """
+        上流に問い合わせてキャッシュに入れる．同じ問い合わせが実行中ならその結果を待つ
+        """
+        task = self.inflight.get(query.key)
+        if task is None:
+            task = asyncio.ensure_future(self.forward(query))
+            self.inflight[query.key] = task
+            task.add_done_callback(lambda t: self.landed(query.key, t))
+        res = await asyncio.shield(task)
+        entry = make_entry(res)
+        if entry is not None:
+            self.cache[query.key] = entry
+            self.cache.move_to_end(query.key)
+            while len(self.cache) > self.size:
+                self.cache.popitem(last=False)
+        return res
+
+    def landed(self, key: bytes, task: asyncio.Task):
+        self.inflight.pop(key, None)
+        if not task.cancelled():
+            task.exception()  # 待っていた側が先にタイムアウトしても例外を回収済みにする
+
+    async def forward(self, query: Query) -> bytes:
+        """
+        上流を順に試す．UDPの応答が切り詰められていればTCPで問い合わせ直す
+        """
+        for server in self.upstreams:
+            try:
+                res = await asyncio.wait_for(self.forward_udp(server, query), self.timeout)
+                if HEADER.unpack_from(res)[1] & FLAG_TC:
+                    res = await asyncio.wait_for(self.forward_tcp(server, query), self.timeout)
+                return res
+            except (asyncio.TimeoutError, OSError, struct.error):
+                continue
+        raise OSError("No upstream DNS server answered.")
+
+    def upstream_socket(self, kind: int) -> socket.socket:
+        """
+        deviceに結び付けた上流へのソケット
+        """
+        sock = socket.socket(socket.AF_INET, kind)
+        try:
+            sock.setblocking(False)
+            if self.device is not None:
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_BINDTODEVICE, self.device.encode())
+        except OSError:
+            sock.close()
+            raise
+        return sock
+
+    async def forward_udp(self, server: str, query: Query) -> bytes:
+        loop = asyncio.get_running_loop()
+        id = random.getrandbits(16)  # 応答の偽装を防ぐため，IDと送信元ポートは毎回変える
+        sock = self.upstream_socket(socket.SOCK_DGRAM)
+        try:
+            sock.connect(parse_server(server))
+            (transport, protocol) = await loop.create_datagram_endpoint(
+                lambda: UpstreamProtocol(id, query.question), sock=sock
+            )
+        except OSError:
+            sock.close()
+            raise
+        try:
+            transport.sendto(struct.pack("!H", id) + query.data[2:])
+            return await protocol.answer
+        finally:
+            transport.close()
+
+    async def forward_tcp(self, server: str, query: Query) -> bytes:
+        sock = self.upstream_socket(socket.SOCK_STREAM)
+        try:
+            await asyncio.get_running_loop().sock_connect(sock, parse_server(server))
+            (reader, writer) = await asyncio.open_connection(sock=sock)
+        except BaseException:
+            sock.close()  # タイムアウト(キャンセル)の場合も閉じる
+            raise
+        try:
+            writer.write(LENGTH.pack(len(query.data)) + query.data)
+            await writer.drain()
+            (length,) = LENGTH.unpack(await reader.readexactly(LENGTH.size))
+            return await reader.readexactly(length)
+        except asyncio.IncompleteReadError as e:
+            raise OSError("Connection closed by upstream DNS server.") from e
+        finally:
+            writer.close()
+
+    def report(self, result: str, start: float):
+        if self.on_query is not None:
+            self.on_query(result, time.monotonic() - start)
+
+
+class ServerProtocol(asyncio.DatagramProtocol):
+    def __init__(self, forwarder: Forwarder):
+        self.forwarder = forwarder
+        self.transport: asyncio.DatagramTransport = None
+
+    def connection_made(self, transport: asyncio.DatagramTransport):
+        self.transport = transport
+
+    def datagram_received(self, data: bytes, addr):
+        self.forwarder.spawn(self.forwarder.serve_udp(self.transport, data, addr))
+
+
+def serve(host: str, port: int, upstreams: list[str], **kwargs) -> Forwarder:
+    """
+    DNSフォワーダをデーモンスレッドで起動する．引数はForwarderと同じ
+    """
+    forwarder = Forwarder(upstreams, **kwargs)
+    forwarder.start(host, port)
+    return forwarder
@@ -3,11 +3,13 @@ import epaper
 from PIL import Image, ImageDraw, ImageFont
 import time
 import logging
-import subprocess
-import re
 import datetime
+from threading import Thread, Event
+import state
+import epdrender
 
 NIC_UPSTREAM: str = "eth0"
+IDLE_SLEEP: float = 30.0  # 表示が変わらないままこの秒数が経ったらパネルをスリープさせる
 
 logging.basicConfig(level=logging.DEBUG)
 epd = epaper.epaper('epd2in13_V4').EPD()
@@ -27,35 +29,36 @@ def main():
 
 
 def loop():
-    update = True
-    ip = ""
-    vpn = ""
+    # 描画中に届いた状態は最新のものだけを描く
+    latest = {}
+    changed = Event()
+    Thread(target=subscribe_worker, args=(latest, changed), daemon=True).start()
+    renderer = epdrender.Renderer(epd, get_base(), ignore=get_clock_box())
     while True:
-        # Get nic ip
-        _ip = get_nicip(NIC_UPSTREAM)
-        logging.info(f"{NIC_UPSTREAM}: {_ip}")
-        if _ip != ip:
-            update = True
-            ip = _ip
-        # Get vpn status
-        _vpn = getvpnstatus()
-        logging.info(f"VPN status: {_vpn}")
-        if _vpn != vpn:
-            update = True
-            vpn = _vpn
-        if update:
-            update = False
-            logging.info("Drawing...")
-            epd.init()
-            image, draw = get_draw()
-            draw.text((5, 5), f"{NIC_UPSTREAM}: {ip}", font=font20, fill=0)
-            draw.text((5, 35), f"★VPN★\n{vpn}", font=font18, fill=0)
-            epd.display(epd.getbuffer(image))
-            logging.info("Drawing done.")
-            epd.sleep()
-            logging.info("Entered sleep mode.")
-        else:
-            time.sleep(3)
+        if not changed.wait(timeout=IDLE_SLEEP):
+            renderer.sleep()
+            continue
+        changed.clear()
+        (ip, vpn) = (latest["ip"], latest["vpn"])
+        logging.info(f"{NIC_UPSTREAM}: {ip}")
+        logging.info(f"VPN status: {vpn}")
+        logging.info("Drawing...")
+        start = time.perf_counter()
+        kind = renderer.show(get_frame(renderer, ip, vpn))
+        logging.info(f"Drawing done. ({kind}, {(time.perf_counter() - start) * 1000:.0f}ms)")
+
+
+def subscribe_worker(latest: dict, changed: Event):
+    """
+    main.pyが配信する状態を受け取り，表示内容が変わった時だけ描画させる
+    """
+    for st in state.subscribe():
+        ip = format_ip(st.get("upstream_ip") if st is not None else None)
+        vpn = getvpnstatus(st)
+        if latest.get("ip") == ip and latest.get("vpn") == vpn:
+            continue
+        latest.update(ip=ip, vpn=vpn)
+        changed.set()
 
 
 def init():
@@ -76,43 +79,62 @@ def get_draw():
     return image, draw
 
 
-def get_nicip(nic: str) -> (str):
-    res = runcmd(
-        ["ip", "addr", "show", str(nic)]
-    )
-    match = re.search(r"inet (\d+\.\d+\.\d+\.\d+)", res.stdout)
-    if match:
-        ip = match.group(1)
+def get_base() -> Image.Image:
+    """
+    ラベルなど変わらない部分だけを描いたフレーム
+    """
+    image = Image.new('1', (epd.height, epd.width), 255)
+    draw = ImageDraw.Draw(image)
+    draw.text((5, 5), f"{NIC_UPSTREAM}: ", font=font20, fill=0)
+    draw.text((5, 35), "★VPN★", font=font18, fill=0)
+    draw.text((5, epd.width - 16), "Last update: ", font=font14, fill=0)
+    return image
+
+
+def get_clock_box() -> tuple[int, int, int, int]:
+    """
+    "Last update"の時刻を描く領域．表示内容が変わった時だけ描き直すため，変化の判定から除く
+    """
+    draw = ImageDraw.Draw(Image.new('1', (epd.height, epd.width), 255))
+    return (int(5 + draw.textlength("Last update: ", font=font14)), epd.width - 16, epd.height, epd.width)
+
+
+def get_frame(renderer: epdrender.Renderer, ip: str, vpn: str) -> Image.Image:
+    """
+    固定部分のフレームに値だけを描き足す．値はラベルの直後(次の行)から描く
+    """
+    image = renderer.frame()
+    draw = ImageDraw.Draw(image)
+    dtstr = datetime.datetime.now().strftime("%Y/%m/%d %H:%M:%S")
+    draw.text((5 + draw.textlength(f"{NIC_UPSTREAM}: ", font=font20), 5), ip, font=font20, fill=0)
+    draw.text((5, 35), f"\n{vpn}", font=font18, fill=0)
+    draw.text((5 + draw.textlength("Last update: ", font=font14), epd.width - 16), dtstr, font=font14, fill=0)
+    return image
+
+
+def format_ip(ip: str) -> (str):
+    if ip:
         ip_part = ip.split(".")
         formatted_ip_part = [part.rjust(3) for part in ip_part]
         return '.'.join(formatted_ip_part)
     else:
-        logging.warning("Could not get IP Address of NIC:{nic}")
+        logging.warning(f"Could not get IP Address of NIC:{NIC_UPSTREAM}")
         return "IP Error"
 
 
-def runcmd(command: list[str]) -> subprocess.CompletedProcess:
-    res = subprocess.run(command, check=False, capture_output=True, text=True)
-    return res
-
-
-def getvpnstatus() -> str:
-    command = ["vpncmd", "localhost", "/client", "/cmd", "accountstatusget", "vpngate"]
-    res = runcmd(command)
-    if res.stdout.rfind("The specified VPN Connection Setting is not connected.") >= 0:
-        return "Not connected."
-    match = re.search(r"Session Status\s*\|(.+)", res.stdout)
-    if match:
-        status = match.group(1).strip()
-        if status.find("Connection Completed (Session Established)") >= 0:
-            status = "Connected."
-            match2 = re.search(r"Server Name\s*\|(.+)", res.stdout)
-            if match2:
-                status += f"\n{match2.group(1).strip()}"
-            return status
-        else:
-            return status
-    return "Unknown status."
+def getvpnstatus(st: dict) -> str:
+    if st is None:
+        return "Router is not running."
+    server = st.get("server_name") or st.get("server_ip")
+    if st.get("connected"):
+        status = "Connected."
+        if server:
+            status += f"\n{server}"
+        return status
+    status = st.get("status") or "Unknown status."
+    if status == "Connecting" and server:
+        status += f"\n{server}"
+    return status
 
 
 def chkroot():
@@ -0,0 +1,93 @@
+"""
+電子ペーパーへの描画を最小限にする
+前回と同じフレームは送らず，変化があれば部分更新で描き換える
+時計など毎回変わる領域は比較から除き，それ以外に変化があった時だけ描く
+部分更新を重ねると残像が残るため，一定回数・一定時間ごとと，スリープから起こした時に全体更新する
+"""
+
+import time
+import logging
+from PIL import Image, ImageChops
+
+FULL_EVERY = 20  # この回数だけ部分更新したら全体更新する
+FULL_INTERVAL = 3600.0  # 最後の全体更新からこの秒数が経ったら全体更新する
+
+
+class Renderer:
+    """
+    epdはwaveshareのepd2in13_V4.EPDと同じメソッドを持つもの
+    displayPartialは画面全体のバッファを受け取るため，変化した領域はログに出すのみ
+    """
+
+    def __init__(self, epd, base: Image.Image, full_every: int = FULL_EVERY, full_interval: float = FULL_INTERVAL,
+                 ignore: tuple[int, int, int, int] = None):
+        self.epd = epd
+        self.base = base  # 固定の表示(ラベルなど)だけを描いたフレーム
+        self.ignore = ignore  # 変化の有無の判定に使わない領域(左, 上, 右, 下)
+        self.full_every = full_every
+        self.full_interval = full_interval
+        self.last_image: Image.Image = None
+        self.last_buffer = None
+        self.last_content: bytes = None
+        self.partials = 0  # 最後の全体更新からの部分更新の回数
+        self.full_at = 0.0
+        self.asleep = True
+
+    def frame(self) -> Image.Image:
+        return self.base.copy()
+
+    def show(self, image: Image.Image) -> str:
+        """
+        フレームを表示する
+
+        Returns:
+            str: 行った更新("full", "partial")．変化がなく送らなかった場合はNone
+        """
+        content = self.content(image)
+        if content == self.last_content:
+            return None
+        buffer = self.epd.getbuffer(image)
+        woke = self.asleep
+        if self.asleep:
+            self.epd.init()
+            self.asleep = False
+        # init後のパネルは部分更新の基準画像を持たないため，起こした直後は必ず全体更新する
+        if woke or self.needs_full():
+            self.epd.displayPartBaseImage(buffer)  # 全体更新し，部分更新の基準にする
+            self.partials = 0
+            self.full_at = time.monotonic()
+            kind = "full"
+        else:
+            bbox = ImageChops.difference(image.convert("L"), self.last_image.convert("L")).getbbox()
+            logging.debug(f"Changed region: {bbox}")
+            self.epd.displayPartial(buffer)
+            self.partials += 1
+            kind = "partial"
+        self.last_image = image
+        self.last_buffer = buffer
+        self.last_content = content
+        return kind
+
+    def content(self, image: Image.Image) -> bytes:
+        """
+        ignoreの領域を白で塗りつぶしたフレームの内容
+        """
+        if self.ignore is not None:
+            image = image.copy()
+            image.paste(255, self.ignore)
+        return image.tobytes()
+
+    def needs_full(self) -> bool:
+        if self.last_buffer is None:
+            return True
+        if self.partials >= self.full_every:
+            return True
+        return time.monotonic() - self.full_at >= self.full_interval
+
+    def sleep(self):
+        """
+        パネルを低消費電力状態にする．次のshowで起こす
+        """
+        if not self.asleep:
+            self.epd.sleep()
+            self.asleep = True
@@ -76,7 +76,7 @@ echo "OK"
 # aptからパッケージのインストール
 echo "Installing packages..."
 curl -1sLf 'https://dl.cloudsmith.io/public/isc/kea-2-6/setup.deb.sh' | sudo -E bash
-apt -y install kea-dhcp4-server iptables screen isc-dhcp-client
+apt -y install kea-dhcp4-server iptables nftables screen isc-dhcp-client
 if [ $? -ne 0 ]; then
   echo "Error: Installing dependencies failed."
   exit 1
@@ -157,12 +157,52 @@ if [ ${retcode} -ne 0 ]; then
   echo "Error: An error occurred while configuring vpnclient."
   exit 1
 fi
+# 待機系(config.jsonのstandby)用の仮想NICと接続設定
+./vpncmd localhost /client /cmd niccreate vpngate2
+retcode=$?
+if [ ${retcode} -ne 0 ] && [ ${retcode} -ne 30 ]; then
+  echo "Error: An error occurred while configuring vpnclient."
+  exit 1
+fi
+./vpncmd localhost /client /cmd accountcreate vpngate2 /server:192.0.2.1:443 /hub:VPNGATE /username:vpn /nicname:vpngate2
+retcode=$?
+if [ ${retcode} -ne 0 ] && [ ${retcode} -ne 34 ]; then
+  echo "Error: An error occurred while configuring vpnclient."
+  exit 1
+fi
+./vpncmd localhost /client /cmd accountpasswordset vpngate2 /password:vpn /type:standard
+retcode=$?
+if [ ${retcode} -ne 0 ]; then
+  echo "Error: An error occurred while configuring vpnclient."
+  exit 1
+fi
+# 振り分け先(config.jsonのbond.members)用の仮想NICと接続設定
+./vpncmd localhost /client /cmd niccreate vpngate3
+retcode=$?
+if [ ${retcode} -ne 0 ] && [ ${retcode} -ne 30 ]; then
+  echo "Error: An error occurred while configuring vpnclient."
+  exit 1
+fi
+./vpncmd localhost /client /cmd accountcreate vpngate3 /server:192.0.2.1:443 /hub:VPNGATE /username:vpn /nicname:vpngate3
+retcode=$?
+if [ ${retcode} -ne 0 ] && [ ${retcode} -ne 34 ]; then
+  echo "Error: An error occurred while configuring vpnclient."
+  exit 1
+fi
+./vpncmd localhost /client /cmd accountpasswordset vpngate3 /password:vpn /type:standard
+retcode=$?
+if [ ${retcode} -ne 0 ]; then
+  echo "Error: An error occurred while configuring vpnclient."
+  exit 1
+fi
 systemctl stop vpngate-vpnclient.service
 # vpnclientに設定が保存されないことが頻発するためチェック
 if [ ! -f vpn_client.config ] || \
    ! grep -q "HashedPassword H8N7rT8BH44q0nFXC9NlFxetGzQ=" vpn_client.config || \
    ! grep -q "string AccountName vpngate" vpn_client.config || \
-   ! grep -q "declare vpngate" vpn_client.config; then
+   ! grep -q "declare vpngate" vpn_client.config || \
+   ! grep -q "string AccountName vpngate2" vpn_client.config || \
+   ! grep -q "string AccountName vpngate3" vpn_client.config; then
      echo "Error: Config of vpnclient not saved or incorrect."
      exit 1
 fi
@@ -0,0 +1,145 @@
+"""
+ログファイルへの非同期書き込み
+呼び出し側はキューに積むだけで，整形と書き込みは専用スレッドでまとめて行う
+ファイルは開いたまま使い回し，日付が変わったら次の日のファイルに切り替える
+"""
+
+import os
+import sys
+import time
+import queue
+import atexit
+from threading import Thread, Lock
+from datetime import datetime
+from pathlib import Path
+
+DEBUG = 10
+INFO = 20
+ERROR = 40
+LEVELS = {"debug": DEBUG, "info": INFO, "error": ERROR}
+PREFIX = {DEBUG: "[DEBUG] ", INFO: "", ERROR: "[ERROR] "}
+
+
+class LogWriter:
+    """
+    levelより低いレコードはキューに積む前に捨てる
+    書き込みはバッファし，キューが空のまま1秒経つか，エラーを書いた時点でフラッシュする
+    """
+
+    def __init__(self, directory: Path, tz, level: int = INFO, flush_interval: float = 1.0, batch: int = 1024):
+        self.directory = directory
+        self.tz = tz
+        self.level = level
+        self.flush_interval = flush_interval
+        self.batch = batch  # 1回にまとめて書く最大件数
+        self.queue = queue.SimpleQueue()
+        self.file = None
+        self.date = None
+        self.thread: Thread = None
+        self.lock = Lock()
+        self.failed = False  # 書き込みに失敗しており，まだ成功していない
+        atexit.register(self.close)
+
+    def enabled(self, level: int) -> bool:
+        return level >= self.level
+
+    def write(self, level: int, msg: str):
+        if level < self.level:
+            return
+        if self.thread is None:
+            self.start()
+        self.queue.put((time.time(), level, msg))  # 整形は書き込みスレッドで行う
+
+    def start(self):
+        with self.lock:
+            if self.thread is None:
+                self.thread = Thread(target=self.worker, daemon=True)
+                self.thread.start()
+
+    def worker(self):
+        while True:
+            try:
+                record = self.queue.get(timeout=self.flush_interval)
+            except queue.Empty:
+                if self.file is not None:
+                    try:
+                        self.file.flush()
+                    except OSError as e:
+                        self.fail(e)
+                continue
+            records = [record]
+            while len(records) < self.batch:
+                try:
+                    records.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            stop = None in records
+            try:
+                self.emit([r for r in records if r is not None])
+                self.failed = False
+            except OSError as e:
+                self.fail(e)
+            if stop:
+                return
+
+    def emit(self, records: list[tuple[float, int, str]]):
+        if len(records) == 0:
+            return
+        lines = []
+        error = False
+        for (ts, level, msg) in records:
+            dt = datetime.fromtimestamp(ts, self.tz)
+            if dt.date() != self.date:
+                self.rotate(dt.date(), lines)
+                lines = []
+            lines.append(f"[{dt}] {PREFIX[level]}{msg}\n")
+            error = error or level >= ERROR
+        self.file.write("".join(lines))
+        if error:
+            self.file.flush()
+
+    def fail(self, e: OSError):
+        """
+        書き込めなかったレコードは捨て，ファイルは次の書き込みで開き直す
+        失敗が続く間は最初の1回だけ標準エラー出力に知らせる
+        """
+        if not self.failed:
+            print(f"LogWriter: Could not write to the log file: {e}", file=sys.stderr)
+            self.failed = True
+        if self.file is not None:
+            try:
+                self.file.close()
+            except OSError:
+                pass
+        self.file = None
+        self.date = None
+
+    def rotate(self, date, pending: list[str]):
+        """
+        溜まっている行を前の日のファイルに書いてから，dateのファイルを開く
+        """
+        if self.file is not None:
+            self.file.write("".join(pending))
+            self.file.close()
+        os.makedirs(self.directory, exist_ok=True)
+        self.file = open(self.directory.joinpath(f"log-{date}.txt"), mode="a", encoding="utf-8", buffering=65536)
+        self.date = date
+
+    def close(self):
+        """
+        キューに残っているレコードを書き終えてからファイルを閉じる
+        """
+        with self.lock:
+            thread = self.thread
+            self.thread = None
+        if thread is None:
+            return
+        self.queue.put(None)
+        thread.join()
+        if self.file is not None:
+            try:
+                self.file.close()
+            except OSError as e:
+                self.fail(e)
+            self.file = None
+            self.date = None
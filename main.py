@@ -3,88 +3,493 @@
 import sys
 import os
 import csv
-import requests
 import base64
 import re
-from io import StringIO
 import time
 import subprocess
-from threading import Thread, Event
+import select
+import socket
+import heapq
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor, Future
+from collections import deque
+from threading import Thread, Event, Lock, RLock
 from zoneinfo import ZoneInfo
-from datetime import datetime, timedelta
+from datetime import timedelta
 from pathlib import Path
 import ipaddress
 from pathlib import Path
 import json
+import struct
+import ssl
+from urllib.parse import urlsplit
+import netlink
+import netconf
+import dhcpc
+import logwriter
+import metrics
+import state
 
 VPNCMD_PATH: str = "/opt/VPNGateRouter/vpnclient/vpncmd"
 CSV_URL: str = "https://www.vpngate.net/api/iphone/"
 JSON_PATH = "config.json"
 DEBUG: bool = False
+LOG_DIR: str = "log"  # ログの保存先
+LOG_LEVEL: str = "info"  # ログファイルに書く最低レベル(debug, info, error)．DEBUGがTrueの場合はdebug
 NIC_UPSTREAM: str = "eth0"
 NIC_VPN: str = "br_eth1"
 NIC_VPNGATE: str = "vpn_vpngate"
+VPN_ACCOUNT: str = "vpngate"  # vpnclientの接続設定名
 VPNGATE_EXCEPTION_BY_OP: list[str] = ["Daiyuu Nobori_ Japan. Academic Use Only."]
 VPNGATE_COUNTRY: str = "JP"
 VPNGATE_PORT: list[int] = []
 VPNGATE_MINSPEED: int = 0  # Mbps単位，0は指定なし
+PROBE_COUNT: int = 8  # 接続遅延を計測する候補サーバ数
+PROBE_TIMEOUT: float = 1.0  # 接続遅延計測のタイムアウト(秒)
+PROBE_RTT_WEIGHT: float = 0.5  # 並べ替え時の接続遅延の重み(0でスコアのみ，1で遅延のみ)
+SERVERLIST_MAXAGE: int = 600  # サーバリストキャッシュの最大保持時間(秒)
+SERVERLIST_CACHE: str = "serverlist.csv"  # サーバリストのキャッシュ
+SERVERLIST_META: str = "serverlist.json"  # キャッシュの取得日時，ETagなど
+SCORING_WEIGHTS: dict = {  # サーバ選択時の各指標の重み(0で無視)
+    "score": 1.0,  # VPNGateのスコア
+    "ping": 0.3,  # 低いほど良い
+    "speed": 0.5,
+    "sessions": 0.5,  # 少ないほど良い
+    "uptime": 0.2,
+    "success": 1.0,  # このルータからの接続成功率
+    "connect_time": 0.3,  # このルータからの接続所要時間(短いほど良い)
+    "throughput": 0.5,  # このルータから計測した転送速度
+}
+SCORING_CONSTRAINTS: dict = {  # 満たさないサーバは除外(0は指定なし)
+    "maxping": 0,  # ms
+    "maxsessions": 0,
+    "minuptime": 0,  # 秒
+    "minsuccess": 0.0,  # 接続成功率(0～1)
+}
+REPUTATION_DB: str = "reputation.db"  # サーバの接続実績の保存先
+REPUTATION_HALFLIFE: int = 3600  # 失敗によるペナルティの半減期(秒)
+REPUTATION_THRESHOLD: float = 0.5  # ペナルティがこれ以上のサーバは除外
+STANDBY_ENABLE: bool = False  # 待機系のVPN接続を事前に用意するか
+STANDBY_ACCOUNT: str = "vpngate2"  # 待機系のvpnclientの接続設定名
+STANDBY_NIC: str = "vpn_vpngate2"  # 待機系の仮想NIC
+STANDBY_INTERVAL: float = 5.0  # 待機系の死活監視間隔(秒)
+DETECT_PROBE: bool = True  # トンネル内のゲートウェイへのping監視を行うか
+DETECT_INTERVAL: float = 0.3  # ping監視の間隔(秒)
+DETECT_THRESHOLD: int = 5  # 連続でこの回数応答がなければ切断とみなす
+CONNECT_TIMEOUT: float = 5.0  # 接続完了を待つ時間(秒)
+VPNCMD_TIMEOUT: float = 60.0  # vpncmdの応答待ちタイムアウト(秒)
+VPNCMD_QUERY_TIMEOUT: float = 5.0  # 状態・一覧を取得するだけのコマンドの応答待ちタイムアウト(秒)
+DHCP_TIMEOUT: float = 10.0  # DHCPの応答待ちタイムアウト(秒)
+DHCP_RETRY_MIN: float = 60.0  # リース更新に失敗した場合の最短の再試行間隔(秒)
+NETWORK_BACKEND: str = "netlink"  # アドレス・経路の設定方法(netlinkまたはcommand)
+METRICS_ENABLE: bool = True  # メトリクスをHTTPで公開するか
+METRICS_LISTEN: str = "127.0.0.1"  # メトリクスの待受アドレス
+METRICS_PORT: int = 9101  # メトリクスの待受ポート(GET /metrics)
+QUALIFY_ENABLE: bool = False  # 接続直後にトンネル経由の転送速度を計測し，遅いサーバを避けるか
+QUALIFY_URL: str = "https://speed.cloudflare.com/__down?bytes=100000000"  # 計測に使うダウンロード先
+QUALIFY_DURATION: float = 3.0  # 計測時間の上限(秒)
+QUALIFY_MINSPEED: float = 10.0  # これより遅いサーバは切断して次へ(Mbps)
+QUALIFY_MAXLATENCY: float = 0.0  # トンネル経由の接続遅延がこれより大きいサーバは切断して次へ(ms，0は指定なし)
+QUALITY_ENABLE: bool = False  # 接続中の品質が低下したら別のサーバへ計画的に移行するか
+QUALITY_WINDOW: float = 60.0  # 品質を集計する期間(秒)
+QUALITY_HOLD: float = 30.0  # 基準を下回る状態がこの秒数続いたら移行する
+QUALITY_COOLDOWN: float = 600.0  # 移行を試みてから次に試みるまでの最短間隔(秒)
+QUALITY_MAXRTT: float = 500.0  # トンネル内のゲートウェイへの平均RTT(ms，0は指定なし)
+QUALITY_MAXLOSS: float = 0.1  # トンネル内のゲートウェイへのpingの損失率(0～1，0は指定なし)
+QUALITY_MINSPEED: float = 1.0  # 転送が詰まっている時の転送速度(Mbps，0は指定なし)
+QUALITY_SATURATION: float = 2.0  # 平均RTTが最小RTTのこの倍数以上なら，転送が詰まっているとみなす
+BOND_ENABLE: bool = False  # 現用系に加えて複数のVPN接続を維持し，LANの通信をフロー単位で振り分けるか
+BOND_MEMBERS: list[dict] = [{"account": "vpngate3", "nic": "vpn_vpngate3"}]  # 追加で接続する接続設定名・仮想NIC
+BOND_TABLE: int = 100  # 振り分けに使う経路表．追加の接続はBOND_TABLE+1から順に自身の経路表を持つ
+BOND_PRIORITY: int = 100  # 振り分けのip ruleの優先度(BOND_PRIORITYから3つ使う)
+BOND_INTERVAL: float = 5.0  # 追加の接続の死活監視間隔(秒)
+BYPASS_ENABLE: bool = False  # 指定した宛先へのLANの通信を，VPNを通さず上流NICから直接出すか
+BYPASS_NETS: list[str] = []  # 直接通信する宛先(CIDR)
+BYPASS_NET_FILES: list[str] = []  # 1行に1つCIDRを書いたファイル(#以降はコメント)
+BYPASS_DOMAINS: list[str] = []  # 直接通信する宛先のドメイン名(名前解決したアドレスを使う)
+BYPASS_DOMAIN_FILES: list[str] = []  # 1行に1つドメイン名を書いたファイル(#以降はコメント)
+BYPASS_INTERVAL: float = 300.0  # ファイルの再読み込みと名前解決の間隔(秒)
+BYPASS_KEEP: float = 3600.0  # 名前解決で得られなくなったアドレスを集合に残す時間(秒)
+BYPASS_TABLE: int = 90  # 直接通信に使う経路表．fwmarkとconntrackのマークにも同じ値を使う
+BYPASS_PRIORITY: int = 90  # 直接通信のip ruleの優先度(振り分けより前にする)
+NFT_TABLE: str = "vpngate_bypass"  # 直接通信する宛先の集合と規則を置くnftablesのテーブル
+DNS_ENABLE: bool = True  # LANのクライアント向けにキャッシュ付きDNSフォワーダをNIC_VPNのアドレスで動かすか
+DNS_PORT: int = 53  # DNSフォワーダの待受ポート(UDP/TCP)
+DNS_UPSTREAMS: list[str] = ["1.1.1.1", "1.0.0.1"]  # 転送先のDNSサーバ(ip[:port])．現用系の仮想NICから問い合わせる
+DNS_CACHE_SIZE: int = 10000  # キャッシュする応答の最大数
+DNS_TIMEOUT: float = 2.0  # 上流1つあたりの応答待ち時間(秒)
+DNS_MAX_STALE: float = 86400.0  # 上流に届かない場合に，期限切れの応答を返す最大時間(秒)
+RESUME_ENABLE: bool = True  # 起動時に前回のセッションを引き継ぐか(確立したままなら引き取り，なければ前回のサーバに直接接続する)
+RESUME_STATE: str = "session.json"  # 前回のセッションの状態(サーバ，リース，ネットワーク設定)の保存先
+RESUME_MAXAGE: int = 3600  # これより古い状態は使わず，サーバを選び直す(秒)
 
 status_error_event = Event()
 is_connected = False
 is_overwrite_active = False
 check_point = None
 vpngate_ip_list: list[str] = []  # 切断されたサーバ
+vpn_account: str = VPN_ACCOUNT  # 現用系の接続設定名(待機系への切替で入れ替わる)
+vpn_nic: str = NIC_VPNGATE  # 現用系の仮想NIC(待機系への切替で入れ替わる)
+session_id: int = 0  # 接続ごとに増やし，前の接続の監視スレッドを止める
+vpn_gateway: str = None  # 現用系のトンネル内のゲートウェイ
+vpn_lease = None  # 現用系のDHCPリース(dhcpc.Lease)
+vpn_host: str = None  # 現用系の接続先(IPアドレス:ポート)
+failure_lock = Lock()  # 複数の検知手段から同時に切断を報告しないため
+standby = None  # 待機系のVPN接続(StandbyTunnel)
+migration_tunnel = None  # 待機系がない場合に，計画的な移行先として使う待機系の接続設定(StandbyTunnel)
+migrate_event = Event()  # 移行先の準備完了
+migrate_reason: str = None  # 移行の理由(メトリクスのラベル)
+last_migration: float = None  # 最後に移行を試みた時刻(time.monotonic())
+quality = None  # 接続中の品質(QualityMonitor)
+bond_members: list["BondMember"] = []  # 振り分け用の追加のVPN接続
+bond_lock = Lock()  # 振り分けの経路を同時に書き換えないため
+claim_lock = Lock()  # 待機系・振り分け先が同じサーバを選ばないため
+bypass = None  # VPNを通さない宛先(SplitTunnel)
+dns_forwarder = None  # LANのクライアント向けのDNSフォワーダ(dnsfwd.Forwarder)
+startup_mode: str = "cold"  # 起動から最初の接続までの方法(cold, resume, adopt)．接続後はNone
+session_state_lock = Lock()  # RESUME_STATEを同時に書き込まないため
 stopping: bool = False  # 終了中(error code=1による誤再起動を防ぐ)
+vpncmd_session = None  # 常駐させるvpncmd
+server_table = None  # パース済みのサーバリスト(キャッシュが更新されるまで再利用)
+server_table_key = None  # server_tableのパース元キャッシュのmtime
+reputation = None  # サーバの接続実績(ReputationStore)
+connected_at = None  # 現在のセッションの接続時刻
+serverlist_lock = Lock()  # サーバリストの取得を同時に行わないため
+serverlist_refresh_event = Event()  # サーバリストの即時更新要求
+net = None  # ネットワーク設定のバックエンド(netconf)
+publisher = None  # 状態の配信(state.Publisher)
+upstream_ip = None  # 上流NICのアドレス．リンク監視がアドレスの変化を受けて取得し直す
+registry = metrics.Registry()
+m_rx_bytes = registry.counter("vpngate_rx_bytes_total", "Bytes received through the tunnel in the current session.")
+m_tx_bytes = registry.counter("vpngate_tx_bytes_total", "Bytes sent through the tunnel in the current session.")
+m_rx_rate = registry.gauge("vpngate_rx_bytes_per_second", "Receive rate between the last two status polls.")
+m_tx_rate = registry.gauge("vpngate_tx_bytes_per_second", "Send rate between the last two status polls.")
+m_connected = registry.gauge("vpngate_connected", "1 if the tunnel is established.")
+m_uptime = registry.gauge("vpngate_session_uptime_seconds", "Seconds since the current session was established.")
+m_server = registry.gauge("vpngate_server_info", "Relay server of the current session.")
+m_failovers = registry.counter("vpngate_failovers_total", "Failovers by the way the tunnel was restored.")
+m_detect = registry.histogram("vpngate_detect_seconds", "Time from the last healthy signal to failure detection.")
+m_reconnect = registry.histogram("vpngate_reconnect_seconds", "Time from failure detection to the restored session.")
+m_dhcp = registry.histogram("vpngate_dhcp_seconds", "Duration of DHCP lease acquisition and renewal.")
+m_ipconfig = registry.histogram("vpngate_ipconfig_seconds", "Duration of ipconfig including DHCP.")
+m_qualify = registry.histogram(
+    "vpngate_qualify_mbps", "Throughput measured through the tunnel after connecting.",
+    buckets=(1, 5, 10, 25, 50, 100, 250, 500, 1000),
+)
+m_rtt = registry.gauge("vpngate_tunnel_rtt_seconds", "Mean RTT to the tunnel gateway over the quality window.")
+m_loss = registry.gauge("vpngate_tunnel_loss_ratio", "Ping loss to the tunnel gateway over the quality window.")
+m_migrations = registry.counter("vpngate_migrations_total", "Planned migrations by the criterion that triggered them.")
+m_qualify_rejected = registry.counter("vpngate_qualify_rejected_total", "Servers disconnected by the post-connect test.")
+m_stage = registry.histogram("vpngate_connect_stage_seconds", "Duration of each connect and failover stage.")
+m_bypass = registry.gauge("vpngate_bypass_entries", "Entries in the nftables sets of destinations that bypass the VPN.")
+m_dns = registry.histogram("vpngate_dns_query_seconds", "Duration of DNS queries answered by the forwarder by result.")
+m_dns_cache = registry.gauge("vpngate_dns_cache_entries", "Responses held in the DNS forwarder cache.")
+m_startup = registry.gauge("vpngate_startup_seconds", "Time from start to the first established session by how it was restored.")
+m_bond = registry.gauge("vpngate_bond_tunnels", "Tunnels that LAN flows are currently spread across.")
+last_healthy: float = None  # 最後に正常を確認した時刻(time.monotonic())
+failover_method: str = None  # フェイルオーバー中の場合，復旧方法(standby, reconnect)
+status_sample = None  # 前回の状態確認時の(時刻, 受信量, 送信量)．転送速度の計算用
+logger = logwriter.LogWriter(
+    Path(__file__).resolve().parent.joinpath(LOG_DIR),
+    ZoneInfo("Asia/Tokyo"),
+    level=logwriter.DEBUG if DEBUG else logwriter.LEVELS[LOG_LEVEL],
+)
 
 
 def main():
     global stopping
     global is_connected
     global vpngate_ip_list
+    global vpn_account
+    global vpn_nic
+    global startup_mode
+    global reputation
+    global standby
+    global net
+    global publisher
+    global quality
+    global bond_members
+    global bypass
     try:
         set_td()
         print_debug("Started.")
         load_json()
+        reputation = ReputationStore(get_path(REPUTATION_DB))
+        quality = QualityMonitor()
+        net = netconf.open_backend(NETWORK_BACKEND, runcmd)
+        if METRICS_ENABLE:
+            start_metrics()
+        try:
+            publisher = state.Publisher()
+        except OSError as e:
+            print_error("State", f"Could not publish state on {state.SOCKET_PATH}. {e}")
+        refresh_upstream_ip()
+        publish_state(connected=False, status="Connecting")
+        if net.name != NETWORK_BACKEND:
+            print_error("NetConf", f"Could not use {NETWORK_BACKEND} backend. Falling back to {net.name}.")
+        print_debug(f"Network backend: {net.name}")
+        if not DETECT_PROBE:
+            warn_quality_unmeasured("detect.probe is disabled.")
+        saved = load_session()
+        if saved is not None:
+            # 前回の実行で待機系に切り替えていた場合は，その接続設定・仮想NICを現用系として引き継ぐ
+            (vpn_account, vpn_nic) = (saved["account"], saved["nic"])
+        if BYPASS_ENABLE:
+            bypass = SplitTunnel()
         init()  # 初期設定
+        if bypass is not None:
+            bw = Thread(target=bypass.worker, daemon=True)
+            bw.start()
+        if DNS_ENABLE:
+            start_dns()
+        sl = Thread(target=serverlist_refresh_worker, daemon=True)
+        sl.start()
+        lm = Thread(target=link_monitor_worker, daemon=True)
+        lm.start()
+        pw = Thread(target=vpnclient_watch_worker, daemon=True)
+        pw.start()
+        if STANDBY_ENABLE:
+            standby = StandbyTunnel(*spare_account())
+            st = Thread(target=standby.worker, daemon=True)
+            st.start()
+        if BOND_ENABLE:
+            bond_members = [BondMember(m["account"], m["nic"], BOND_TABLE + 1 + i) for (i, m) in enumerate(BOND_MEMBERS)]
+            for member in bond_members:
+                bm = Thread(target=member.worker, daemon=True)
+                bm.start()
+        pipeline = None  # フェイルオーバー時は，検知した時点で始めた切断・候補選択の処理(ConnectPipeline)
+        if saved is not None:
+            pipeline = ConnectPipeline("Resume")
+            if not saved["clean"]:
+                # 待機系・振り分け先は引き継がず，前回の実行で残った接続と経路を片付ける
+                pipeline.submit("spares", discard_tunnels, saved["tunnels"])
+            if pipeline.run("adopt", adopt_session, saved):
+                pipeline.result("spares")
+                pipeline.close()
+                startup_mode = "adopt"
+                start_session()
+                pipeline = monitor_session()
+            else:
+                # 前回のサーバに直接接続する．サーバリストはフェイルオーバーに備えて並行して読み込む
+                startup_mode = "resume"
+                if not saved["clean"]:
+                    current = {"account": vpn_account, "nic": vpn_nic, "ip": saved["server"]}
+                    pipeline.submit("disconnect", discard_tunnels, [current], after=("spares",))
+                pipeline.submit("probe", lambda: [saved["host"]])
+                sp = Thread(target=get_server_list, daemon=True)
+                sp.start()
         while True:
-            # ベストなVPNGateのサーバ情報を取得
-            host = get_bestserver()
-            vpngate_ip_list.append(host.split(":")[0])  # IPアドレス部分を抽出
-            connect_res = vpn_connect(host)  # ベストなVPNGateサーバに接続
+            if pipeline is None:
+                pipeline = ConnectPipeline("Connect")
+                # ベストなVPNGateのサーバ候補を取得(待機系・振り分け先が使っているサーバは除く)
+                pipeline.submit("select", find_candidates, servers_in_use())
+                pipeline.submit("probe", lambda: rank_candidates(pipeline.result("select")), after=("select",))
+            hosts = pipeline.result("probe")
+            pipeline.result("disconnect")  # 同じ接続設定で接続し直すため，切断の完了を待つ
+            # 候補の上位から順にVPNGateサーバに接続
+            connect_res = pipeline.run("connect", vpn_connect, hosts)
             if not connect_res:
                 print_error("VPNConnect", "Could not complete connecting to vpngate server.")
-                # 接続失敗時，クリーンして再実行
-                vpn_disconnect()
+                # 全候補に接続失敗時，リストを取り直して再実行
                 print_debug(f"Bad servers: {vpngate_ip_list}")
+                pipeline.close()
+                pipeline = None
                 continue
-            ipconfig(vpngate_ip_list[-1])  # IPアドレスを設定
-            # 死活監視スレッドを実行
-            is_connected = True
-            # 実行時間を計測
-            td = get_td()
-            print_log(f"Connected in {td}ms")
-            # 接続成功したので，リストを現在接続している中継サーバのみとする
-            vpngate_ip_list = [vpngate_ip_list[-1]]
-            sc = Thread(target=status_check_worker, daemon=True)
-            sc.start()
-            dh = Thread(target=dhcp_reobtain_worker, daemon=True)
-            dh.start()
-            while sc.is_alive():
-                if status_error_event.wait(timeout=1.0):
-                    status_error_event.clear()
-                    # 状態エラー発生のためフェイルオーバー開始
-                    print_log("Failover started.")
-                    ipreset(vpngate_ip_list[-1])  # IP設定を解除
-                    vpn_disconnect()  # VPN切断
-                    break
+            pipeline.run("ipconfig", ipconfig, vpngate_ip_list[-1])  # IPアドレスを設定
+            if QUALIFY_ENABLE and not pipeline.run("qualify", qualify, vpngate_ip_list[-1]):
+                # 転送速度・遅延が基準を満たさないため，すぐに次のサーバへ
+                ipreset(vpngate_ip_list[-1])
+                vpn_disconnect()
+                pipeline.close()
+                pipeline = None
+                continue
+            pipeline.close()
+            start_session()
+            pipeline = monitor_session()
     except FatalErrException:
         clean(vpngate_ip_list[-1])
         err_exit()
     except KeyboardInterrupt:
         stopping = True
         print_log("Exiting...")
+        if is_connected:
+            reputation.record_session(vpngate_ip_list[-1], time.time() - connected_at, failed=False)
+            save_session(clean=True)  # 次の起動時は，残った設定を調べずに同じサーバへ接続し直す
         clean(vpngate_ip_list[-1])
+        if vpncmd_session is not None:
+            vpncmd_session.close()
+        publish_state(connected=False, status="Stopped")
+        if publisher is not None:
+            publisher.close()
+        net.close()
         print_log("Ready to exit. BYE!")
+        logger.close()
+
+
+def monitor_session() -> "ConnectPipeline":
+    """
+    接続中のセッションを監視し，待機系への切替や計画的な移行はその場で行う
+    再接続が必要になったら，切断の後始末と次のサーバの選択を始めたConnectPipelineを返す
+    """
+    global failover_method
+    while True:
+        if status_error_event.wait(timeout=1.0):
+            status_error_event.clear()
+            # 状態エラー発生のためフェイルオーバー開始
+            print_log("Failover started.")
+            reputation.record_session(vpngate_ip_list[-1], time.time() - connected_at, failed=True)
+            if standby is not None and standby.promote():
+                # 待機系に切り替えた場合は，そのまま監視を続ける
+                failover_method = "standby"
+                start_session()
+                continue
+            failover_method = "reconnect"
+            # 切断の後始末と次のサーバの選択を並行して始める
+            # 候補への接続遅延は，切断したトンネルの経路を消してから計測する
+            pipeline = ConnectPipeline("Failover")
+            pipeline.submit("ipreset", ipreset, vpngate_ip_list[-1])  # IP設定を解除
+            pipeline.submit("disconnect", vpn_disconnect)  # VPN切断
+            pipeline.submit("select", find_candidates, servers_in_use())
+            pipeline.submit(
+                "probe", lambda: rank_candidates(pipeline.result("select")), after=("select", "ipreset")
+            )
+            return pipeline
+        if migrate_event.is_set():
+            migrate_event.clear()
+            # 品質低下による計画的な移行．移行先は接続済みのため，切断せずに切り替える
+            if migrate():
+                start_session()
+
+
+def start_session():
+    """
+    接続完了後の処理．死活監視スレッドとDHCP再取得スレッドを実行する
+    """
+    global is_connected
+    global vpngate_ip_list
+    global connected_at
+    global session_id
+    global last_healthy
+    global failover_method
+    global status_sample
+    global startup_mode
+    # 死活監視スレッドを実行
+    is_connected = True
+    # 実行時間を計測
+    td = get_td()
+    print_log(f"Connected in {td}ms  Server: {vpngate_ip_list[-1]}")
+    if failover_method is not None:
+        m_reconnect.observe(float(td) / 1000, method=failover_method)
+        m_failovers.inc(method=failover_method)
+        failover_method = None
+    if startup_mode is not None:
+        m_startup.set(float(td) / 1000, mode=startup_mode)
+        startup_mode = None
+    connected_at = time.time()
+    last_healthy = time.monotonic()
+    status_sample = None
+    quality.reset()
+    m_connected.set(1)
+    m_server.clear()
+    m_server.set(1, ip=vpngate_ip_list[-1], nic=vpn_nic)
+    if dns_forwarder is not None:
+        dns_forwarder.device = vpn_nic  # 待機系への切替後は仮想NICが変わる
+        dns_forwarder.online = True
+    sinfo = server_table.get(vpngate_ip_list[-1]) if server_table is not None else None
+    publish_state(
+        connected=True,
+        status="Connected",
+        server_ip=vpngate_ip_list[-1],
+        server_name=sinfo.hostname if sinfo is not None else None,
+        rx_rate=None,
+        tx_rate=None,
+    )
+    # 接続成功したので，リストを現在接続している中継サーバのみとする
+    vpngate_ip_list = [vpngate_ip_list[-1]]
+    session_id += 1
+    sc = Thread(target=status_check_worker, args=(session_id,), daemon=True)
+    sc.start()
+    dh = Thread(target=dhcp_reobtain_worker, args=(session_id,), daemon=True)
+    dh.start()
+    if DETECT_PROBE and vpn_gateway is not None:
+        pr = Thread(target=gateway_probe_worker, args=(session_id, vpn_nic, vpn_gateway), daemon=True)
+        pr.start()
+    elif DETECT_PROBE:
+        warn_quality_unmeasured("The VPN gateway is unknown, so the gateway probe is not running.")
+    if QUALITY_ENABLE:
+        qm = Thread(target=quality_monitor_worker, args=(session_id,), daemon=True)
+        qm.start()
+    if standby is not None:
+        standby.wake.set()  # 待機系の準備を始める
+    if BOND_ENABLE:
+        update_bond_route()
+    save_session()
+
+
+def publish_state(**values):
+    """
+    epd.pyなどの購読者に状態を配信する
+    """
+    if publisher is None:
+        return
+    publisher.update(upstream_ip=upstream_ip, **values)
+
+
+def refresh_upstream_ip():
+    """
+    上流NICのアドレスを取得し直し，変わっていれば配信する
+    """
+    global upstream_ip
+    try:
+        ip = net.get_addr(NIC_UPSTREAM)
+    except OSError:
+        ip = None
+    if ip != upstream_ip:
+        upstream_ip = ip
+        publish_state()
+
+
+def start_metrics():
+    m_connected.set(0)
+    m_uptime.set_function(lambda: time.time() - connected_at if is_connected else None)
+    try:
+        metrics.serve(registry, METRICS_LISTEN, METRICS_PORT)
+    except OSError as e:
+        print_error("Metrics", f"Could not listen on {METRICS_LISTEN}:{METRICS_PORT}. {e}")
+        return
+    print_log(f"Metrics are served on http://{METRICS_LISTEN}:{METRICS_PORT}/metrics")
+
+
+def start_dns():
+    """
+    LANのクライアント向けのDNSフォワーダをNIC_VPNのアドレスで起動する
+    起動できなくても接続は続ける(クライアントは別のDNSサーバを使えばよい)
+    """
+    global dns_forwarder
+    import dnsfwd  # asyncioを使うため，有効な場合だけ読み込む
+    try:
+        host = net.get_addr(NIC_VPN)
+    except OSError as e:
+        print_error("DNS", f"Could not get the address of {NIC_VPN}. {e}")
+        return
+    forwarder = dnsfwd.Forwarder(
+        DNS_UPSTREAMS,
+        size=DNS_CACHE_SIZE,
+        timeout=DNS_TIMEOUT,
+        max_stale=DNS_MAX_STALE,
+        on_query=lambda result, seconds: m_dns.observe(seconds, result=result),
+    )
+    # 上流への問い合わせは現用系の仮想NICからだけ送り，接続前(is_connectedがFalse)は送らない
+    forwarder.device = vpn_nic
+    forwarder.online = is_connected
+    try:
+        forwarder.start(host, DNS_PORT)
+    except OSError as e:
+        print_error("DNS", f"Could not listen on {host}:{DNS_PORT}. {e}")
+        return
+    dns_forwarder = forwarder
+    m_dns_cache.set_function(lambda: len(forwarder.cache))
+    print_log(f"DNS forwarder is listening on {host}:{DNS_PORT}")
 
 
 def load_json():
@@ -92,6 +497,59 @@ def load_json():
     global VPNGATE_COUNTRY
     global VPNGATE_PORT
     global VPNGATE_MINSPEED
+    global SERVERLIST_MAXAGE
+    global SCORING_WEIGHTS
+    global SCORING_CONSTRAINTS
+    global REPUTATION_HALFLIFE
+    global REPUTATION_THRESHOLD
+    global STANDBY_ENABLE
+    global STANDBY_ACCOUNT
+    global STANDBY_NIC
+    global DETECT_PROBE
+    global DETECT_INTERVAL
+    global DETECT_THRESHOLD
+    global PROBE_COUNT
+    global PROBE_TIMEOUT
+    global PROBE_RTT_WEIGHT
+    global NETWORK_BACKEND
+    global LOG_LEVEL
+    global METRICS_ENABLE
+    global METRICS_LISTEN
+    global METRICS_PORT
+    global QUALIFY_ENABLE
+    global QUALIFY_URL
+    global QUALIFY_DURATION
+    global QUALIFY_MINSPEED
+    global QUALIFY_MAXLATENCY
+    global QUALITY_ENABLE
+    global QUALITY_WINDOW
+    global QUALITY_HOLD
+    global QUALITY_COOLDOWN
+    global QUALITY_MAXRTT
+    global QUALITY_MAXLOSS
+    global QUALITY_MINSPEED
+    global BOND_ENABLE
+    global BOND_MEMBERS
+    global BOND_TABLE
+    global BOND_PRIORITY
+    global BOND_INTERVAL
+    global BYPASS_ENABLE
+    global BYPASS_NETS
+    global BYPASS_NET_FILES
+    global BYPASS_DOMAINS
+    global BYPASS_DOMAIN_FILES
+    global BYPASS_INTERVAL
+    global BYPASS_KEEP
+    global BYPASS_TABLE
+    global BYPASS_PRIORITY
+    global DNS_ENABLE
+    global DNS_PORT
+    global DNS_UPSTREAMS
+    global DNS_CACHE_SIZE
+    global DNS_TIMEOUT
+    global DNS_MAX_STALE
+    global RESUME_ENABLE
+    global RESUME_MAXAGE
     path = Path(__file__).resolve().parent.joinpath(JSON_PATH)
     try:
         with open(Path(path), 'r') as f:
@@ -104,6 +562,133 @@ def load_json():
             print_debug(f"VPNGATE_PORT = {VPNGATE_PORT}")
             VPNGATE_MINSPEED = dict_get(j, "minspeed", VPNGATE_MINSPEED, type(VPNGATE_MINSPEED))
             print_debug(f"VPNGATE_MINSPEED = {VPNGATE_MINSPEED}")
+            SERVERLIST_MAXAGE = dict_get(j, "serverlist.maxage", SERVERLIST_MAXAGE, int)
+            print_debug(f"SERVERLIST_MAXAGE = {SERVERLIST_MAXAGE}")
+            SCORING_WEIGHTS = dict_get_numbers(j, "scoring.weights", SCORING_WEIGHTS)
+            print_debug(f"SCORING_WEIGHTS = {SCORING_WEIGHTS}")
+            SCORING_CONSTRAINTS = dict_get_numbers(j, "scoring.constraints", SCORING_CONSTRAINTS)
+            print_debug(f"SCORING_CONSTRAINTS = {SCORING_CONSTRAINTS}")
+            REPUTATION_HALFLIFE = dict_get(j, "reputation.halflife", REPUTATION_HALFLIFE, int)
+            print_debug(f"REPUTATION_HALFLIFE = {REPUTATION_HALFLIFE}")
+            REPUTATION_THRESHOLD = dict_get(j, "reputation.threshold", REPUTATION_THRESHOLD, (int, float))
+            print_debug(f"REPUTATION_THRESHOLD = {REPUTATION_THRESHOLD}")
+            STANDBY_ENABLE = dict_get(j, "standby.enable", STANDBY_ENABLE, bool)
+            print_debug(f"STANDBY_ENABLE = {STANDBY_ENABLE}")
+            STANDBY_ACCOUNT = dict_get(j, "standby.account", STANDBY_ACCOUNT, str)
+            print_debug(f"STANDBY_ACCOUNT = {STANDBY_ACCOUNT}")
+            STANDBY_NIC = dict_get(j, "standby.nic", STANDBY_NIC, str)
+            print_debug(f"STANDBY_NIC = {STANDBY_NIC}")
+            DETECT_PROBE = dict_get(j, "detect.probe", DETECT_PROBE, bool)
+            print_debug(f"DETECT_PROBE = {DETECT_PROBE}")
+            DETECT_INTERVAL = dict_get(j, "detect.interval", DETECT_INTERVAL, (int, float))
+            print_debug(f"DETECT_INTERVAL = {DETECT_INTERVAL}")
+            DETECT_THRESHOLD = dict_get(j, "detect.threshold", DETECT_THRESHOLD, int)
+            print_debug(f"DETECT_THRESHOLD = {DETECT_THRESHOLD}")
+            PROBE_COUNT = dict_get(j, "probe.count", PROBE_COUNT, int)
+            print_debug(f"PROBE_COUNT = {PROBE_COUNT}")
+            PROBE_TIMEOUT = dict_get(j, "probe.timeout", PROBE_TIMEOUT, (int, float))
+            print_debug(f"PROBE_TIMEOUT = {PROBE_TIMEOUT}")
+            PROBE_RTT_WEIGHT = dict_get(j, "probe.rtt_weight", PROBE_RTT_WEIGHT, (int, float))
+            print_debug(f"PROBE_RTT_WEIGHT = {PROBE_RTT_WEIGHT}")
+            NETWORK_BACKEND = dict_get(j, "network.backend", NETWORK_BACKEND, str)
+            if NETWORK_BACKEND not in netconf.BACKENDS:
+                print_error("LOAD_JSON", f"Unknown network backend \"{NETWORK_BACKEND}\"")
+                err_exit()
+            print_debug(f"NETWORK_BACKEND = {NETWORK_BACKEND}")
+            LOG_LEVEL = dict_get(j, "log.level", LOG_LEVEL, str)
+            if LOG_LEVEL not in logwriter.LEVELS:
+                print_error("LOAD_JSON", f"Unknown log level \"{LOG_LEVEL}\"")
+                err_exit()
+            if not DEBUG:
+                logger.level = logwriter.LEVELS[LOG_LEVEL]
+            print_debug(f"LOG_LEVEL = {LOG_LEVEL}")
+            METRICS_ENABLE = dict_get(j, "metrics.enable", METRICS_ENABLE, bool)
+            print_debug(f"METRICS_ENABLE = {METRICS_ENABLE}")
+            METRICS_LISTEN = dict_get(j, "metrics.listen", METRICS_LISTEN, str)
+            print_debug(f"METRICS_LISTEN = {METRICS_LISTEN}")
+            METRICS_PORT = dict_get(j, "metrics.port", METRICS_PORT, int)
+            print_debug(f"METRICS_PORT = {METRICS_PORT}")
+            QUALIFY_ENABLE = dict_get(j, "qualify.enable", QUALIFY_ENABLE, bool)
+            print_debug(f"QUALIFY_ENABLE = {QUALIFY_ENABLE}")
+            QUALIFY_URL = dict_get(j, "qualify.url", QUALIFY_URL, str)
+            if urlsplit(QUALIFY_URL).scheme not in ("http", "https"):
+                print_error("LOAD_JSON", f"Unsupported qualify URL \"{QUALIFY_URL}\"")
+                err_exit()
+            print_debug(f"QUALIFY_URL = {QUALIFY_URL}")
+            QUALIFY_DURATION = dict_get(j, "qualify.duration", QUALIFY_DURATION, (int, float))
+            print_debug(f"QUALIFY_DURATION = {QUALIFY_DURATION}")
+            QUALIFY_MINSPEED = dict_get(j, "qualify.minspeed", QUALIFY_MINSPEED, (int, float))
+            print_debug(f"QUALIFY_MINSPEED = {QUALIFY_MINSPEED}")
+            QUALIFY_MAXLATENCY = dict_get(j, "qualify.maxlatency", QUALIFY_MAXLATENCY, (int, float))
+            print_debug(f"QUALIFY_MAXLATENCY = {QUALIFY_MAXLATENCY}")
+            QUALITY_ENABLE = dict_get(j, "quality.enable", QUALITY_ENABLE, bool)
+            print_debug(f"QUALITY_ENABLE = {QUALITY_ENABLE}")
+            QUALITY_WINDOW = dict_get(j, "quality.window", QUALITY_WINDOW, (int, float))
+            print_debug(f"QUALITY_WINDOW = {QUALITY_WINDOW}")
+            QUALITY_HOLD = dict_get(j, "quality.hold", QUALITY_HOLD, (int, float))
+            print_debug(f"QUALITY_HOLD = {QUALITY_HOLD}")
+            QUALITY_COOLDOWN = dict_get(j, "quality.cooldown", QUALITY_COOLDOWN, (int, float))
+            print_debug(f"QUALITY_COOLDOWN = {QUALITY_COOLDOWN}")
+            QUALITY_MAXRTT = dict_get(j, "quality.maxrtt", QUALITY_MAXRTT, (int, float))
+            print_debug(f"QUALITY_MAXRTT = {QUALITY_MAXRTT}")
+            QUALITY_MAXLOSS = dict_get(j, "quality.maxloss", QUALITY_MAXLOSS, (int, float))
+            print_debug(f"QUALITY_MAXLOSS = {QUALITY_MAXLOSS}")
+            QUALITY_MINSPEED = dict_get(j, "quality.minspeed", QUALITY_MINSPEED, (int, float))
+            print_debug(f"QUALITY_MINSPEED = {QUALITY_MINSPEED}")
+            BOND_ENABLE = dict_get(j, "bond.enable", BOND_ENABLE, bool)
+            print_debug(f"BOND_ENABLE = {BOND_ENABLE}")
+            BOND_MEMBERS = dict_get(j, "bond.members", BOND_MEMBERS, list)
+            accounts = [VPN_ACCOUNT, STANDBY_ACCOUNT]
+            for m in BOND_MEMBERS:
+                if not isinstance(m, dict) or not isinstance(m.get("account"), str) or not isinstance(m.get("nic"), str):
+                    print_error("LOAD_JSON", "Each of \"bond.members\" should have \"account\" and \"nic\"")
+                    err_exit()
+                if m["account"] in accounts:
+                    # 現用系・待機系とは別の接続設定でなければならない
+                    print_error("LOAD_JSON", f"VPN account \"{m['account']}\" in \"bond.members\" is already used")
+                    err_exit()
+                accounts.append(m["account"])
+            print_debug(f"BOND_MEMBERS = {BOND_MEMBERS}")
+            BOND_TABLE = dict_get(j, "bond.table", BOND_TABLE, int)
+            print_debug(f"BOND_TABLE = {BOND_TABLE}")
+            BOND_PRIORITY = dict_get(j, "bond.priority", BOND_PRIORITY, int)
+            print_debug(f"BOND_PRIORITY = {BOND_PRIORITY}")
+            BOND_INTERVAL = dict_get(j, "bond.interval", BOND_INTERVAL, (int, float))
+            print_debug(f"BOND_INTERVAL = {BOND_INTERVAL}")
+            BYPASS_ENABLE = dict_get(j, "bypass.enable", BYPASS_ENABLE, bool)
+            print_debug(f"BYPASS_ENABLE = {BYPASS_ENABLE}")
+            BYPASS_NETS = dict_get_strings(j, "bypass.nets", BYPASS_NETS)
+            print_debug(f"BYPASS_NETS = {BYPASS_NETS}")
+            BYPASS_NET_FILES = dict_get_strings(j, "bypass.net_files", BYPASS_NET_FILES)
+            print_debug(f"BYPASS_NET_FILES = {BYPASS_NET_FILES}")
+            BYPASS_DOMAINS = dict_get_strings(j, "bypass.domains", BYPASS_DOMAINS)
+            print_debug(f"BYPASS_DOMAINS = {BYPASS_DOMAINS}")
+            BYPASS_DOMAIN_FILES = dict_get_strings(j, "bypass.domain_files", BYPASS_DOMAIN_FILES)
+            print_debug(f"BYPASS_DOMAIN_FILES = {BYPASS_DOMAIN_FILES}")
+            BYPASS_INTERVAL = dict_get(j, "bypass.interval", BYPASS_INTERVAL, (int, float))
+            print_debug(f"BYPASS_INTERVAL = {BYPASS_INTERVAL}")
+            BYPASS_KEEP = dict_get(j, "bypass.keep", BYPASS_KEEP, (int, float))
+            print_debug(f"BYPASS_KEEP = {BYPASS_KEEP}")
+            BYPASS_TABLE = dict_get(j, "bypass.table", BYPASS_TABLE, int)
+            print_debug(f"BYPASS_TABLE = {BYPASS_TABLE}")
+            BYPASS_PRIORITY = dict_get(j, "bypass.priority", BYPASS_PRIORITY, int)
+            print_debug(f"BYPASS_PRIORITY = {BYPASS_PRIORITY}")
+            DNS_ENABLE = dict_get(j, "dns.enable", DNS_ENABLE, bool)
+            print_debug(f"DNS_ENABLE = {DNS_ENABLE}")
+            DNS_PORT = dict_get(j, "dns.port", DNS_PORT, int)
+            print_debug(f"DNS_PORT = {DNS_PORT}")
+            DNS_UPSTREAMS = dict_get_strings(j, "dns.upstreams", DNS_UPSTREAMS)
+            print_debug(f"DNS_UPSTREAMS = {DNS_UPSTREAMS}")
+            DNS_CACHE_SIZE = dict_get(j, "dns.cache_size", DNS_CACHE_SIZE, int)
+            print_debug(f"DNS_CACHE_SIZE = {DNS_CACHE_SIZE}")
+            DNS_TIMEOUT = dict_get(j, "dns.timeout", DNS_TIMEOUT, (int, float))
+            print_debug(f"DNS_TIMEOUT = {DNS_TIMEOUT}")
+            DNS_MAX_STALE = dict_get(j, "dns.max_stale", DNS_MAX_STALE, (int, float))
+            print_debug(f"DNS_MAX_STALE = {DNS_MAX_STALE}")
+            RESUME_ENABLE = dict_get(j, "resume.enable", RESUME_ENABLE, bool)
+            print_debug(f"RESUME_ENABLE = {RESUME_ENABLE}")
+            RESUME_MAXAGE = dict_get(j, "resume.maxage", RESUME_MAXAGE, int)
+            print_debug(f"RESUME_MAXAGE = {RESUME_MAXAGE}")
     except FileNotFoundError as e:
         print_error(
             "LOAD_JSON",
@@ -129,72 +714,183 @@ def dict_get(d: dict, key: str, default, expected_type):
         value = value[k]
     # 値が想定したtypeでない場合はエラー→終了
     if not isinstance(value, expected_type):
+        if isinstance(expected_type, tuple):
+            type_name = " or ".join(t.__name__ for t in expected_type)
+        else:
+            type_name = expected_type.__name__
         print_error(
             "LOAD_JSON",
-            f"The type of the value \"{key}\" should be \"{expected_type.__name__}\"",
+            f"The type of the value \"{key}\" should be \"{type_name}\"",
         )
         err_exit()
     return value
 
 
+def dict_get_numbers(d: dict, key: str, default: dict) -> dict:
+    """
+    数値を値に持つ辞書を得る．未指定のサブキーはdefaultの値を使う
+    """
+    value = dict_get(d, key, default, dict)
+    res = dict(default)
+    for (k, v) in value.items():
+        if k not in default:
+            print_error("LOAD_JSON", f"Unknown key \"{key}.{k}\"")
+            err_exit()
+        res[k] = dict_get(value, k, v, (int, float))
+    return res
+
+
+def dict_get_strings(d: dict, key: str, default: list) -> list[str]:
+    """
+    文字列のリストを得る
+    """
+    value = dict_get(d, key, default, list)
+    if not all(isinstance(v, str) for v in value):
+        print_error("LOAD_JSON", f"The values of \"{key}\" should be \"str\"")
+        err_exit()
+    return value
+
+
 def init():
     # IPマスカレードの設定
     print_log("Setting up IP masquerade...")
     nw_addr = get_nw(NIC_VPN)
-    res = runcmd(
-        [
-            "iptables",
-            "-t",
-            "nat",
-            "-A",
-            "POSTROUTING",
-            "-s",
-            nw_addr,
-            "-o",
-            NIC_VPNGATE,
-            "-j",
-            "MASQUERADE",
-        ]
-    )
-    if res.returncode != 0:
-        # IPアドレスの指定形式がおかしいなどの構文エラーの場合2
+    # 前回の実行で残った待機系・振り分け先の規則は，切替・追加時に重複しないよう消しておく
+    # 重複して残っている場合もあるため，なくなるまで消す(iptablesが応答を誤る場合に備えて回数は制限する)
+    for nic in dict.fromkeys([NIC_VPNGATE, STANDBY_NIC, *(m["nic"] for m in BOND_MEMBERS)]):
+        for _ in range(4):
+            if nic == vpn_nic or not net.has_masquerade(nw_addr, nic):
+                break
+            print_debug(f"Removing leftover IP masquerade for {nic}.")
+            if not set_masquerade(delete=[nic]):
+                break
+    if net.has_masquerade(nw_addr, vpn_nic):
+        print_debug("IP masquerade is already set up.")  # 前回の実行で残った規則をそのまま使う
+    elif not set_masquerade(add=[vpn_nic]):
+        # IPアドレスの指定形式がおかしいなどの構文エラーの場合
         # 存在しないNIC指定では正常終了
         # 通常発生し得ない
-        print_error(
-            "NAT Config",
-            f"iptables command failed. Error information is below.\n{res.stderr}",
-        )
         raise FatalErrException()
+    if bypass is not None:
+        bypass.setup()
+    if BOND_ENABLE:
+        bond_init()
 
 
 def clean(vpngateip):
     global is_connected
     is_connected = False
+    if standby is not None:
+        with standby.lock:
+            dhcp_release(standby.lease, nic=standby.nic)
+            standby.teardown()
+    for member in bond_members:
+        with member.lock:
+            dhcp_release(member.lease, nic=member.nic)
+            member.teardown()
+    if BOND_ENABLE:
+        bond_reset()
+    if bypass is not None:
+        bypass.reset()
+    dhcp_release(vpn_lease)  # 切断前にリースを返す
     ipreset(vpngateip)  # IP設定を解除
     vpn_disconnect()  # VPN切断
     # IPマスカレードの解除
     print_log("Cleaning IP masquerade setting...")
+    set_masquerade(delete=[vpn_nic])
+
+
+def set_masquerade(add: list[str] = (), delete: list[str] = ()) -> bool:
+    """
+    LANからaddのNICへ出る通信のIPマスカレードを追加し，deleteのNICへの分を削除する
+    """
     nw_addr = get_nw(NIC_VPN)
-    res = runcmd(
-        [
-            "iptables",
-            "-t",
-            "nat",
-            "-D",
-            "POSTROUTING",
-            "-s",
-            nw_addr,
-            "-o",
-            NIC_VPNGATE,
-            "-j",
-            "MASQUERADE",
-        ]
-    )
-    if res.returncode != 0:
-        print_error(
-            "NAT Reset",
-            f"iptables command failed. Error information is below.\n{res.stderr}",
-        )
+    try:
+        net.masquerade(nw_addr, add=add, delete=delete)
+    except OSError as e:
+        print_error("NAT Config" if add else "NAT Reset", e)
+        return False
+    return True
+
+
+def bond_init():
+    """
+    LANからの通信をBOND_TABLEの経路で振り分けるip ruleを設定する
+    mainテーブルの個別の経路(上流側のネットワークなど)は，デフォルトルート以外そのまま使う
+    """
+    bond_reset()  # 異常終了時の設定が残っている場合もあるため
+    set_sysctl("net/ipv4/fib_multipath_hash_policy", "1")  # ポート番号まで含めてフローを区別する
+    print_log("Setting up LAN load balancing...")
+    try:
+        net.rule_add(BOND_PRIORITY, netlink.RT_TABLE_MAIN, iif=NIC_VPN, suppress_prefixlength=0)
+        net.rule_add(BOND_PRIORITY + 1, BOND_TABLE, iif=NIC_VPN)
+    except OSError as e:
+        print_error("Bond", e)
+        raise FatalErrException()
+
+
+def bond_reset():
+    for (priority, table, selectors) in [
+        (BOND_PRIORITY, netlink.RT_TABLE_MAIN, {"iif": NIC_VPN, "suppress_prefixlength": 0}),
+        (BOND_PRIORITY + 1, BOND_TABLE, {"iif": NIC_VPN}),
+    ]:
+        try:
+            net.rule_del(priority, table, **selectors)
+        except OSError:
+            pass
+    try:
+        net.route_del_default(BOND_TABLE)
+    except OSError:
+        pass
+
+
+def update_bond_route():
+    """
+    接続中の現用系と振り分け先に入っている追加の接続へ，LANの通信をフロー単位で振り分ける
+    どれもない場合は経路を消し，mainテーブルのデフォルトルートに任せる
+    """
+    with bond_lock:
+        nexthops = [(m.gateway, m.nic) for m in bond_members if m.in_rotation]
+        if is_connected and vpn_gateway is not None:
+            nexthops.insert(0, (vpn_gateway, vpn_nic))
+        try:
+            if len(nexthops) > 0:
+                net.route_replace_multipath(nexthops, BOND_TABLE, onlink=True)
+            else:
+                net.route_del_default(BOND_TABLE)
+        except OSError as e:
+            print_error("Bond", e)
+            return
+        m_bond.set(len(nexthops))
+        print_debug(f"LAN flows are spread across {[nic for (_, nic) in nexthops]}")
+
+
+def servers_in_use() -> set[str]:
+    """
+    現用系・待機系・振り分け先が接続している中継サーバ
+    """
+    tunnels = [standby, migration_tunnel, *bond_members]
+    res = {t.ip for t in tunnels if t is not None and t.ip is not None}
+    if len(vpngate_ip_list) > 0:
+        res.add(vpngate_ip_list[-1])
+    return res
+
+
+def spare_account() -> (str, str):
+    """
+    待機系・移行先に使う接続設定名と仮想NIC
+    現用系が待機系の接続設定を使っている場合(前回の実行で切り替えていた場合)は，現用系のものと入れ替える
+    """
+    if vpn_account == STANDBY_ACCOUNT:
+        return (VPN_ACCOUNT, NIC_VPNGATE)
+    return (STANDBY_ACCOUNT, STANDBY_NIC)
+
+
+def set_sysctl(key: str, value: str):
+    try:
+        Path("/proc/sys").joinpath(key).write_text(value)
+    except OSError as e:
+        print_error("Sysctl", f"Could not set {key}. {e}")
 
 
 def set_td():
@@ -209,12 +905,12 @@ def get_td():
 
 
 def get_gw(nic: str):
-    res = runcmd(
-        ["ip", "route", "show", "default", "dev", str(nic)]
-    )
-    match = re.search(r"default via (\d+\.\d+\.\d+\.\d+)", res.stdout)
-    if match:
-        gateway_ip = match.group(1)
+    try:
+        gateway_ip = net.get_gw(str(nic))
+    except OSError as e:
+        print_debug(f"GetGwAddr: {e}")
+        gateway_ip = None
+    if gateway_ip is not None:
         print_log(f"Gateway address of {nic} is {gateway_ip}")
         return gateway_ip
     else:
@@ -229,12 +925,12 @@ def get_gw(nic: str):
 
 
 def get_nw(nic: str):
-    res = runcmd(
-        ["ip", "addr", "show", str(nic)]
-    )
-    match = re.search(r"inet (\d+\.\d+\.\d+\.\d+/\d+)", res.stdout)
-    if match:
-        nw_addr = str(ipaddress.IPv4Network(match.group(1), strict=False))
+    try:
+        nw_addr = net.get_nw(str(nic))
+    except OSError as e:
+        print_debug(f"GetNwAddr: {e}")
+        nw_addr = None
+    if nw_addr is not None:
         print_log(f"Network address of {nic} is {nw_addr}")
         return nw_addr
     else:
@@ -248,34 +944,317 @@ def get_nw(nic: str):
         raise FatalErrException()
 
 
-def status_check_worker():
-    global is_connected
+def status_check_worker(sid: int):
+    global last_healthy
     print_log("Status check process is running.")
-    while is_connected:
+    while is_connected and sid == session_id:
         (valid, status, s) = vpn_status("Session Status", log_disp_out=False)
         if valid and status == "Connection Completed (Session Established)":
+            last_healthy = time.monotonic()
             show_status(s)
             time.sleep(1)
             continue
         else:
-            if is_connected:
-                set_td()
-                print_error(
-                    "StatusCheck", "Connection error detected."
-                )
-                is_connected = False
-                status_error_event.set()
-                time.sleep(1)  # イベント発火を確実にさせる起こすため念のため
+            report_failure(sid, "session status", "status")
+            return
+
+
+def report_failure(sid: int, reason: str, source: str):
+    """
+    切断を検知したらフェイルオーバーを開始させる
+    複数の検知手段から呼ばれるため，同じ接続について一度だけ報告する
+
+    Args:
+        source (str): 検知手段(メトリクスのラベル)
+    """
+    global is_connected
+    with failure_lock:
+        if not is_connected or sid != session_id:
+            return
+        set_td()
+        print_error(
+            "StatusCheck", f"Connection error detected. ({reason})"
+        )
+        if last_healthy is not None:
+            m_detect.observe(time.monotonic() - last_healthy, source=source)
+        m_connected.set(0)
+        is_connected = False
+        publish_state(connected=False, status="Failover")
+        status_error_event.set()
+        if dns_forwarder is not None:
+            dns_forwarder.online = False  # 復旧までは上流を待たずにキャッシュから返す
+        if BOND_ENABLE:
+            update_bond_route()  # 復旧までは追加の接続だけで通信を続ける
+
+
+def link_monitor_worker():
+    """
+    netlinkで仮想NICのリンク状態とデフォルトルートの変化を購読し，即座に切断を検知する
+    上流NICのアドレスの変化も受け取り，配信する状態に反映する
+    """
+    try:
+        monitor = netlink.Monitor()
+    except OSError as e:
+        print_error("LinkMonitor", f"Could not subscribe netlink events. {e}")
+        return
+    refresh_upstream_ip()  # 購読を始めるまでの変化を取りこぼさない
+    for ev in monitor.events():
+        if is_upstream_event(ev):
+            refresh_upstream_ip()
+        if isinstance(ev, netlink.AddrEvent):
+            continue  # アドレスの変化は切断の検知に使わない
+        if isinstance(ev, netlink.LinkEvent) and ev.is_down():
+            for member in bond_members:
+                if ev.ifname == member.nic and member.ready.is_set():
+                    member.down.set()
+                    member.wake.set()  # 次の死活監視を待たずに振り分け先から外す
+        if not is_connected:
+            continue
+        sid = session_id
+        if isinstance(ev, netlink.LinkEvent):
+            if ev.ifname == vpn_nic and ev.is_down():
+                report_failure(sid, f"{vpn_nic} is down", "link")
+        elif ev.is_default_removed() and ev.table == 254:  # 254: mainテーブル
+            try:
+                index = socket.if_nametoindex(vpn_nic)
+            except OSError:
+                index = None
+            if ev.oif == index:
+                report_failure(sid, "default route removed", "route")
+
+
+def is_upstream_event(ev) -> bool:
+    if isinstance(ev, netlink.LinkEvent):
+        return ev.ifname == NIC_UPSTREAM
+    if isinstance(ev, netlink.AddrEvent):
+        try:
+            return ev.index == socket.if_nametoindex(NIC_UPSTREAM)
+        except OSError:
+            return False
+    return False
+
+
+def vpnclient_watch_worker():
+    """
+    vpnclientのプロセス終了をpidfdで待ち受け，即座に切断を検知する
+    """
+    while not stopping:
+        pid = find_vpnclient_pid()
+        if pid is None:
+            time.sleep(1)
+            continue
+        try:
+            fd = os.pidfd_open(pid)
+        except (OSError, AttributeError):
+            return  # pidfdが使えない環境では状態確認による検知に任せる
+        try:
+            select.select([fd], [], [])  # プロセス終了で読み込み可能になる
+        finally:
+            os.close(fd)
+        if is_connected:
+            report_failure(session_id, "vpnclient exited", "process")
+
+
+def find_vpnclient_pid() -> int:
+    vpnclient = os.path.join(os.path.dirname(VPNCMD_PATH), "vpnclient")
+    for pid in os.listdir("/proc"):
+        if not pid.isdigit():
+            continue
+        try:
+            if os.readlink(f"/proc/{pid}/exe") == vpnclient:
+                return int(pid)
+        except OSError:
+            continue
+    return None
+
+
+def gateway_probe_worker(sid: int, nic: str, gateway: str):
+    """
+    トンネル内のゲートウェイにpingを送り続け，連続で応答がなければ切断とみなす
+    ゲートウェイがpingに応答しない場合もあるため，一度応答を得てから監視を始める
+    """
+    global last_healthy
+    try:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_RAW, socket.IPPROTO_ICMP)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_BINDTODEVICE, nic.encode())
+    except OSError as e:
+        print_error("GatewayProbe", f"Could not open ICMP socket. {e}")
+        warn_quality_unmeasured("The gateway probe is not running.")
+        return
+    lost = 0
+    seq = 0
+    armed = False
+    with sock:
+        while is_connected and sid == session_id:
+            seq = (seq + 1) & 0xFFFF
+            start = time.monotonic()
+            rtt = icmp_echo(sock, gateway, seq, DETECT_INTERVAL)
+            if armed:
+                quality.add_rtt(rtt)
+            if rtt is not None:
+                last_healthy = time.monotonic()
+                armed = True
+                lost = 0
+            elif not armed:
+                # 送信に失敗した場合(ENETUNREACHなど)はすぐに戻るが，試行は間隔を空けて数える
+                if seq >= 20:
+                    print_log(f"Gateway {gateway} does not reply to ping. Probe disabled.")
+                    warn_quality_unmeasured("The gateway probe is disabled.")
+                    return
+            else:
+                lost += 1
+                if lost >= DETECT_THRESHOLD:
+                    report_failure(sid, f"no reply from {gateway}", "probe")
+                    return
+            time.sleep(max(0.0, DETECT_INTERVAL - (time.monotonic() - start)))
+
+
+def icmp_echo(sock: socket.socket, host: str, seq: int, timeout: float) -> float:
+    """
+    ICMP echoを送り，応答までの時間(ms)を返す．タイムアウトした場合はNone
+    """
+    ident = os.getpid() & 0xFFFF
+    payload = struct.pack("!d", time.monotonic())
+    header = struct.pack("!BBHHH", 8, 0, 0, ident, seq)
+    checksum = icmp_checksum(header + payload)
+    packet = struct.pack("!BBHHH", 8, 0, checksum, ident, seq) + payload
+    start = time.perf_counter()
+    try:
+        sock.sendto(packet, (host, 0))
+    except OSError:
+        return None
+    deadline = time.monotonic() + timeout
+    while True:
+        remain = deadline - time.monotonic()
+        if remain <= 0:
+            return None
+        (r, _, _) = select.select([sock], [], [], remain)
+        if not r:
+            return None
+        (data, addr) = sock.recvfrom(1024)
+        ihl = (data[0] & 0x0F) * 4  # IPヘッダ長
+        if len(data) < ihl + 8 or addr[0] != host:
+            continue
+        (kind, _, _, r_ident, r_seq) = struct.unpack("!BBHHH", data[ihl:ihl + 8])
+        if kind == 0 and r_ident == ident and r_seq == seq:
+            return (time.perf_counter() - start) * 1000
+
+
+def icmp_checksum(data: bytes) -> int:
+    if len(data) % 2:
+        data += b"\0"
+    total = sum(struct.unpack(f"!{len(data) // 2}H", data))
+    total = (total >> 16) + (total & 0xFFFF)
+    total += total >> 16
+    return ~total & 0xFFFF
+
+
+def warn_quality_unmeasured(reason: str):
+    """
+    品質の判定はgateway_probe_workerが集めるRTTだけを使うため，プローブが動かなければ移行は起こらない
+    """
+    if QUALITY_ENABLE:
+        print_error("Quality", f"{reason} In-session quality cannot be measured and no migration will be made.")
+
+
+def quality_monitor_worker(sid: int):
+    """
+    品質が基準を下回る状態がQUALITY_HOLD秒続いたら，移行先を用意して計画的な移行を要求する
+    切断は検知しない(report_failureによるフェイルオーバーとは別)
+    """
+    global last_migration
+    degraded_since = None
+    while is_connected and sid == session_id:
+        time.sleep(1)
+        res = quality.check()
+        if res is None:
+            if degraded_since is not None:
+                print_debug("Quality recovered.")
+            degraded_since = None
+            continue
+        (reason, detail) = res
+        now = time.monotonic()
+        if degraded_since is None:
+            print_debug(f"Quality degraded. ({detail})")
+            degraded_since = now
+        if now - degraded_since < QUALITY_HOLD:
+            continue
+        if last_migration is not None and now - last_migration < QUALITY_COOLDOWN:
+            continue
+        last_migration = now
+        degraded_since = None
+        print_log(f"Quality has been below the threshold for {QUALITY_HOLD:.0f}s. ({detail}) Preparing migration...")
+        prepare_migration(sid, reason)
+
+
+def prepare_migration(sid: int, reason: str):
+    """
+    移行先として待機系を接続する．待機系を使わない設定でも，待機系の接続設定・仮想NICで接続する
+    """
+    global migration_tunnel
+    global migrate_reason
+    tunnel = standby
+    if tunnel is None:
+        if migration_tunnel is None:
+            migration_tunnel = StandbyTunnel(*spare_account())
+        tunnel = migration_tunnel
+    with tunnel.lock:
+        try:
+            if not tunnel.ready.is_set() and not tunnel.prepare():
+                tunnel.teardown()
+        except FatalErrException:
+            tunnel.teardown()
+        if not tunnel.ready.is_set():
+            print_error("Migration", "Could not prepare a server to migrate to. Staying on the current server.")
             return
+    if is_connected and sid == session_id:
+        migrate_reason = reason
+        migrate_event.set()
+
+
+def migrate() -> bool:
+    """
+    用意した移行先に切り替える．元の接続はその後で切断する
+    """
+    tunnel = standby or migration_tunnel
+    if not is_connected or tunnel is None:
+        return False  # 移行前に切断された場合はフェイルオーバーに任せる
+    old = vpngate_ip_list[-1]
+    print_log("Migration started.")
+    set_td()
+    if not tunnel.promote():
+        print_error("Migration", "Migration target is not ready.")
+        return False
+    # 元の接続の異常(切替に伴うものを含む)はフェイルオーバーさせない
+    status_error_event.clear()
+    # 品質の低いサーバをしばらく選ばないよう，異常終了として記録する
+    reputation.record_session(old, time.time() - connected_at, failed=True)
+    m_migrations.inc(reason=migrate_reason)
+    return True
 
 
 def show_status(s: str):
+    global status_sample
     match1 = re.search(r"Outgoing Data Size\s*\|([\d,]+) bytes", s)
     match2 = re.search(r"Incoming Data Size\s*\|([\d,]+) bytes", s)
     if match1 and match2:
+        tx = int(match1.group(1).replace(',', ''))
+        rx = int(match2.group(1).replace(',', ''))
+        now = time.monotonic()
+        m_tx_bytes.set(tx)
+        m_rx_bytes.set(rx)
+        if status_sample is not None and now > status_sample[0]:
+            (t, prev_rx, prev_tx) = status_sample
+            rx_rate = max(0, rx - prev_rx) / (now - t)
+            tx_rate = max(0, tx - prev_tx) / (now - t)
+            m_rx_rate.set(rx_rate)
+            m_tx_rate.set(tx_rate)
+            quality.add_rate(rx_rate + tx_rate)
+            publish_state(rx_rate=round(rx_rate), tx_rate=round(tx_rate))
+        status_sample = (now, rx, tx)
         unit = ["bytes", "KB", "MB", "GB", "TB"]
-        dout = conv_datasize(int(match1.group(1).replace(',', '')), unit)
-        din = conv_datasize(int(match2.group(1).replace(',', '')), unit)
+        dout = conv_datasize(tx, unit)
+        din = conv_datasize(rx, unit)
         print_status(f"DL:{din}  UP:{dout}")
     else:
         print_error("StatusCheck", "Failed to parse data size.")
@@ -292,85 +1271,123 @@ def conv_datasize(i: int, unit: list[str]) -> str:
     return f"{i:.2f}{unit[index_unit]}"
 
 
-def dhcp_reobtain_worker():
-    counter: int = 0
-    while is_connected:
+def dhcp_reobtain_worker(sid: int):
+    """
+    リースのT1で更新する
+    失敗した場合は期限までの残り時間の半分ごとに再試行し，期限が切れたら切断とみなす
+    """
+    global vpn_lease
+    lease = vpn_lease
+    if lease is None:
+        return
+    next_at = lease.renew_at
+    while is_connected and sid == session_id:
         time.sleep(1)
-        counter += 1
-        if counter > 300:
-            counter = 0
-            print_debug("Reobtaining IP Address...")
-            dhcp(loop=False, log_disp_out=False)
+        now = time.monotonic()
+        if now < next_at:
+            continue
+        print_debug("Renewing DHCP lease...")
+        res = dhcp(loop=False, log_disp_out=False, lease=lease)
+        if res is not None and res.address == lease.address:
+            lease = res
+            if sid == session_id:
+                vpn_lease = res
+                save_session()
+            next_at = res.renew_at
+        elif res is not None:
+            report_failure(sid, f"DHCP address changed to {res.address}", "dhcp")
+            return
+        elif now >= lease.expire_at:
+            report_failure(sid, "DHCP lease expired", "dhcp")
+            return
+        else:
+            next_at = min(now + max(DHCP_RETRY_MIN, (lease.expire_at - now) / 2), lease.expire_at)
+
 
+def dhcp(loop: bool = True, log_disp_out: bool = True, nic: str = None, lease: "dhcpc.Lease" = None) -> "dhcpc.Lease":
+    """
+    DHCPでリースを得る．leaseを指定した場合はそのリースを更新する
 
-def dhcp(loop: bool = True, log_disp_out: bool = True) -> (str, str):
+    Args:
+        loop (bool): 得られるまで繰り返すか．Falseの場合，失敗したらNoneを返す
+    """
+    nic = nic or vpn_nic
     while True:
-        path = Path(__file__).resolve().parent.joinpath("lease.txt")
-        open(path, "w").close()  # lease情報の保存先を作成
-        res = runcmd(
-            ["dhclient", "-v", "-sf", "/bin/true", "-lf", str(path), "vpn_vpngate"],
-            log_disp_out=log_disp_out
-        )
-        if res.returncode != 0:
-            # NIC指定エラーや構文エラーなどはreturncodeが1
-            # DHCP取得エラーはreturncodeが0なのでキャッチできない
-            print_error(
-                "dhclient",
-                f"dhclient failed. Error information is below.\n{res.stderr}"
-            )
-            return (None, None)
-        # 情報抽出
-        with open(path, "r") as f:
-            lease_text = f.read()
-        if log_disp_out:
-            print_debug(f"DHCP Lease information\n{lease_text}")
-        fixed_address_match = re.search(r"fixed-address ([\d\.]+);", lease_text)
-        fixed_address = fixed_address_match.group(1) if fixed_address_match else None
-        routers_match = re.search(r"option routers ([\d\.]+);", lease_text)
-        routers = routers_match.group(1) if routers_match else None
-        if fixed_address is None or routers is None:
-            print_error("ParseDHCPData", "Obtained dhcp data was not valid.")
-            if loop:
-                continue
-        return (fixed_address, routers)
+        start = time.perf_counter()
+        try:
+            client = dhcpc.Client(nic, timeout=DHCP_TIMEOUT)
+            try:
+                res = client.renew(lease) if lease is not None else client.discover()
+            finally:
+                client.close()
+            m_dhcp.observe(time.perf_counter() - start, kind="renew" if lease is not None else "discover")
+        except OSError as e:
+            # NICが存在しない場合など
+            print_error("DHCP", f"DHCP on {nic} failed. {e}")
+            return None
+        if res is not None and res.router is not None:
+            if log_disp_out:
+                print_debug(f"DHCP Lease information: {res}")
+            return res
+        print_error("DHCP", f"Could not obtain a valid lease on {nic}.")
+        if not loop:
+            return None
+        time.sleep(1)
 
 
-def ipconfig(vpngateip: str):
-    # DHCPにてIP取得
-    print_log("Obtaining IP Address from vpngate server...")
-    (fixed_address, routers) = dhcp()
-    fixed_address += "/16"
-    print_log(f"Obtained IP: {fixed_address}  GW:{routers}")
-    # 上流NICのゲートウェイアドレス取得
-    gateway_ip = get_gw(NIC_UPSTREAM)
-    # 静的経路設定
-    res = runcmd(
-        ["ip", "route", "add", vpngateip, "via", gateway_ip, "dev", NIC_UPSTREAM]
-    )
-    if res.returncode != 0:
-        # NIC_UPSTREAMが存在しない場合, gateway_ipやvpngateipが異常の場合1
-        # gateway_ipがNexthopとして不適切，すでにvpngateipに対するルートが存在する場合2
-        # 発生したらプログラムを続行すべきでない
-        print_error(
-            "IP Route Add",
-            f"ip route add failed. Error information is below.\n{res.stderr}",
-        )
+def dhcp_release(lease: "dhcpc.Lease", nic: str = None):
+    """
+    終了時にリースをDHCPサーバへ返す．返せなくても終了処理は続ける
+    """
+    if lease is None:
+        return
+    nic = nic or vpn_nic
+    try:
+        client = dhcpc.Client(nic, timeout=DHCP_TIMEOUT)
+        try:
+            client.release(lease)
+        finally:
+            client.close()
+    except OSError as e:
+        print_error("DHCP", f"Could not release the lease on {nic}. {e}")
+
+
+def ipconfig(vpngateip: str, nic: str = None):
+    nic = nic or vpn_nic
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=1) as ex:
+        # 静的経路設定(DHCPとは独立しているため並行して行う)
+        relay = ex.submit(add_relay_route, vpngateip)
+        # DHCPにてIP取得
+        print_log("Obtaining IP Address from vpngate server...")
+        lease = dhcp(nic=nic)
+        relay.result()
+    if lease is None:
         raise FatalErrException()
+    print_log(f"Obtained IP: {lease.address}/{lease.prefixlen}  GW:{lease.router}")
+    global vpn_gateway
+    global vpn_lease
+    vpn_gateway = lease.router
+    vpn_lease = lease
     # IP設定
-    res = runcmd(["ip", "addr", "add", fixed_address, "dev", NIC_VPNGATE])
-    if res.returncode != 0:
-        print_error(
-            "IP Addr Add",
-            f"ip addr add failed. Error information is below.\n{res.stderr}",
-        )
+    try:
+        net.addr_add(nic, lease.address, lease.prefixlen)
+    except OSError as e:
+        print_error("IP Addr Add", e)
         raise FatalErrException()
-    res = runcmd(["ip", "route", "add", "default", "via", routers, "dev", NIC_VPNGATE])
-    if res.returncode != 0:
-        print_error(
-            "IP Route Add Default",
-            f"ip addr add default failed. Error information is below.\n{res.stderr}",
-        )
+    # 待機系から切り替えた経路が残っている場合もあるため置き換える
+    try:
+        net.route_replace_default(lease.router, nic)
+    except OSError as e:
+        print_error("IP Route Add Default", e)
         raise FatalErrException()
+    m_ipconfig.observe(time.perf_counter() - start)
+    # WAN IPは確認用のため，接続完了を待たせずに取得する
+    wi = Thread(target=show_wan_ip, daemon=True)
+    wi.start()
+
+
+def show_wan_ip():
     res = runcmd(["curl", "inet-ip.info"])
     if res.returncode != 0:
         print_error(
@@ -379,40 +1396,295 @@ def ipconfig(vpngateip: str):
     print_log(f"IP Configuration OK. WAN IP: {res.stdout}")
 
 
-def ipreset(vpngateip: str):
+def add_relay_route(vpngateip: str, replace: bool = False):
+    """
+    中継サーバ宛の通信をVPNを通さず上流NICから出す静的経路を設定する
+
+    Args:
+        replace (bool): 既存の経路を置き換えるか(前回の実行で設定した経路を引き継ぐ場合)
+    """
+    # 上流NICのゲートウェイアドレス取得
+    gateway_ip = get_gw(NIC_UPSTREAM)
+    try:
+        net.route_add(vpngateip, gateway_ip, NIC_UPSTREAM, replace=replace)
+    except OSError as e:
+        # NIC_UPSTREAMが存在しない場合, gateway_ipやvpngateipが異常の場合
+        # gateway_ipがNexthopとして不適切，すでにvpngateipに対するルートが存在する場合
+        # 発生したらプログラムを続行すべきでない
+        print_error("IP Route Add", e)
+        raise FatalErrException()
+
+
+def ipreset(vpngateip: str, nic: str = None):
+    nic = nic or vpn_nic
     print_log("Resetting IP setting...")
     # 静的経路設定解除
-    res = runcmd(["ip", "route", "del", vpngateip])
-    if res.returncode != 0:
-        print_error(
-            "IP Route Del",
-            f"ip route del failed. Error information is below.\n{res.stderr}",
-        )
+    try:
+        net.route_del(vpngateip)
+    except OSError as e:
+        print_error("IP Route Del", e)
     # IP解放
-    res = runcmd(["ip", "addr", "flush", "dev", NIC_VPNGATE])
-    if res.returncode != 0:
-        print_error(
-            "IP Addr Flush",
-            f"ip addr flush failed. Error information is below.\n{res.stderr}",
-        )
+    try:
+        net.addr_flush(nic)
+    except OSError as e:
+        print_error("IP Addr Flush", e)
 
 
-def get_bestserver() -> str:
+def adopt_session(saved: dict) -> bool:
+    """
+    前回の実行で確立したままのセッションを引き取る．アドレスと経路は同じものを設定し直す(設定済みなら変わらない)
+    セッションが確立していない場合，別のサーバに接続している場合，終了時に切断済みの場合はFalse
+    """
+    global vpngate_ip_list
+    global vpn_host
+    global vpn_gateway
+    global vpn_lease
+    if saved["clean"]:
+        return False
+    ip = saved["server"]
+    (valid, status, out) = vpn_status("Session Status")
+    server = re.search(rf"Server Name\s*\|\s*{re.escape(ip)}(?![\d.])", out)
+    if not valid or status != "Connection Completed (Session Established)" or server is None:
+        print_log("Previous session is not established. Reconnecting...")
+        return False
+    print_log(f"Adopting the established session. Server: {ip}")
+    add_relay_route(ip, replace=True)
+    lease = saved["lease"]
+    if time.monotonic() >= lease.expire_at:
+        lease = dhcp(loop=False)
+        if lease is None:
+            return False
+    try:
+        if net.get_addr(vpn_nic) != lease.address:
+            net.addr_flush(vpn_nic)
+            net.addr_add(vpn_nic, lease.address, lease.prefixlen)
+        net.route_replace_default(lease.router, vpn_nic)
+    except OSError as e:
+        print_error("Resume", e)
+        return False
+    vpngate_ip_list = [ip]
+    vpn_host = saved["host"]
+    vpn_gateway = lease.router
+    vpn_lease = lease
+    return True
+
+
+def discard_tunnels(tunnels: list[dict]):
+    """
+    前回の実行で残った接続({"account", "nic", "ip"})を切断し，アドレスと中継サーバへの経路を消す
+    """
+    for t in tunnels:
+        ipreset(t["ip"], nic=t["nic"])
+        vpn_disconnect(account=t["account"])
+
+
+def get_bestserver(exclude: set[str] = None, required: bool = True, probe: bool = True) -> list[str]:
+    """
+    接続候補のサーバを良い順に返す
+
+    Args:
+        exclude (set[str]): 追加で除外するサーバのIPアドレス
+        required (bool): 候補が見つからない場合に終了するか．Falseの場合は空のリストを返す
+        probe (bool): 接続遅延を計測するか．Falseの場合は採点結果の順に返す
+    """
+    return rank_candidates(find_candidates(exclude, required), probe)
+
+
+def find_candidates(exclude: set[str] = None, required: bool = True) -> list["ServerConnectInfo"]:
+    """
+    サーバリストから接続遅延を計測する候補を選ぶ．引数(exclude, required)はget_bestserverと同じ
+    """
     print_log("Getting best vpngate server...")
-    server_list = get_server_list()
-    if len(server_list) == 0:
+    table = get_server_list()
+    servers = table.select(
+        country=VPNGATE_COUNTRY,
+        ports=VPNGATE_PORT,
+        exclude_ops=VPNGATE_EXCEPTION_BY_OP,
+        exclude_ips=set(vpngate_ip_list) | (exclude or set()),  # 最後に接続していたサーバと接続失敗サーバは除外
+    )
+    # 最近失敗したサーバは除外．ただし全て除外される場合は除外しない
+    trusted = [s for s in servers if not reputation.is_blacklisted(s.ip)]
+    print_debug(f"{len(servers) - len(trusted)} servers are blacklisted by reputation.")
+    if len(trusted) > 0:
+        servers = trusted
+    candidates = ScoreEngine(SCORING_WEIGHTS, SCORING_CONSTRAINTS).top(servers, PROBE_COUNT)
+    if len(candidates) == 0:
         print_error("GetBestServer", "No server found.")
+        if not required:
+            return []
         # 利用可能なサーバが一つも存在しない場合
         # プログラムを続行すべきでない
         err_exit()
-    print_log(f"Done. {server_list[0]}")
-    return server_list[0].get_host()
+    return candidates
+
+
+def rank_candidates(candidates: list["ServerConnectInfo"], probe: bool = True) -> list[str]:
+    """
+    候補への接続遅延を計測し，良い順に接続先(IPアドレス:ポート)を返す
+    probeがFalseの場合は計測せず，採点結果の順(find_candidatesの順)のまま返す
+    """
+    if len(candidates) == 0:
+        return []
+    shortlist = probe_servers(candidates) if probe else candidates
+    print_log(f"Done. {shortlist[0]}")
+    return [s.get_host() for s in shortlist]
+
+
+def probe_servers(servers: list["ServerConnectInfo"]) -> list["ServerConnectInfo"]:
+    """
+    候補サーバへのTCP接続遅延を並列に計測し，採点結果と合わせて並べ替える
+    応答がなかったサーバは末尾に回す
+
+    Args:
+        servers (list[ServerConnectInfo]): ScoreEngineで採点済みの候補サーバ
+
+    Returns:
+        list[ServerConnectInfo]: 並べ替えた候補サーバ
+    """
+    if len(servers) <= 1:
+        return servers
+    print_log(f"Probing {len(servers)} servers...")
+    with ThreadPoolExecutor(max_workers=len(servers)) as ex:
+        rtts = list(ex.map(measure_rtt, servers))
+    for (sinfo, rtt) in zip(servers, rtts):
+        sinfo.rtt = rtt
+    reachable = [s for s in servers if s.rtt is not None]
+    unreachable = [s for s in servers if s.rtt is None]
+    if len(reachable) > 0:
+        max_rank = max(s.rank for s in reachable) or 1
+        timeout_ms = PROBE_TIMEOUT * 1000
+
+        def rank(s):
+            score_n = s.rank / max_rank
+            rtt_n = 1 - min(s.rtt, timeout_ms) / timeout_ms
+            return (1 - PROBE_RTT_WEIGHT) * score_n + PROBE_RTT_WEIGHT * rtt_n
+
+        reachable.sort(key=rank, reverse=True)
+    for s in reachable + unreachable:
+        print_debug(f"  RTT:{s.get_rtt()}ms {repr(s)}", banner=False)
+    return reachable + unreachable
+
+
+def measure_rtt(sinfo: "ServerConnectInfo") -> float:
+    """
+    TCP接続にかかった時間(ms)を返す．接続できなかった場合はNone
+    """
+    if sinfo.port is None:
+        return None
+    try:
+        start = time.perf_counter()
+        with socket.create_connection((sinfo.ip, sinfo.port), timeout=PROBE_TIMEOUT):
+            end = time.perf_counter()
+    except OSError:
+        return None
+    return (end - start) * 1000
+
+
+def qualify(vpngateip: str, nic: str = None) -> bool:
+    """
+    接続直後にトンネル経由の転送速度と遅延を計測し，基準を満たすか判定する
+    結果はサーバの接続実績に記録し，満たさないサーバにはペナルティを加える
+    計測先に問題がある場合にすべてのサーバを除外しないよう，計測できなかった場合は合格とする
+    """
+    nic = nic or vpn_nic
+    print_log("Measuring throughput...")
+    res = measure_throughput(nic)
+    if res is None:
+        print_error("Qualify", f"Could not measure throughput via {QUALIFY_URL}. Skipped.")
+        return True
+    (mbps, latency) = res
+    print_log(f"Throughput: {mbps:.1f}Mbps  Latency: {latency:.0f}ms")
+    reputation.record_throughput(vpngateip, mbps)
+    m_qualify.observe(mbps)
+    if mbps < QUALIFY_MINSPEED:
+        reason = "speed"
+    elif QUALIFY_MAXLATENCY > 0 and latency > QUALIFY_MAXLATENCY:
+        reason = "latency"
+    else:
+        return True
+    print_error("Qualify", f"{vpngateip} does not meet the {reason} requirement. Trying next server...")
+    reputation.add_penalty(vpngateip)
+    m_qualify_rejected.inc(reason=reason)
+    return False
+
+
+def measure_throughput(nic: str) -> (float, float):
+    """
+    QUALIFY_URLをnic経由で最大QUALIFY_DURATION秒だけ受信する
+    転送速度はヘッダ受信後の本文のみで計算し，TCP/TLSの確立にかかる時間を含めない
+
+    Returns:
+        (float, float): (転送速度(Mbps), TCP接続にかかった時間(ms))．計測できなかった場合はNone
+    """
+    u = urlsplit(QUALIFY_URL)
+    port = u.port or (443 if u.scheme == "https" else 80)
+    path = (u.path or "/") + (f"?{u.query}" if u.query else "")
+    buf = bytearray(65536)
+    try:
+        addr = socket.getaddrinfo(u.hostname, port, socket.AF_INET, socket.SOCK_STREAM)[0][4]
+        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as raw:
+            raw.setsockopt(socket.SOL_SOCKET, socket.SO_BINDTODEVICE, nic.encode())
+            raw.settimeout(QUALIFY_DURATION)
+            start = time.perf_counter()
+            raw.connect(addr)
+            latency = (time.perf_counter() - start) * 1000
+            sock = ssl.create_default_context().wrap_socket(raw, server_hostname=u.hostname) if u.scheme == "https" else raw
+            sock.sendall(f"GET {path} HTTP/1.1\r\nHost: {u.hostname}\r\nConnection: close\r\n\r\n".encode())
+            # ヘッダを読み，ステータスを確認する
+            head = b""
+            while b"\r\n\r\n" not in head:
+                n = sock.recv_into(buf)
+                if n == 0:
+                    return None
+                head += buf[:n]
+            (head, body) = head.split(b"\r\n\r\n", 1)
+            status = head.split(b" ", 2)[1]
+            if status != b"200":
+                print_debug(f"Throughput test returned HTTP {status.decode(errors='replace')}")
+                return None
+            received = len(body)
+            start = time.perf_counter()
+            deadline = start + QUALIFY_DURATION
+            while time.perf_counter() < deadline:
+                n = sock.recv_into(buf)
+                if n == 0:
+                    break
+                received += n
+            elapsed = time.perf_counter() - start
+    except (OSError, IndexError) as e:
+        print_debug(f"Throughput test failed. {e}")
+        return None
+    if elapsed <= 0:
+        return None
+    return (received * 8 / elapsed / 1e6, latency)
 
 
-def vpn_connect(host: str):
+def vpn_connect(hosts: list[str]) -> bool:
+    """
+    候補の上位から順に接続を試み，接続できたサーバをvpngate_ip_listの末尾に残す
+    """
+    global vpn_host
+    for host in hosts:
+        ip = host.split(":")[0]  # IPアドレス部分を抽出
+        vpngate_ip_list.append(ip)
+        sinfo = server_table.get(ip) if server_table is not None else None
+        publish_state(status="Connecting", server_ip=ip, server_name=sinfo.hostname if sinfo is not None else None)
+        start = time.perf_counter()
+        res = vpn_connect_host(host)
+        reputation.record_connect(ip, res, (time.perf_counter() - start) * 1000)
+        if res:
+            vpn_host = host
+            return True
+        print_error("VPNConnect", f"Could not connect to {host}. Trying next server...")
+        vpn_disconnect()  # 接続失敗時，クリーンして次の候補へ
+    return False
+
+
+def vpn_connect_host(host: str, account: str = None) -> bool:
+    account = account or vpn_account
     # 接続情報の設定
     print_log("Setting vpngate server address...")
-    res = runvpncmd(["accountset", "vpngate", f"/server:{host}", "/hub:vpngate"])
+    res = runvpncmd(["accountset", account, f"/server:{host}", "/hub:vpngate"])
     if errcheck_vpncmd_res(res):
         print_error(
             "VPNCMD_Set",
@@ -421,7 +1693,7 @@ def vpn_connect(host: str):
         raise FatalErrException()
     # 接続
     print_log("Connecting to vpngate server...")
-    res = runvpncmd(["accountconnect", "vpngate"])
+    res = runvpncmd(["accountconnect", account])
     if errcheck_vpncmd_res(res):
         print_error(
             "VPNCMD_Connect",
@@ -430,23 +1702,25 @@ def vpn_connect(host: str):
         raise FatalErrException()
     # 接続状況確認
     retry = 0
+    delays = backoff(CONNECT_TIMEOUT)
     while True:
         retry += 1
         print_log(f"Checking connection... Try:{retry}")
-        (valid, status, _) = vpn_status("Session Status")
+        (valid, status, _) = vpn_status("Session Status", account=account)
         if valid and status == "Connection Completed (Session Established)":
             return True  # 接続成功
-        elif retry >= 5:
+        delay = next(delays, None)
+        if delay is None:
             break
-        else:
-            time.sleep(1)
+        time.sleep(delay)
     return False  # 接続失敗
 
 
-def vpn_disconnect():
+def vpn_disconnect(account: str = None):
+    account = account or vpn_account
     # 切断
     print_log("Disconnecting from vpngate server...")
-    res = runvpncmd(["accountdisconnect", "vpngate"])
+    res = runvpncmd(["accountdisconnect", account])
     if errcheck_vpncmd_res(res):
         print_error(
             "VPNCMD_Disconnect",
@@ -454,17 +1728,34 @@ def vpn_disconnect():
         )
     # 接続状況確認
     print_log("Checking connection...")
+    delays = backoff(CONNECT_TIMEOUT)
     while True:
-        (valid, status, _) = vpn_status("Session Status")
+        (valid, status, _) = vpn_status("Session Status", account=account)
         if not valid:
             break
-        time.sleep(1)
+        time.sleep(next(delays, 1.0))
+
+
+def backoff(timeout: float, initial: float = 0.1, maximum: float = 1.0):
+    """
+    待ち時間を倍々に伸ばしながら返す．合計がtimeoutに達したら終わる
+    """
+    delay = initial
+    deadline = time.monotonic() + timeout
+    while True:
+        remain = deadline - time.monotonic()
+        if remain <= 0:
+            return
+        yield min(delay, remain)
+        delay = min(delay * 2, maximum)
 
 
-def runcmd(command: list[str], log_disp_out: bool = True) -> subprocess.CompletedProcess:
+def runcmd(command: list[str], log_disp_out: bool = True, input: str = None) -> subprocess.CompletedProcess:
     if log_disp_out:
         print_debug(f"RunCMD_args: {' '.join(command)}")
-    res = subprocess.run(command, check=False, capture_output=True, text=True)
+        if input is not None:
+            print_debug(f"RunCMD_stdin: {input}")
+    res = subprocess.run(command, check=False, capture_output=True, text=True, input=input)
     if log_disp_out:
         print_debug(f"RunCMD_stdout: {res.stdout}")
         print_debug(f"RunCMD_stderr: {res.stderr}")
@@ -473,8 +1764,10 @@ def runcmd(command: list[str], log_disp_out: bool = True) -> subprocess.Complete
 
 def runvpncmd(command: list[str], log_disp_out: bool = True) -> subprocess.CompletedProcess:
     global stopping
-    command = [VPNCMD_PATH, "localhost", "/client", "/cmd"] + command
-    res = runcmd(command, log_disp_out=log_disp_out)
+    global vpncmd_session
+    if vpncmd_session is None:
+        vpncmd_session = VpncmdSession(VPNCMD_PATH)
+    res = vpncmd_session.run(command, log_disp_out=log_disp_out)
     if not stopping and "(Error code: 1)" in res.stdout:
         print_error(
             "VPNCMD",
@@ -485,8 +1778,137 @@ def runvpncmd(command: list[str], log_disp_out: bool = True) -> subprocess.Compl
     return res
 
 
-def vpn_status(key: str, log_disp_out: bool = True) -> (bool, str, str):
-    res = runvpncmd(["accountstatusget", "vpngate"], log_disp_out=log_disp_out)
+class VpncmdSession:
+    """
+    vpncmdを対話モードで常駐させ，標準入力からコマンドを送って応答を得る
+    毎回プロセスを起動する代わりに，1回の往復でコマンドを実行できる
+    プロセスが終了していた場合は再起動してコマンドを再送する
+    vpnclientが停止している場合，再起動時の出力に"(Error code: 1)"が含まれるため，
+    runvpncmd側の再起動処理はそのまま機能する
+    全ての呼び出し元が1つのプロセスを順に使うため，状態・一覧の取得はquery_timeout秒で諦め，
+    応答しないプロセスは待たずに終了させて起動し直す
+    """
+    PROMPT: str = "VPN Client>"
+    QUERIES = {"accountstatusget", "accountlist", "accountget", "niclist", "versionget"}  # 状態・一覧の取得
+
+    def __init__(self, path: str, timeout: float = VPNCMD_TIMEOUT, query_timeout: float = VPNCMD_QUERY_TIMEOUT):
+        self.path = path
+        self.timeout = timeout
+        self.query_timeout = query_timeout
+        self.proc: subprocess.Popen = None
+        self.lock = Lock()
+
+    def run(self, command: list[str], log_disp_out: bool = True) -> subprocess.CompletedProcess:
+        line = " ".join(quote_vpncmd_arg(c) for c in command)
+        timeout = self.query_timeout if command[0].lower() in self.QUERIES else self.timeout
+        if log_disp_out:
+            print_debug(f"RunVPNCMD_args: {line}")
+        with self.lock:
+            for _ in range(2):  # プロセスが落ちていた場合のみ1回だけ再試行
+                if not self.is_alive():
+                    (alive, out) = self.start()
+                    if not alive:
+                        # 接続できない(vpnclient停止など)場合はその出力をそのまま返す
+                        res = subprocess.CompletedProcess(line, 1, out, "")
+                        break
+                (alive, out) = self.communicate(line, timeout)
+                res = subprocess.CompletedProcess(line, 0 if alive else 1, out, "")
+                if alive:
+                    break
+                print_error("VPNCMD", "vpncmd process exited unexpectedly. Restarting...")
+        if log_disp_out:
+            print_debug(f"RunVPNCMD_stdout: {res.stdout}")
+        return res
+
+    def start(self) -> (bool, str):
+        self.close()
+        print_debug("Starting vpncmd session...")
+        try:
+            self.proc = subprocess.Popen(
+                [self.path, "localhost", "/client"],
+                stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.STDOUT,
+                bufsize=0,
+            )
+        except OSError as e:
+            return (False, str(e))
+        return self.read_reply(self.timeout)
+
+    def communicate(self, line: str, timeout: float) -> (bool, str):
+        try:
+            self.proc.stdin.write(f"{line}\n".encode())
+            self.proc.stdin.flush()
+        except (BrokenPipeError, OSError):
+            return (False, "")
+        return self.read_reply(timeout)
+
+    def read_reply(self, timeout: float) -> (bool, str):
+        """
+        プロンプトが表示されるまで出力を読む
+
+        Returns:
+            bool: プロセスが生存しており，プロンプトまで読めたか
+            str: プロンプトを除いた出力
+        """
+        buf = b""
+        prompt = self.PROMPT.encode()
+        fd = self.proc.stdout.fileno()
+        deadline = time.monotonic() + timeout
+        while not buf.rstrip().endswith(prompt):
+            remain = deadline - time.monotonic()
+            if remain <= 0:
+                print_error("VPNCMD", f"vpncmd did not respond in {timeout:g}s. Killing it...")
+                self.kill()
+                return (False, buf.decode(errors="replace"))
+            (r, _, _) = select.select([fd], [], [], remain)
+            if not r:
+                continue
+            chunk = os.read(fd, 65536)
+            if not chunk:
+                # EOF: プロセスが終了した
+                self.proc.wait()
+                return (False, buf.decode(errors="replace"))
+            buf += chunk
+        out = buf.rstrip()[:-len(prompt)]
+        return (True, out.decode(errors="replace"))
+
+    def is_alive(self) -> bool:
+        return self.proc is not None and self.proc.poll() is None
+
+    def kill(self):
+        """
+        応答しないプロセスはexitも読まないため，待たずに終了させる
+        """
+        if self.proc is None:
+            return
+        self.proc.kill()
+        self.proc.wait()
+        self.proc = None
+
+    def close(self):
+        if self.proc is None:
+            return
+        if self.proc.poll() is None:
+            try:
+                self.proc.stdin.write(b"exit\n")
+                self.proc.stdin.flush()
+                self.proc.wait(timeout=1)
+            except (OSError, subprocess.TimeoutExpired):
+                self.proc.kill()
+                self.proc.wait()
+        self.proc = None
+
+
+def quote_vpncmd_arg(arg: str) -> str:
+    if " " in arg:
+        return f'"{arg}"'
+    return arg
+
+
+def vpn_status(key: str, log_disp_out: bool = True, account: str = None) -> (bool, str, str):
+    account = account or vpn_account
+    res = runvpncmd(["accountstatusget", account], log_disp_out=log_disp_out)
     match = re.search(rf"{re.escape(key)}\s*\|(.+)", res.stdout)
     if match:
         return (True, match.group(1).strip(), res.stdout)
@@ -500,30 +1922,232 @@ def errcheck_vpncmd_res(res: subprocess.CompletedProcess) -> bool:
     return True
 
 
-def get_server_list():
-    res = []
-    with requests.Session() as s:
+def serverlist_refresh_worker():
+    """
+    トンネルが正常な間，キャッシュが古くなったらサーバリストを取得し直す
+    フェイルオーバー時にはキャッシュをそのまま使うため，ダウンロードを待たない
+    """
+    session = None
+    while True:
+        serverlist_refresh_event.wait(timeout=10)
+        serverlist_refresh_event.clear()
+        if not is_connected:
+            continue
+        age = get_server_list_age()
+        if age is not None and age < SERVERLIST_MAXAGE:
+            continue
+        print_debug("Refreshing VPNGate server list cache.")
+        if session is None:
+            import requests  # 読み込みに時間がかかるため，起動時の接続が終わって最初に取得する時まで読み込まない
+            session = requests.Session()
+        if not fetch_server_list(session):
+            time.sleep(3)
+            serverlist_refresh_event.set()  # 失敗時は再試行
+
+
+def get_path(name: str) -> Path:
+    """
+    main.pyと同じディレクトリにあるファイルのパス
+    """
+    return Path(__file__).resolve().parent.joinpath(name)
+
+
+def save_session(clean: bool = False):
+    """
+    次の起動時に引き継ぐため，現用系のサーバ・リース・ネットワーク設定と，待機系・振り分け先の接続を保存する
+    cleanは終了時に切断・設定の解除まで行う場合．次の起動時は残った設定を調べずに同じサーバへ接続し直す
+    """
+    if not RESUME_ENABLE or not is_connected or vpn_lease is None:
+        return
+    tunnels = [t for t in [standby, migration_tunnel, *bond_members] if t is not None and t.ip is not None]
+    saved = {
+        "server": vpngate_ip_list[-1],
+        "host": vpn_host,
+        "account": vpn_account,
+        "nic": vpn_nic,
+        "lease": vpn_lease.dump(),
+        "tunnels": [{"account": t.account, "nic": t.nic, "ip": t.ip} for t in tunnels],
+        "clean": clean,
+        "saved_at": time.time(),
+    }
+    path = get_path(RESUME_STATE)
+    tmp = path.with_name(f"{path.name}.tmp")
+    with session_state_lock:
+        try:
+            with open(tmp, "w") as f:
+                json.dump(saved, f)
+            os.replace(tmp, path)
+        except OSError as e:
+            print_error("Resume", f"Could not save the session state. {e}")
+
+
+def load_session() -> dict:
+    """
+    前回の実行で保存したセッションを読み込む
+    ない場合，RESUME_MAXAGEより古い場合，接続設定が変わった場合，サーバが最近失敗している場合はNone
+    """
+    if not RESUME_ENABLE:
+        return None
+    try:
+        with open(get_path(RESUME_STATE), "r") as f:
+            saved = json.load(f)
+        age = time.time() - saved["saved_at"]
+        account = (saved["account"], saved["nic"])
+        (ip, host) = (saved["server"], saved["host"])
+        saved["lease"] = dhcpc.Lease.load(saved["lease"])
+        saved["tunnels"] = [{k: t[k] for k in ("account", "nic", "ip")} for t in saved["tunnels"]]
+        saved["clean"] = bool(saved["clean"])
+    except (FileNotFoundError, json.decoder.JSONDecodeError, KeyError, TypeError):
+        return None
+    if age > RESUME_MAXAGE:
+        print_debug(f"Previous session state is {int(age)}s old. Selecting a server again.")
+        return None
+    if account not in [(VPN_ACCOUNT, NIC_VPNGATE), (STANDBY_ACCOUNT, STANDBY_NIC)] or host is None:
+        return None
+    if reputation.is_blacklisted(ip):
+        print_debug(f"Previous server {ip} is blacklisted by reputation. Selecting a server again.")
+        return None
+    print_log(f"Resuming the previous session. Server: {host}")
+    return saved
+
+
+def load_server_list_meta() -> dict:
+    try:
+        with open(get_path(SERVERLIST_META), "r") as f:
+            return json.load(f)
+    except (FileNotFoundError, json.decoder.JSONDecodeError):
+        return {}
+
+
+def save_server_list_meta(meta: dict):
+    path = get_path(SERVERLIST_META)
+    tmp = path.with_name(f"{path.name}.tmp")
+    with open(tmp, "w") as f:
+        json.dump(meta, f)
+    os.replace(tmp, path)
+
+
+def get_server_list_age() -> float:
+    """
+    キャッシュの経過時間(秒)を返す．キャッシュがない場合はNone
+    """
+    if not get_path(SERVERLIST_CACHE).is_file():
+        return None
+    fetched_at = load_server_list_meta().get("fetched_at")
+    if fetched_at is None:
+        return None
+    return time.time() - fetched_at
+
+
+def fetch_server_list(session) -> bool:
+    """
+    サーバリストをダウンロードしてキャッシュに保存する
+    ETag/Last-Modifiedが保存されていれば条件付きで取得し，更新がなければ取得日時のみ更新する
+
+    Returns:
+        bool: 成功したか
+    """
+    with serverlist_lock:
+        meta = load_server_list_meta()
+        headers = {}
+        if get_path(SERVERLIST_CACHE).is_file():
+            if meta.get("etag"):
+                headers["If-None-Match"] = meta["etag"]
+            if meta.get("last_modified"):
+                headers["If-Modified-Since"] = meta["last_modified"]
+        try:
+            r = session.get(CSV_URL, headers=headers, timeout=30)
+            if r.status_code == 304:
+                print_debug("VPNGate server list not modified.")
+            elif r.status_code == 200:
+                path = get_path(SERVERLIST_CACHE)
+                tmp = path.with_name(f"{path.name}.tmp")
+                with open(tmp, "wb") as f:
+                    f.write(r.content)
+                os.replace(tmp, path)
+                meta["etag"] = r.headers.get("ETag")
+                meta["last_modified"] = r.headers.get("Last-Modified")
+            else:
+                print_error("GetServerListCSV", f"HTTP status {r.status_code}")
+                return False
+        except Exception as e:
+            print_error("GetServerListCSV", e)
+            return False
+        meta["fetched_at"] = time.time()
+        save_server_list_meta(meta)
+        return True
+
+
+def open_server_list():
+    """
+    キャッシュ済みのサーバリストを開く
+    キャッシュがない場合(初回起動時)のみ，取得できるまでダウンロードを繰り返す
+    """
+    age = get_server_list_age()
+    if age is None:
         print_debug("Getting VPNGate server list csv.")
-        while True:
-            try:
-                content = s.get(CSV_URL).content.decode("utf-8")
-                break  # contentをループ外で使うため
-            except Exception as e:
-                print_error("GetServerListCSV", e)
+        import requests
+        with requests.Session() as s:
+            while not fetch_server_list(s):
                 time.sleep(3)
-                continue
-        server_list = list(csv.reader(StringIO(content), delimiter=","))
-        # [0]HostName,[1]IP,[2]Score,[3]Ping,[4]Speed,
-        # [5]CountryLong,[6]CountryShort,[7]NumVpnSessions,[8]Uptime,
-        # [9]TotalUsers,[10]TotalTraffic,[11]LogType,[12]Operator,
-        # [13]Message,[14]OpenVPN_ConfigData_Base64
-        server_list = server_list[2:-1]  # 1,2行目と最終行は不要な情報
+    elif age >= SERVERLIST_MAXAGE:
+        # 古いキャッシュでもそのまま使い，更新はバックグラウンドで行う
+        print_log(f"Server list cache is {int(age)}s old. Using it anyway.")
+        serverlist_refresh_event.set()
+    # キャッシュはos.replaceで置き換えられるため，開いたファイルは読み終わるまで有効
+    return open(get_path(SERVERLIST_CACHE), "r", encoding="utf-8", newline="")
+
+
+def iter_server_rows(f):
+    """
+    サーバリストのCSVを1行ずつパースする
+    先頭の"*vpn_servers"，ヘッダ行"#HostName,..."，末尾の"*"は読み飛ばす
+    """
+    lines = (line for line in f if not line.startswith(("*", "#")))
+    # [0]HostName,[1]IP,[2]Score,[3]Ping,[4]Speed,
+    # [5]CountryLong,[6]CountryShort,[7]NumVpnSessions,[8]Uptime,
+    # [9]TotalUsers,[10]TotalTraffic,[11]LogType,[12]Operator,
+    # [13]Message,[14]OpenVPN_ConfigData_Base64
+    for row in csv.reader(lines, delimiter=","):
+        if len(row) >= 15:
+            yield row
+
+
+def get_server_list() -> "ServerTable":
+    """
+    キャッシュ済みのサーバリストをパースしてServerTableを返す
+    キャッシュが更新されていなければ，前回パースしたものを再利用する
+    設定で固定の条件(国，速度，OP)はパース時に除外し，
+    接続失敗サーバなど実行中に変わる条件はServerTable.topで除外する
+    """
+    global server_table
+    global server_table_key
+    with open_server_list() as f:
+        key = os.fstat(f.fileno()).st_mtime_ns
+        if server_table is not None and key == server_table_key:
+            print_debug("Server list not changed. Reusing parsed table.")
+            return server_table
+        res = []
+        debug = is_debug()  # 数千行あるため，ログに出さない場合は整形もしない
         print_debug("▼ServerList")
-        for s in server_list:
+        for s in iter_server_rows(f):
+            # OpenVPN設定のデコードが不要な条件で先に除外する
+            noadd = False
+            if VPNGATE_COUNTRY is not None and s[6] != VPNGATE_COUNTRY:
+                noadd = True
+            elif VPNGATE_MINSPEED > 0 and (str2int(s[4]) or 0) / 1000000 < VPNGATE_MINSPEED:
+                noadd = True
+            elif len(VPNGATE_EXCEPTION_BY_OP) > 0 and s[12] in VPNGATE_EXCEPTION_BY_OP:
+                # OPで除外リストに追加されている場合，それを除外
+                noadd = True
+            if noadd:
+                if DEBUG:
+                    print_debug(f"X {s[0]} {s[1]} ({s[6]}) OP:{s[12]}", banner=False)
+                continue
             sinfo = ServerConnectInfo(
                 s[0],  # hostname
                 s[1],  # ip
-                get_port_from_openvpn(s[14]),  # port
+                None,  # port(必要になった時点でOpenVPN設定からデコード)
                 str2int(s[2]),  # score
                 str2int(s[3]),  # ping
                 str2int(s[4]),  # speed
@@ -531,27 +2155,14 @@ def get_server_list():
                 str2int(s[7]),  # num_vpn_sessions
                 str2int(s[8]),  # uptime
                 s[12],  # operator
+                openvpn_config=s[14],
             )
-            noadd = False
-            if VPNGATE_COUNTRY is not None and sinfo.country != VPNGATE_COUNTRY:
-                noadd = True
-            if len(VPNGATE_PORT) > 0 and sinfo.port not in VPNGATE_PORT:
-                noadd = True
-            if VPNGATE_MINSPEED > 0 and sinfo.speed / 1000000 < VPNGATE_MINSPEED:
-                noadd = True
-            if len(VPNGATE_EXCEPTION_BY_OP) > 0 and sinfo.operator in VPNGATE_EXCEPTION_BY_OP:
-                # OPで除外リストに追加されている場合，それを除外
-                noadd = True
-            if len(vpngate_ip_list) > 0 and sinfo.ip in vpngate_ip_list:
-                # 最後に接続していたサーバと接続失敗サーバは除外
-                noadd = True
-            if noadd:
-                print_debug(f"X {repr(sinfo)}", banner=False)
-            else:
-                res.append(sinfo)
+            res.append(sinfo)
+            if debug:
                 print_debug(f"  {repr(sinfo)}", banner=False)
-        res.sort(key=lambda x: x.score, reverse=True)
-        return res
+    server_table = ServerTable(res)
+    server_table_key = key
+    return server_table
 
 
 def str2int(s: str) -> int:
@@ -585,7 +2196,620 @@ def get_port_from_openvpn(base64str):
     return None
 
 
+class StandbyTunnel:
+    """
+    待機系のVPN接続
+    現用系とは別の接続設定・仮想NICで次点のサーバに接続し，DHCPでIPアドレスまで取得しておく
+    現用系の切断時は，デフォルトルートとIPマスカレードを付け替えるだけで切り替えられる
+    切替後は元の現用系の接続設定・仮想NICを引き取り，次の待機系を準備する
+    """
+    role = "standby"  # ログに出す名前
+
+    def __init__(self, account: str, nic: str):
+        self.account = account
+        self.nic = nic
+        self.ip: str = None  # 接続中の中継サーバ
+        self.host: str = None  # 接続中の中継サーバ(IPアドレス:ポート)
+        self.address: str = None
+        self.gateway: str = None
+        self.lease = None  # dhcpc.Lease
+        self.ready = Event()  # 切替可能な状態か
+        self.wake = Event()  # 準備・監視を即座に行う要求
+        self.lock = Lock()
+
+    def worker(self):
+        print_log(f"Standby process is running on {self.nic}.")
+        while not stopping:
+            if self.wake.wait(timeout=STANDBY_INTERVAL):
+                self.wake.clear()
+            if not is_connected:
+                continue  # 現用系の接続処理中は待機系を用意しない
+            with self.lock:
+                try:
+                    if not self.ready.is_set():
+                        if not self.prepare():
+                            self.teardown()
+                    elif not self.is_alive():
+                        print_error("Standby", "Standby connection error detected.")
+                        self.teardown()
+                        self.wake.set()
+                    elif time.monotonic() >= self.lease.renew_at and not self.renew():
+                        # 待機系は作り直せばよいため，更新できなければ破棄する
+                        self.teardown()
+                        self.wake.set()
+                except FatalErrException:
+                    self.teardown()
+
+    def renew(self) -> bool:
+        """
+        DHCPリースを更新する．更新できないか，アドレスが変わった場合はFalse
+        """
+        print_debug(f"Renewing {self.role} DHCP lease...")
+        lease = dhcp(loop=False, log_disp_out=False, nic=self.nic, lease=self.lease)
+        if lease is None or lease.address != self.address:
+            print_error(self.role.capitalize(), f"Could not renew {self.role} DHCP lease.")
+            return False
+        self.lease = lease
+        return True
+
+    def prepare(self) -> bool:
+        """
+        待機系を接続し，IPアドレスを設定する．デフォルトルートは設定しない
+        """
+        print_log(f"Preparing {self.role} connection...")
+        # 現用系の接続中はデフォルトルートがVPN側のため，接続遅延を計測すると中継サーバまでの遅延に
+        # 現用系のトンネルの遅延が加わって順位が歪む．計測せずに採点結果の順で選ぶ
+        hosts = get_bestserver(exclude=servers_in_use(), required=False, probe=False)
+        for host in hosts:
+            ip = host.split(":")[0]
+            with claim_lock:
+                if ip in servers_in_use():
+                    continue  # 並行して準備している他の接続が選んだ
+                (self.ip, self.host) = (ip, host)
+            # 現用系のVPNを経由せずに接続するため，接続前に中継サーバへの静的経路を設定
+            add_relay_route(ip)
+            start = time.perf_counter()
+            res = vpn_connect_host(host, account=self.account)
+            reputation.record_connect(ip, res, (time.perf_counter() - start) * 1000)
+            if res:
+                break
+            print_error(self.role.capitalize(), f"Could not connect to {host}. Trying next server...")
+            self.teardown()
+        else:
+            return False
+        lease = dhcp(loop=False, nic=self.nic)
+        if lease is None:
+            return False
+        # 現用系と同じネットワークになるため，接続経路は作らない
+        try:
+            net.addr_add(self.nic, lease.address, lease.prefixlen, noprefixroute=True)
+        except OSError as e:
+            print_error("IP Addr Add", e)
+            return False
+        self.address = lease.address
+        self.gateway = lease.router
+        self.lease = lease
+        self.ready.set()
+        print_log(f"{self.role.capitalize()} ready. Server: {self.ip}  IP: {lease.address}  GW: {lease.router}")
+        save_session()  # 異常終了した場合に，次の起動時に片付けるため
+        return True
+
+    def is_alive(self) -> bool:
+        (valid, status, _) = vpn_status("Session Status", log_disp_out=False, account=self.account)
+        return valid and status == "Connection Completed (Session Established)"
+
+    def teardown(self):
+        self.ready.clear()
+        if self.ip is None:
+            return
+        ipreset(self.ip, nic=self.nic)
+        vpn_disconnect(account=self.account)
+        self.ip = None
+        self.host = None
+        self.address = None
+        self.gateway = None
+        self.lease = None
+
+    def promote(self) -> bool:
+        """
+        待機系を現用系に切り替える．待機系が用意できていない場合はFalse
+        """
+        global vpn_account
+        global vpn_nic
+        global vpn_gateway
+        global vpn_lease
+        global vpngate_ip_list
+        global vpn_host
+        if not self.lock.acquire(timeout=0.5):
+            return False  # 待機系の準備中
+        try:
+            if not self.ready.is_set():
+                return False
+            print_log(f"Switching to standby connection on {self.nic}...")
+            try:
+                net.route_replace_default(self.gateway, self.nic, onlink=True)
+            except OSError as e:
+                print_error("IP Route Replace Default", e)
+                return False
+            # 付け替えは1つのトランザクションのため，失敗した場合は何も適用されていない
+            # 削除する規則が既にない場合もあるため，追加だけでやり直す
+            if not (set_masquerade(add=[self.nic], delete=[vpn_nic]) or set_masquerade(add=[self.nic])):
+                # LANの通信がNATされずに出ていかないよう，経路を元の現用系に戻す
+                try:
+                    net.route_replace_default(vpn_gateway, vpn_nic)
+                except OSError as e:
+                    print_error("IP Route Replace Default", e)
+                return False
+            (old_ip, old_account, old_nic) = (vpngate_ip_list[-1], vpn_account, vpn_nic)
+            (vpn_account, vpn_nic, vpn_gateway, vpn_lease) = (self.account, self.nic, self.gateway, self.lease)
+            vpngate_ip_list = [self.ip]
+            vpn_host = self.host
+            # 元の現用系の接続設定・仮想NICを次の待機系に使う
+            (self.account, self.nic) = (old_account, old_nic)
+            self.ready.clear()
+            self.ip = old_ip  # teardownで元の現用系を片付けるため
+        finally:
+            self.lock.release()
+        Thread(target=self.retire, daemon=True).start()
+        return True
+
+    def retire(self):
+        """
+        切替後，元の現用系を切断する
+        """
+        with self.lock:
+            self.teardown()
+        self.wake.set()
+
+
+class BondMember(StandbyTunnel):
+    """
+    LANの通信の振り分け先として，現用系に加えて維持するVPN接続
+    待機系と同じく別の接続設定・仮想NICで接続し，自身の経路表にデフォルトルートを持つ
+    死活監視に失敗したら振り分け先から外し，別のサーバに接続し直す
+    """
+    role = "bond member"
+
+    def __init__(self, account: str, nic: str, table: int):
+        super().__init__(account, nic)
+        self.table = table
+        self.in_rotation = False  # 振り分け先に入っているか
+        self.joined_at: float = None  # 振り分け先に加えた時刻(time.time())
+        self.armed = False  # ゲートウェイがpingに応答したことがあるか
+        self.down = Event()  # 仮想NICのリンクが落ちた
+
+    def worker(self):
+        print_log(f"Bond member process is running on {self.nic}.")
+        while not stopping:
+            if self.wake.wait(timeout=BOND_INTERVAL):
+                self.wake.clear()
+            with self.lock:
+                try:
+                    if not self.ready.is_set():
+                        # 現用系の接続処理中は，同じサーバを選ばないよう新たに接続しない
+                        if is_connected and not (self.prepare() and self.join()):
+                            self.teardown()
+                    elif not self.is_healthy():
+                        print_error("Bond", f"Health check failed on {self.nic}. Removing it from rotation.")
+                        reputation.record_session(self.ip, time.time() - self.joined_at, failed=True)
+                        self.teardown()
+                        self.wake.set()
+                    elif time.monotonic() >= self.lease.renew_at and not self.renew():
+                        self.teardown()
+                        self.wake.set()
+                except FatalErrException:
+                    self.teardown()
+
+    def join(self) -> bool:
+        """
+        自身の経路表とip rule，IPマスカレードを設定し，振り分け先に加える
+        アドレスから送る通信(応答を含む)と，仮想NICに結び付けたソケットの通信は自身の経路表を引く
+        """
+        self.leave()  # 異常終了時の設定が残っている場合もあるため
+        try:
+            net.route_replace_default(self.gateway, self.nic, onlink=True, table=self.table)
+            for selectors in self.rule_selectors():
+                net.rule_add(BOND_PRIORITY + 2, self.table, **selectors)
+        except OSError as e:
+            print_error("Bond", e)
+            return False
+        if not set_masquerade(add=[self.nic]):
+            return False
+        self.down.clear()
+        self.in_rotation = True
+        self.joined_at = time.time()
+        update_bond_route()
+        print_log(f"Added {self.nic} to rotation.")
+        return True
+
+    def leave(self):
+        """
+        振り分け先から外し，joinの設定を解除する
+        """
+        if self.in_rotation:
+            self.in_rotation = False
+            update_bond_route()
+            set_masquerade(delete=[self.nic])
+        for selectors in self.rule_selectors():
+            try:
+                net.rule_del(BOND_PRIORITY + 2, self.table, **selectors)
+            except OSError:
+                pass
+        try:
+            net.route_del_default(self.table)
+        except OSError:
+            pass
+
+    def rule_selectors(self) -> list[dict]:
+        res = [{"oif": self.nic}]
+        if self.address is not None:
+            res.append({"src": self.address})
+        return res
+
+    def is_healthy(self) -> bool:
+        """
+        セッションの状態と，トンネル内のゲートウェイへのpingで判定する
+        pingに一度も応答していないゲートウェイは，セッションの状態だけで判定する
+        """
+        if self.down.is_set() or not self.is_alive():
+            return False
+        try:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_RAW, socket.IPPROTO_ICMP)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_BINDTODEVICE, self.nic.encode())
+        except OSError:
+            return True
+        with sock:
+            for seq in range(1, DETECT_THRESHOLD + 1):
+                if icmp_echo(sock, self.gateway, seq, DETECT_INTERVAL) is not None:
+                    self.armed = True
+                    return True
+        return not self.armed
+
+    def teardown(self):
+        if self.ready.is_set():
+            self.leave()
+        self.armed = False
+        super().teardown()
+
+
+class QualityMonitor:
+    """
+    接続中の品質を直近QUALITY_WINDOW秒で集計する
+    RTTと損失はgateway_probe_workerのping，転送速度はshow_statusの受信・送信量から得る
+    転送量は利用者の通信量次第のため，転送速度はRTTが増えて転送が詰まっている時だけ判定する
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.rtts: deque[tuple[float, float]] = deque()  # (時刻, RTT(ms)．損失はNone)
+        self.rates: deque[tuple[float, float]] = deque()  # (時刻, 受信+送信(bytes/s))
+        self.rtt_min: float = None  # 接続中の最小RTT(ms)
+
+    def reset(self):
+        with self.lock:
+            self.rtts.clear()
+            self.rates.clear()
+            self.rtt_min = None
+
+    def add_rtt(self, rtt: float):
+        with self.lock:
+            self.rtts.append((time.monotonic(), rtt))
+            if rtt is not None and (self.rtt_min is None or rtt < self.rtt_min):
+                self.rtt_min = rtt
+
+    def add_rate(self, rate: float):
+        with self.lock:
+            self.rates.append((time.monotonic(), rate))
+
+    def check(self) -> (str, str):
+        """
+        基準を下回っているかを判定する．標本が足りない場合は判定しない
+
+        Returns:
+            (str, str): 下回った基準(loss, rtt, throughput)と詳細．下回っていない場合はNone
+        """
+        now = time.monotonic()
+        with self.lock:
+            for q in (self.rtts, self.rates):
+                while len(q) > 0 and q[0][0] < now - QUALITY_WINDOW:
+                    q.popleft()
+            rtts = [r for (_, r) in self.rtts]
+            rates = [r for (_, r) in self.rates]
+            rtt_min = self.rtt_min
+        if len(rtts) < 10:
+            return None
+        replies = [r for r in rtts if r is not None]
+        loss = 1 - len(replies) / len(rtts)
+        rtt = sum(replies) / len(replies) if len(replies) > 0 else None
+        m_loss.set(loss)
+        if rtt is not None:
+            m_rtt.set(rtt / 1000)
+        if QUALITY_MAXLOSS > 0 and loss > QUALITY_MAXLOSS:
+            return ("loss", f"loss {loss:.0%}")
+        if rtt is None:
+            return None
+        if QUALITY_MAXRTT > 0 and rtt > QUALITY_MAXRTT:
+            return ("rtt", f"RTT {rtt:.0f}ms")
+        if QUALITY_MINSPEED > 0 and len(rates) > 0 and rtt >= rtt_min * QUALITY_SATURATION:
+            mbps = sum(rates) / len(rates) * 8 / 1e6
+            if 0 < mbps < QUALITY_MINSPEED:
+                return ("throughput", f"{mbps:.2f}Mbps at RTT {rtt:.0f}ms")
+        return None
+
+
+class SplitTunnel:
+    """
+    指定した宛先へのLANの通信を，VPNを通さず上流NICから直接出す(スプリットトンネル)
+    宛先はnftablesの集合(CIDRはnets，名前解決したアドレスはhosts)に入れ，集合の照合はカーネルで行う
+    LANからの新しい接続の宛先が集合に含まれていればconntrackにマークを付け，その接続のパケットには
+    fwmarkを付ける．fwmarkのip ruleでBYPASS_TABLEを引き，上流NICからIPマスカレードして出る
+    マークは接続単位のため，集合から外れた宛先との通信中の接続も途切れない
+    集合と規則は仮想NICと無関係のため，フェイルオーバーでは変更しない
+    """
+
+    def __init__(self):
+        self.nets: set[str] = set()  # 集合に入れたCIDR
+        self.hosts: set[str] = set()  # 集合に入れたアドレス
+        self.seen: dict[str, float] = {}  # 名前解決で得たアドレス: 最後に得た時刻(time.monotonic())
+        self.gateway: str = None  # BYPASS_TABLEに設定した上流NICのゲートウェイ
+
+    def setup(self):
+        """
+        nftablesのテーブルを作り直し，ip ruleと経路を設定する．名前解決はworkerで行う
+        """
+        print_log("Setting up split tunneling...")
+        nets = self.load_nets() or set()
+        mark = BYPASS_TABLE
+        script = [
+            # 異常終了時のテーブルが残っている場合もあるため，作ってから消して作り直す(全体で1つのトランザクション)
+            f"table ip {NFT_TABLE}",
+            f"delete table ip {NFT_TABLE}",
+            f"table ip {NFT_TABLE} {{",
+            "    set nets { type ipv4_addr; flags interval; }",
+            "    set hosts { type ipv4_addr; }",
+            "    chain prerouting {",
+            "        type filter hook prerouting priority mangle; policy accept;",
+            f"        iifname \"{NIC_VPN}\" ct state new ip daddr @nets ct mark set {mark}",
+            f"        iifname \"{NIC_VPN}\" ct state new ip daddr @hosts ct mark set {mark}",
+            f"        iifname \"{NIC_VPN}\" ct mark {mark} meta mark set {mark}",
+            "    }",
+            "    chain postrouting {",
+            "        type nat hook postrouting priority srcnat; policy accept;",
+            f"        oifname \"{NIC_UPSTREAM}\" meta mark {mark} masquerade",
+            "    }",
+            "}",
+            *self.elements("add", "nets", nets),
+        ]
+        try:
+            net.nft("\n".join(script) + "\n")
+        except OSError as e:
+            print_error("Bypass", e)
+            raise FatalErrException()
+        self.nets = nets
+        self.hosts = set()
+        m_bypass.set(len(nets), set="nets")
+        m_bypass.set(0, set="hosts")
+        self.gateway = get_gw(NIC_UPSTREAM)
+        try:
+            net.route_replace_default(self.gateway, NIC_UPSTREAM, table=BYPASS_TABLE)
+            try:
+                net.rule_del(BYPASS_PRIORITY, BYPASS_TABLE, fwmark=mark)
+            except OSError:
+                pass
+            net.rule_add(BYPASS_PRIORITY, BYPASS_TABLE, fwmark=mark)
+        except OSError as e:
+            print_error("Bypass", e)
+            raise FatalErrException()
+        # 応答は上流NICから戻るが，mainテーブルのデフォルトルートはVPN側のため，経路の向きを厳密に検査しない
+        set_sysctl(f"net/ipv4/conf/{NIC_UPSTREAM}/rp_filter", "2")
+        print_log(f"Split tunneling ready. {len(nets)} networks bypass the VPN.")
+
+    def reset(self):
+        try:
+            net.rule_del(BYPASS_PRIORITY, BYPASS_TABLE, fwmark=BYPASS_TABLE)
+        except OSError:
+            pass
+        try:
+            net.route_del_default(BYPASS_TABLE)
+        except OSError:
+            pass
+        try:
+            net.nft(f"delete table ip {NFT_TABLE}\n")
+        except OSError as e:
+            print_error("Bypass", e)
+
+    def worker(self):
+        """
+        BYPASS_INTERVALごとにファイルを読み直して名前解決し，集合を差分で更新する
+        """
+        while not stopping:
+            self.refresh()
+            time.sleep(BYPASS_INTERVAL)
+
+    def refresh(self):
+        """
+        集合の追加・削除をまとめて1つのトランザクションで適用する
+        失敗した場合はどちらの集合も変わらないため，次回に同じ差分を適用し直す
+        """
+        nets = self.load_nets()
+        if nets is None:
+            nets = self.nets  # 読めないファイルがある場合は，CIDRの集合はそのまま
+        now = time.monotonic()
+        for ip in self.resolve(self.load_domains()):
+            self.seen[ip] = now
+        # DNSの応答ごとにアドレスが入れ替わる場合もあるため，しばらく得られなかったアドレスだけ外す
+        self.seen = {ip: t for (ip, t) in self.seen.items() if now - t <= BYPASS_KEEP}
+        hosts = set(self.seen)
+        script = [
+            *self.elements("delete", "nets", self.nets - nets),
+            *self.elements("add", "nets", nets - self.nets),
+            *self.elements("delete", "hosts", self.hosts - hosts),
+            *self.elements("add", "hosts", hosts - self.hosts),
+        ]
+        if len(script) > 0:
+            try:
+                net.nft("\n".join(script) + "\n")
+            except OSError as e:
+                print_error("Bypass", e)
+                return
+            print_debug(
+                f"Bypass sets updated. nets: +{len(nets - self.nets)} -{len(self.nets - nets)}  "
+                f"hosts: +{len(hosts - self.hosts)} -{len(self.hosts - hosts)}"
+            )
+            (self.nets, self.hosts) = (nets, hosts)
+        m_bypass.set(len(self.nets), set="nets")
+        m_bypass.set(len(self.hosts), set="hosts")
+        self.update_route()
+
+    def update_route(self):
+        """
+        上流NICのゲートウェイが変わっていたらBYPASS_TABLEの経路を置き換える
+        """
+        try:
+            gateway = net.get_gw(NIC_UPSTREAM)
+            if gateway is not None and gateway != self.gateway:
+                net.route_replace_default(gateway, NIC_UPSTREAM, table=BYPASS_TABLE)
+                print_log(f"Bypass gateway changed to {gateway}")
+                self.gateway = gateway
+        except OSError as e:
+            print_error("Bypass", e)
+
+    @staticmethod
+    def elements(op: str, name: str, items: set[str]) -> list[str]:
+        items = sorted(items)
+        return [
+            f"{op} element ip {NFT_TABLE} {name} {{ {', '.join(items[i:i + 1000])} }}"
+            for i in range(0, len(items), 1000)
+        ]
+
+    @staticmethod
+    def read_lines(name: str) -> list[str]:
+        """
+        ファイルから空行と#以降を除いた行を読む．相対パスはmain.pyのディレクトリから
+        """
+        res = []
+        with open(get_path(name), "r", encoding="utf-8") as f:
+            for line in f:
+                line = line.split("#")[0].strip()
+                if line:
+                    res.append(line)
+        return res
+
+    def load_nets(self) -> set[str]:
+        """
+        CIDRを重複・隣接をまとめた形で返す(集合の要素が重ならないようにするため)
+        読めないファイルがある場合はNone
+        """
+        lines = list(BYPASS_NETS)
+        for name in BYPASS_NET_FILES:
+            try:
+                lines += self.read_lines(name)
+            except OSError as e:
+                print_error("Bypass", f"Could not read {name}. {e}")
+                return None
+        nets = []
+        for line in lines:
+            try:
+                nets.append(ipaddress.IPv4Network(line, strict=False))
+            except ValueError:
+                print_error("Bypass", f"Invalid network \"{line}\". Ignored.")
+        return {str(n) for n in ipaddress.collapse_addresses(nets)}
+
+    def load_domains(self) -> list[str]:
+        domains = list(BYPASS_DOMAINS)
+        for name in BYPASS_DOMAIN_FILES:
+            try:
+                domains += self.read_lines(name)
+            except OSError as e:
+                print_error("Bypass", f"Could not read {name}. {e}")
+        return domains
+
+    @staticmethod
+    def resolve(domains: list[str]) -> set[str]:
+        """
+        ドメイン名を並列に名前解決し，得られたIPv4アドレスを返す
+        """
+        def lookup(domain: str) -> set[str]:
+            try:
+                return {a[4][0] for a in socket.getaddrinfo(domain, None, socket.AF_INET, socket.SOCK_STREAM)}
+            except OSError:
+                print_debug(f"Could not resolve {domain}.")
+                return set()
+
+        if len(domains) == 0:
+            return set()
+        with ThreadPoolExecutor(max_workers=min(16, len(domains))) as ex:
+            return set().union(*ex.map(lookup, domains))
+
+
+class ConnectPipeline:
+    """
+    接続・フェイルオーバーの各段階を依存関係に沿って並行に実行し，段階ごとの所要時間を記録する
+    段階は名前で参照する．別スレッドで実行する段階はsubmit，呼び出し元で実行する段階はrunで実行する
+    """
+
+    def __init__(self, kind: str):
+        self.kind = kind  # ログに出す名前
+        self.start = time.perf_counter()
+        self.ex = ThreadPoolExecutor(max_workers=4)
+        self.stages: dict[str, Future] = {}
+        self.timings: dict[str, float] = {}  # 段階名: 所要時間(秒)
+
+    def submit(self, name: str, fn, *args, after: tuple[str] = ()):
+        """
+        afterの段階が終わってからfnを実行する
+        """
+        deps = [self.stages[n] for n in after]
+
+        def stage():
+            for f in deps:
+                f.result()
+            return self.run(name, fn, *args)
+
+        self.stages[name] = self.ex.submit(stage)
+
+    def run(self, name: str, fn, *args):
+        start = time.perf_counter()
+        try:
+            return fn(*args)
+        finally:
+            self.timings[name] = time.perf_counter() - start
+            m_stage.observe(self.timings[name], stage=name)
+
+    def result(self, name: str):
+        """
+        段階の結果を待って返す．段階がない場合はNone．段階で発生した例外はここで送出される
+        """
+        return self.stages[name].result() if name in self.stages else None
+
+    def close(self):
+        """
+        各段階の所要時間を，並行に実行したことで短縮された時間と合わせてログに出す
+        """
+        self.ex.shutdown(wait=False)
+        elapsed = (time.perf_counter() - self.start) * 1000
+        total = sum(self.timings.values()) * 1000
+        stages = ", ".join(f"{k} {v * 1000:.0f}ms" for (k, v) in self.timings.items())
+        print_log(f"{self.kind} stages: {stages}  Elapsed: {elapsed:.0f}ms  Saved: {max(0.0, total - elapsed):.0f}ms")
+
+
 class ServerConnectInfo:
+    __slots__ = (
+        "hostname",
+        "ip",
+        "_port",
+        "score",
+        "ping",
+        "speed",
+        "country",
+        "num_vpn_sessions",
+        "uptime",
+        "operator",
+        "openvpn_config",
+        "rtt",
+        "rank",
+    )
+
     def __init__(
         self,
         hostname,
@@ -598,10 +2822,12 @@ class ServerConnectInfo:
         num_vpn_sessions,
         uptime,
         operator,
+        openvpn_config=None,
     ):
         self.hostname = hostname
         self.ip = ip
-        self.port = port
+        self._port = port
+        self.openvpn_config = openvpn_config  # portが必要になるまでデコードしない
         self.score = score
         self.ping = ping
         self.speed = speed
@@ -609,6 +2835,15 @@ class ServerConnectInfo:
         self.num_vpn_sessions = num_vpn_sessions
         self.uptime = uptime
         self.operator = operator
+        self.rtt = None  # 計測したTCP接続遅延(ms)
+        self.rank = 0.0  # ScoreEngineによる採点結果
+
+    @property
+    def port(self):
+        if self.openvpn_config is not None:
+            self._port = get_port_from_openvpn(self.openvpn_config)
+            self.openvpn_config = None
+        return self._port
 
     def get_uptime(self):
         td = timedelta(seconds=self.uptime)
@@ -622,6 +2857,12 @@ class ServerConnectInfo:
         else:
             return str(self.ping)
 
+    def get_rtt(self):
+        if self.rtt is None:
+            return "--"
+        else:
+            return f"{self.rtt:.1f}"
+
     def get_host(self):
         return f"{self.ip}:{self.port}"
 
@@ -630,12 +2871,251 @@ class ServerConnectInfo:
         return f"{self.hostname} {self.get_host()} ({self.country}) Score:{self.score} Ping:{self.get_ping()}ms Speed:{speed} Sessions:{self.num_vpn_sessions} UP:{self.get_uptime()} OP:{self.operator}"
 
 
-def log_write(msg: str):
-    dt = datetime.now(ZoneInfo("Asia/Tokyo"))
-    path = Path(__file__).resolve().parent.joinpath(f"log/log-{dt.date()}.txt")
-    os.makedirs(os.path.dirname(path), exist_ok=True)
-    with open(path, mode="a", encoding="utf-8") as f:
-        f.write(f"[{dt}] {msg}")
+class ServerTable:
+    """
+    パース済みのサーバ一覧
+    国，OP，ポートの索引を持ち，条件に合うサーバを全件走査せずに絞り込む
+    上位k件の選択は採点を含めてScoreEngine.topで行う
+    ポートの索引はOpenVPN設定のデコードが必要なため，初めて使う時に作る
+    """
+
+    def __init__(self, servers: list[ServerConnectInfo]):
+        self.servers = servers
+        self.by_country: dict[str, list[int]] = {}
+        self.by_operator: dict[str, list[int]] = {}
+        self.by_ip: dict[str, int] = {}
+        self._by_port: dict[int, list[int]] = None
+        for (i, s) in enumerate(servers):
+            self.by_country.setdefault(s.country, []).append(i)
+            self.by_operator.setdefault(s.operator, []).append(i)
+            self.by_ip[s.ip] = i
+
+    def __len__(self):
+        return len(self.servers)
+
+    @property
+    def by_port(self) -> dict[int, list[int]]:
+        if self._by_port is None:
+            self._by_port = {}
+            for (i, s) in enumerate(self.servers):
+                self._by_port.setdefault(s.port, []).append(i)
+        return self._by_port
+
+    def get(self, ip: str) -> ServerConnectInfo:
+        i = self.by_ip.get(ip)
+        return None if i is None else self.servers[i]
+
+    def select(
+        self,
+        country: str = None,
+        ports: list[int] = None,
+        exclude_ops: list[str] = None,
+        exclude_ips: set[str] = None,
+    ) -> list[ServerConnectInfo]:
+        """
+        条件に合うサーバを索引から絞り込む
+        """
+        if country is not None:
+            idx = set(self.by_country.get(country, []))
+        else:
+            idx = set(range(len(self.servers)))
+        if ports:
+            idx.intersection_update(i for p in ports for i in self.by_port.get(p, []))
+        if exclude_ops:
+            idx.difference_update(i for op in exclude_ops for i in self.by_operator.get(op, []))
+        if exclude_ips:
+            idx.difference_update(self.by_ip[ip] for ip in exclude_ips if ip in self.by_ip)
+        return [self.servers[i] for i in idx]
+
+
+class ReputationStore:
+    """
+    サーバごとの接続実績をSQLiteに保存し，再起動後も引き継ぐ
+    読み出しはメモリ上の辞書から行い，更新時のみDBに書き込む
+    接続失敗やセッション異常終了でペナルティを加算し，ペナルティは半減期で時間減衰する
+    """
+    COLUMNS = (
+        "attempts",  # 接続試行回数
+        "successes",  # 接続成功回数
+        "connect_ms",  # 成功時の接続所要時間の合計(ms)
+        "penalty",  # last_failure時点のペナルティ
+        "last_failure",  # 最後に失敗した時刻(UNIX時間)
+        "sessions",  # 終了したセッション数
+        "session_seconds",  # セッション継続時間の合計(秒)
+        "throughput",  # 最後に計測したスループット(Mbps)
+    )
+
+    def __init__(self, path: Path):
+        self.lock = RLock()  # 読み出しから更新までを1つの操作にするため，update()を内側で呼べるようにする
+        self.db = sqlite3.connect(str(path), check_same_thread=False)
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS servers (ip TEXT PRIMARY KEY, "
+            + ", ".join(f"{c} REAL NOT NULL DEFAULT 0" for c in self.COLUMNS)
+            + ")"
+        )
+        self.db.commit()
+        self.rows: dict[str, dict] = {}
+        for row in self.db.execute(f"SELECT ip, {', '.join(self.COLUMNS)} FROM servers"):
+            self.rows[row[0]] = dict(zip(self.COLUMNS, row[1:]))
+        print_debug(f"Loaded reputation of {len(self.rows)} servers.")
+
+    def get(self, ip: str) -> dict:
+        return self.rows.get(ip) or dict.fromkeys(self.COLUMNS, 0)
+
+    def update(self, ip: str, **values):
+        with self.lock:
+            row = self.rows.setdefault(ip, dict.fromkeys(self.COLUMNS, 0))
+            row.update(values)
+            self.db.execute(
+                f"INSERT OR REPLACE INTO servers (ip, {', '.join(self.COLUMNS)}) "
+                f"VALUES (?, {', '.join('?' * len(self.COLUMNS))})",
+                (ip, *(row[c] for c in self.COLUMNS)),
+            )
+            self.db.commit()
+
+    def get_penalty(self, ip: str) -> float:
+        row = self.get(ip)
+        if row["penalty"] == 0:
+            return 0.0
+        elapsed = time.time() - row["last_failure"]
+        return row["penalty"] * 0.5 ** (elapsed / REPUTATION_HALFLIFE)
+
+    def add_penalty(self, ip: str, **values):
+        with self.lock:
+            self.update(ip, penalty=self.get_penalty(ip) + 1, last_failure=time.time(), **values)
+
+    def is_blacklisted(self, ip: str) -> bool:
+        return self.get_penalty(ip) >= REPUTATION_THRESHOLD
+
+    def record_connect(self, ip: str, success: bool, ms: float):
+        with self.lock:
+            row = self.get(ip)
+            if success:
+                self.update(
+                    ip,
+                    attempts=row["attempts"] + 1,
+                    successes=row["successes"] + 1,
+                    connect_ms=row["connect_ms"] + ms,
+                )
+            else:
+                self.add_penalty(ip, attempts=row["attempts"] + 1)
+
+    def record_session(self, ip: str, seconds: float, failed: bool):
+        with self.lock:
+            row = self.get(ip)
+            values = {"sessions": row["sessions"] + 1, "session_seconds": row["session_seconds"] + seconds}
+            if failed:
+                self.add_penalty(ip, **values)
+            else:
+                self.update(ip, **values)
+
+    def record_throughput(self, ip: str, mbps: float):
+        self.update(ip, throughput=mbps)
+
+    def get_throughput(self, ip: str) -> float:
+        """
+        最後に計測した転送速度(Mbps)．計測していない場合はNone
+        """
+        row = self.get(ip)
+        return row["throughput"] or None
+
+    def get_success_rate(self, ip: str) -> float:
+        """
+        接続成功率．試行回数が少ないサーバが極端な値にならないよう，1勝1敗を事前に加える
+        """
+        row = self.get(ip)
+        return (row["successes"] + 1) / (row["attempts"] + 2)
+
+    def get_connect_time(self, ip: str) -> float:
+        """
+        成功時の平均接続所要時間(ms)．記録がない場合はNone
+        """
+        row = self.get(ip)
+        if row["successes"] == 0:
+            return None
+        return row["connect_ms"] / row["successes"]
+
+
+class ScoreEngine:
+    """
+    サーバを複数の指標の重み付き和で採点する
+    各指標は候補全体の列ごとに最小0・最大1へ正規化してから合算するため，単位の違いに左右されない
+    値がない指標は最低点として扱う
+    """
+    # 指標名: (値の取得関数, 大きいほど良いか)
+    FEATURES = {
+        "score": (lambda s: s.score, True),
+        "ping": (lambda s: s.ping, False),
+        "speed": (lambda s: s.speed, True),
+        "sessions": (lambda s: s.num_vpn_sessions, False),
+        "uptime": (lambda s: s.uptime, True),
+        "success": (lambda s: reputation.get_success_rate(s.ip), True),
+        "connect_time": (lambda s: reputation.get_connect_time(s.ip), False),
+        "throughput": (lambda s: reputation.get_throughput(s.ip), True),
+    }
+
+    def __init__(self, weights: dict, constraints: dict):
+        self.weights = weights
+        self.constraints = constraints
+
+    def accept(self, s: ServerConnectInfo) -> bool:
+        """
+        制約条件を満たすか
+        """
+        c = self.constraints
+        if c["maxping"] > 0 and (s.ping is None or s.ping > c["maxping"]):
+            return False
+        if c["maxsessions"] > 0 and (s.num_vpn_sessions is None or s.num_vpn_sessions > c["maxsessions"]):
+            return False
+        if c["minuptime"] > 0 and (s.uptime is None or s.uptime < c["minuptime"]):
+            return False
+        if c["minsuccess"] > 0 and reputation.get_success_rate(s.ip) < c["minsuccess"]:
+            return False
+        return True
+
+    def score(self, servers: list[ServerConnectInfo]) -> list[float]:
+        """
+        各サーバの点数を返し，ServerConnectInfo.rankにも記録する
+        """
+        ranks = [0.0] * len(servers)
+        for (name, (getter, higher_is_better)) in self.FEATURES.items():
+            weight = self.weights.get(name, 0)
+            if weight == 0:
+                continue
+            column = [getter(s) for s in servers]
+            values = [v for v in column if v is not None]
+            if len(values) == 0:
+                continue
+            lo = min(values)
+            span = (max(values) - lo) or 1
+            for (i, v) in enumerate(column):
+                if v is None:
+                    continue
+                n = (v - lo) / span
+                ranks[i] += weight * (n if higher_is_better else 1 - n)
+        for (s, r) in zip(servers, ranks):
+            s.rank = r
+        return ranks
+
+    def top(self, servers: list[ServerConnectInfo], k: int) -> list[ServerConnectInfo]:
+        """
+        制約条件を満たすサーバを採点し，上位k件を返す
+        """
+        servers = [s for s in servers if self.accept(s)]
+        ranks = self.score(servers)
+        best = heapq.nlargest(k, range(len(servers)), key=ranks.__getitem__)
+        return [servers[i] for i in best]
+
+
+def log_write(msg: str, level: int = logwriter.INFO):
+    logger.write(level, msg)
+
+
+def is_debug() -> bool:
+    """
+    デバッグ出力が画面かログファイルのどちらかに出るか
+    """
+    return DEBUG or logger.enabled(logwriter.DEBUG)
 
 
 def print_status(msg: str):
@@ -655,29 +3135,32 @@ def print_log(msg: str):
         print(f"\033[32m{str(msg)}\033[0m")
     else:
         print(str(msg))
-    log_write(f"{str(msg)}\n")
+    log_write(str(msg))
 
 
 def print_debug(msg, banner=True, end="\n"):
     global is_overwrite_active
+    if not is_debug():
+        return
     if DEBUG:
         is_overwrite_active = False
         if banner:
             print("\033[45m(DEBUG)\033[0m " + str(msg), end=end)
         else:
             print(str(msg), end=end)
-    log_write(f"[DEBUG] {str(msg)}\n")
+    log_write(str(msg), level=logwriter.DEBUG)
 
 
 def print_error(errtype, errmsg):
     global is_overwrite_active
     is_overwrite_active = False
     print(f"\033[31m{str(errtype)}: {str(errmsg)}\033[0m")
-    log_write(f"[ERROR] {str(errtype)}: {str(errmsg)}\n")
+    log_write(f"{str(errtype)}: {str(errmsg)}", level=logwriter.ERROR)
 
 
 def err_exit():
     print_log("Terminating due to error...")
+    logger.close()  # os._exitではatexitが呼ばれないため
     os._exit(1)
 
 
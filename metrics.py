@@ -0,0 +1,174 @@
+"""
+Prometheusのテキスト形式でメトリクスを公開する最小限の実装
+値の更新はロックを取って辞書を書き換えるだけなので，監視スレッドから頻繁に呼んでもよい
+"""
+
+import math
+from threading import Thread, Lock
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def format_labels(labels: tuple[tuple[str, str], ...]) -> str:
+    if len(labels) == 0:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n") for (_, v) in labels)
+    return "{" + ",".join(f"{k}=\"{v}\"" for ((k, _), v) in zip(labels, escaped)) + "}"
+
+
+def format_value(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class Metric:
+    kind: str = None
+
+    def __init__(self, name: str, help: str):
+        self.name = name
+        self.help = help
+        self.lock = Lock()
+        self.values: dict[tuple, float] = {}  # ラベルの組: 値
+
+    def samples(self) -> list[tuple[str, tuple, float]]:
+        """
+        (名前, ラベル, 値)の一覧
+        """
+        with self.lock:
+            return [(self.name, labels, v) for (labels, v) in self.values.items()]
+
+    def clear(self):
+        with self.lock:
+            self.values.clear()
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def set(self, value: float, **labels):
+        """
+        vpnclientの転送量など，外部で数えている累積値をそのまま写す
+        """
+        with self.lock:
+            self.values[tuple(sorted(labels.items()))] = value
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def __init__(self, name: str, help: str):
+        super().__init__(name, help)
+        self.function = None
+
+    def set(self, value: float, **labels):
+        with self.lock:
+            self.values[tuple(sorted(labels.items()))] = value
+
+    def set_function(self, function):
+        """
+        出力時にfunction()の値を使う．Noneを返した場合は出力しない
+        """
+        self.function = function
+
+    def samples(self) -> list[tuple[str, tuple, float]]:
+        if self.function is not None:
+            value = self.function()
+            return [] if value is None else [(self.name, (), value)]
+        return super().samples()
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, buckets: tuple[float, ...] = DEFAULT_BUCKETS):
+        super().__init__(name, help)
+        self.buckets = tuple(buckets) + (math.inf,)
+        self.counts: dict[tuple, list[int]] = {}
+        self.sums: dict[tuple, float] = {}
+
+    def observe(self, value: float, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            counts = self.counts.setdefault(key, [0] * len(self.buckets))
+            for (i, bound) in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            self.sums[key] = self.sums.get(key, 0.0) + value
+
+    def samples(self) -> list[tuple[str, tuple, float]]:
+        res = []
+        with self.lock:
+            for (key, counts) in self.counts.items():
+                for (bound, count) in zip(self.buckets, counts):
+                    res.append((f"{self.name}_bucket", key + (("le", format_value(bound)),), count))
+                res.append((f"{self.name}_sum", key, self.sums[key]))
+                res.append((f"{self.name}_count", key, counts[-1]))
+        return res
+
+    def clear(self):
+        with self.lock:
+            self.counts.clear()
+            self.sums.clear()
+
+
+class Registry:
+    def __init__(self):
+        self.metrics: list[Metric] = []
+
+    def counter(self, name: str, help: str) -> Counter:
+        return self.add(Counter(name, help))
+
+    def gauge(self, name: str, help: str) -> Gauge:
+        return self.add(Gauge(name, help))
+
+    def histogram(self, name: str, help: str, buckets: tuple[float, ...] = DEFAULT_BUCKETS) -> Histogram:
+        return self.add(Histogram(name, help, buckets))
+
+    def add(self, metric: Metric) -> Metric:
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for m in self.metrics:
+            lines.append(f"# HELP {m.name} {m.help}")
+            lines.append(f"# TYPE {m.name} {m.kind}")
+            for (name, labels, value) in m.samples():
+                lines.append(f"{name}{format_labels(labels)} {format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+def serve(registry: Registry, host: str, port: int) -> ThreadingHTTPServer:
+    """
+    GET /metricsに応答するHTTPサーバをデーモンスレッドで起動する
+    """
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = registry.render().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", CONTENT_TYPE)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass  # アクセスログは出さない
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    Thread(target=server.serve_forever, daemon=True).start()
+    return server
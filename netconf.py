@@ -0,0 +1,218 @@
+"""
+ネットワーク設定(アドレス・経路・IPマスカレード)のバックエンド
+NetlinkBackendはrtnetlinkソケットで直接設定し，フェイルオーバー中にプロセスを起動しない
+CommandBackendは従来通りip/iptablesコマンドを実行する(netlinkが使えない環境向け)
+どちらも失敗時はOSErrorを送出する
+"""
+
+import re
+import socket
+import ipaddress
+import netlink
+
+
+class CommandBackend:
+    """
+    ip/iptablesコマンドを実行して設定する
+    """
+    name = "command"
+
+    def __init__(self, runcmd):
+        self.runcmd = runcmd  # main.runcmd(コマンドのログ出力を共通にするため)
+
+    def run(self, command: list[str], input: str = None) -> str:
+        res = self.runcmd(command, input=input)
+        if res.returncode != 0:
+            raise OSError(f"{command[0]} command failed. Error information is below.\n{res.stderr}")
+        return res.stdout
+
+    def get_gw(self, nic: str) -> str:
+        out = self.run(["ip", "route", "show", "default", "dev", nic])
+        match = re.search(r"default via (\d+\.\d+\.\d+\.\d+)", out)
+        return match.group(1) if match else None
+
+    def get_addr(self, nic: str) -> str:
+        out = self.run(["ip", "addr", "show", nic])
+        match = re.search(r"inet (\d+\.\d+\.\d+\.\d+)/", out)
+        return match.group(1) if match else None
+
+    def get_nw(self, nic: str) -> str:
+        out = self.run(["ip", "addr", "show", nic])
+        match = re.search(r"inet (\d+\.\d+\.\d+\.\d+/\d+)", out)
+        return str(ipaddress.IPv4Network(match.group(1), strict=False)) if match else None
+
+    def addr_add(self, nic: str, addr: str, prefixlen: int, noprefixroute: bool = False):
+        command = ["ip", "addr", "add", f"{addr}/{prefixlen}", "dev", nic]
+        if noprefixroute:
+            command.append("noprefixroute")
+        self.run(command)
+
+    def addr_flush(self, nic: str):
+        self.run(["ip", "addr", "flush", "dev", nic])
+
+    def route_add(self, dst: str, gateway: str, nic: str, replace: bool = False):
+        self.run(["ip", "route", "replace" if replace else "add", dst, "via", gateway, "dev", nic])
+
+    def route_del(self, dst: str):
+        self.run(["ip", "route", "del", dst])
+
+    def route_replace_default(self, gateway: str, nic: str, onlink: bool = False, table: int = netlink.RT_TABLE_MAIN):
+        command = ["ip", "route", "replace", "default", "via", gateway, "dev", nic]
+        if table != netlink.RT_TABLE_MAIN:
+            command += ["table", str(table)]
+        if onlink:
+            command.append("onlink")
+        self.run(command)
+
+    def route_replace_multipath(self, nexthops: list[tuple[str, str]], table: int, onlink: bool = False):
+        """
+        (ゲートウェイ, NIC)の各経路にフロー単位で振り分けるデフォルトルートを設定する
+        """
+        command = ["ip", "route", "replace", "default", "table", str(table)]
+        for (gateway, nic) in nexthops:
+            command += ["nexthop", "via", gateway, "dev", nic] + (["onlink"] if onlink else [])
+        self.run(command)
+
+    def route_del_default(self, table: int):
+        self.run(["ip", "route", "del", "default", "table", str(table)])
+
+    def rule_add(self, priority: int, table: int, **selectors):
+        """
+        条件(iif, oif, src, fwmark, suppress_prefixlength)に合う通信でtableを引くip ruleを追加する
+        """
+        self.run(["ip", "rule", "add", *self.rule_args(priority, table, **selectors)])
+
+    def rule_del(self, priority: int, table: int, **selectors):
+        self.run(["ip", "rule", "del", *self.rule_args(priority, table, **selectors)])
+
+    @staticmethod
+    def rule_args(
+        priority: int,
+        table: int,
+        iif: str = None,
+        oif: str = None,
+        src: str = None,
+        fwmark: int = None,
+        suppress_prefixlength: int = None,
+    ) -> list[str]:
+        args = ["priority", str(priority)]
+        for (key, value) in (("iif", iif), ("oif", oif), ("from", src), ("fwmark", fwmark)):
+            if value is not None:
+                args += [key, str(value)]
+        args += ["lookup", str(table)]
+        if suppress_prefixlength is not None:
+            args += ["suppress_prefixlength", str(suppress_prefixlength)]
+        return args
+
+    def masquerade(self, src: str, add: list[str] = (), delete: list[str] = ()):
+        """
+        srcからnicへ出る通信のIPマスカレードを追加・削除する
+        """
+        for (nic, op) in [(n, "-A") for n in add] + [(n, "-D") for n in delete]:
+            self.run(["iptables", "-t", "nat", op, "POSTROUTING", "-s", src, "-o", nic, "-j", "MASQUERADE"])
+
+    def has_masquerade(self, src: str, nic: str) -> bool:
+        """
+        srcからnicへ出る通信のIPマスカレードが設定済みか(前回の実行で残った規則を重複させないため)
+        """
+        try:
+            self.run(["iptables", "-t", "nat", "-C", "POSTROUTING", "-s", src, "-o", nic, "-j", "MASQUERADE"])
+        except OSError:
+            return False
+        return True
+
+    def nft(self, script: str):
+        """
+        nftのスクリプトを1つのトランザクションで適用する．途中で失敗した場合は何も変わらない
+        nftablesはnetlinkの別のサブシステムのため，どちらのバックエンドでもnftコマンドを使う
+        """
+        self.run(["nft", "-f", "-"], input=script)
+
+    def close(self):
+        pass
+
+
+class NetlinkBackend(CommandBackend):
+    """
+    rtnetlinkで直接設定する
+    IPマスカレードはnetlinkでは扱えないため，iptables-restoreで追加・削除をまとめて1回で適用する
+    """
+    name = "netlink"
+
+    def __init__(self, runcmd):
+        super().__init__(runcmd)
+        self.rtnl = netlink.RtNetlink()
+
+    def get_gw(self, nic: str) -> str:
+        index = socket.if_nametoindex(nic)
+        for r in self.rtnl.get_routes():
+            if r.dst_len == 0 and r.oif == index and r.gateway is not None:
+                return r.gateway
+        return None
+
+    def get_addr(self, nic: str) -> str:
+        addrs = self.rtnl.get_addrs(socket.if_nametoindex(nic))
+        return addrs[0][1] if len(addrs) > 0 else None
+
+    def get_nw(self, nic: str) -> str:
+        addrs = self.rtnl.get_addrs(socket.if_nametoindex(nic))
+        if len(addrs) == 0:
+            return None
+        (_, addr, prefixlen) = addrs[0]
+        return str(ipaddress.IPv4Network(f"{addr}/{prefixlen}", strict=False))
+
+    def addr_add(self, nic: str, addr: str, prefixlen: int, noprefixroute: bool = False):
+        self.rtnl.addr_add(socket.if_nametoindex(nic), addr, prefixlen, noprefixroute=noprefixroute)
+
+    def addr_flush(self, nic: str):
+        self.rtnl.addr_flush(socket.if_nametoindex(nic))
+
+    def route_add(self, dst: str, gateway: str, nic: str, replace: bool = False):
+        self.rtnl.route_add(dst, 32, gateway, socket.if_nametoindex(nic), replace=replace)
+
+    def route_del(self, dst: str):
+        self.rtnl.route_del(dst, 32)
+
+    def route_replace_default(self, gateway: str, nic: str, onlink: bool = False, table: int = netlink.RT_TABLE_MAIN):
+        self.rtnl.route_add(
+            "0.0.0.0", 0, gateway, socket.if_nametoindex(nic), table=table, onlink=onlink, replace=True
+        )
+
+    def route_replace_multipath(self, nexthops: list[tuple[str, str]], table: int, onlink: bool = False):
+        hops = [(gateway, socket.if_nametoindex(nic)) for (gateway, nic) in nexthops]
+        self.rtnl.route_multipath("0.0.0.0", 0, hops, table=table, onlink=onlink)
+
+    def route_del_default(self, table: int):
+        self.rtnl.route_del("0.0.0.0", 0, table=table)
+
+    def rule_add(self, priority: int, table: int, **selectors):
+        self.rtnl.rule(netlink.RTM_NEWRULE, priority, table, **selectors)
+
+    def rule_del(self, priority: int, table: int, **selectors):
+        self.rtnl.rule(netlink.RTM_DELRULE, priority, table, **selectors)
+
+    def masquerade(self, src: str, add: list[str] = (), delete: list[str] = ()):
+        """
+        追加と削除を1つのトランザクションで適用するため，切替中にどちらの規則もない瞬間ができない
+        """
+        rules = [f"-A POSTROUTING -s {src} -o {nic} -j MASQUERADE" for nic in add]
+        rules += [f"-D POSTROUTING -s {src} -o {nic} -j MASQUERADE" for nic in delete]
+        self.run(["iptables-restore", "--noflush"], input="\n".join(["*nat", *rules, "COMMIT", ""]))
+
+    def close(self):
+        self.rtnl.close()
+
+
+BACKENDS = {b.name: b for b in (NetlinkBackend, CommandBackend)}
+
+
+def open_backend(name: str, runcmd):
+    """
+    指定したバックエンドを返す．netlinkソケットが開けない場合はCommandBackendを使う
+    """
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown network backend \"{name}\"")
+    try:
+        return BACKENDS[name](runcmd)
+    except OSError:
+        return CommandBackend(runcmd)
@@ -0,0 +1,382 @@
+"""
+rtnetlinkソケットを直接扱うための最小限の実装
+ipコマンドを起動せずに，リンク・経路の変化の通知を受け取ったり，アドレス・経路を設定したりする
+"""
+
+import os
+import socket
+import struct
+from threading import Lock
+
+NETLINK_ROUTE = 0
+RTMGRP_LINK = 0x1
+RTMGRP_IPV4_IFADDR = 0x10
+RTMGRP_IPV4_ROUTE = 0x40
+
+NLM_F_REQUEST = 0x1
+NLM_F_ACK = 0x4
+NLM_F_REPLACE = 0x100
+NLM_F_EXCL = 0x200
+NLM_F_CREATE = 0x400
+NLM_F_DUMP = 0x300
+
+NLMSG_ERROR = 2
+NLMSG_DONE = 3
+RTM_NEWLINK = 16
+RTM_DELLINK = 17
+RTM_NEWADDR = 20
+RTM_DELADDR = 21
+RTM_NEWROUTE = 24
+RTM_DELROUTE = 25
+RTM_GETADDR = 22
+RTM_GETROUTE = 26
+RTM_NEWRULE = 32
+RTM_DELRULE = 33
+
+IFF_UP = 0x1
+IFF_RUNNING = 0x40
+IFF_LOWER_UP = 0x10000
+
+IFLA_IFNAME = 3
+IFA_ADDRESS = 1
+IFA_LOCAL = 2
+IFA_FLAGS = 8
+IFA_F_NOPREFIXROUTE = 0x200
+RTA_DST = 1
+RTA_OIF = 4
+RTA_GATEWAY = 5
+RTA_MULTIPATH = 9
+RTA_TABLE = 15
+FRA_SRC = 2
+FRA_IIFNAME = 3
+FRA_PRIORITY = 6
+FRA_FWMARK = 10
+FRA_SUPPRESS_PREFIXLEN = 14
+FRA_TABLE = 15
+FRA_OIFNAME = 17
+
+RT_TABLE_MAIN = 254
+RTPROT_BOOT = 3
+RT_SCOPE_UNIVERSE = 0
+RTN_UNICAST = 1
+RTNH_F_ONLINK = 0x4
+FR_ACT_TO_TBL = 1
+
+NLMSGHDR = struct.Struct("=IHHII")  # len, type, flags, seq, pid
+IFINFOMSG = struct.Struct("=BxHiII")  # family, type, index, flags, change
+RTMSG = struct.Struct("=BBBBBBBBI")  # family, dst_len, src_len, tos, table, protocol, scope, type, flags
+IFADDRMSG = struct.Struct("=BBBBI")  # family, prefixlen, flags, scope, index
+RTATTR = struct.Struct("=HH")  # len, type
+RTNEXTHOP = struct.Struct("=HBBi")  # len, flags, hops, ifindex
+FIBRULEHDR = struct.Struct("=BBBBBBBBI")  # family, dst_len, src_len, tos, table, res1, res2, action, flags
+
+
+def align(n: int) -> int:
+    return (n + 3) & ~3
+
+
+def parse_attrs(data: bytes, offset: int) -> dict[int, bytes]:
+    """
+    rtattrの並びを{属性番号: 値}にする
+    """
+    attrs = {}
+    while offset + RTATTR.size <= len(data):
+        (length, kind) = RTATTR.unpack_from(data, offset)
+        if length < RTATTR.size:
+            break
+        attrs[kind] = data[offset + RTATTR.size:offset + length]
+        offset += align(length)
+    return attrs
+
+
+def pack_attr(kind: int, value: bytes) -> bytes:
+    length = RTATTR.size + len(value)
+    return RTATTR.pack(length, kind) + value + b"\0" * (align(length) - length)
+
+
+def pack_table(table: int) -> (int, bytes):
+    """
+    経路表の番号を(ヘッダに書く値, RTA_TABLE属性)にする．256以上は属性でしか表せない
+    """
+    return (table if table < 256 else 0, pack_attr(RTA_TABLE, struct.pack("=I", table)))
+
+
+def parse_messages(data: bytes):
+    """
+    受信したデータをnetlinkメッセージごとに分け，(種類, 本体)を返す
+    """
+    offset = 0
+    while offset + NLMSGHDR.size <= len(data):
+        (length, kind, _, _, _) = NLMSGHDR.unpack_from(data, offset)
+        if length < NLMSGHDR.size:
+            break
+        yield (kind, data[offset + NLMSGHDR.size:offset + length])
+        offset += align(length)
+
+
+class LinkEvent:
+    """
+    リンクの状態変化(RTM_NEWLINK/RTM_DELLINK)
+    """
+    __slots__ = ("kind", "index", "ifname", "flags")
+
+    def __init__(self, kind: int, index: int, ifname: str, flags: int):
+        self.kind = kind
+        self.index = index
+        self.ifname = ifname
+        self.flags = flags
+
+    def is_down(self) -> bool:
+        if self.kind == RTM_DELLINK:
+            return True
+        return not (self.flags & IFF_UP) or not (self.flags & IFF_RUNNING)
+
+
+class RouteEvent:
+    """
+    経路の変化(RTM_NEWROUTE/RTM_DELROUTE)
+    """
+    __slots__ = ("kind", "dst_len", "table", "oif", "gateway")
+
+    def __init__(self, kind: int, dst_len: int, table: int, oif: int, gateway: str):
+        self.kind = kind
+        self.dst_len = dst_len
+        self.table = table
+        self.oif = oif
+        self.gateway = gateway
+
+    def is_default_removed(self) -> bool:
+        return self.kind == RTM_DELROUTE and self.dst_len == 0
+
+
+class AddrEvent:
+    """
+    アドレスの変化(RTM_NEWADDR/RTM_DELADDR)
+    """
+    __slots__ = ("kind", "index")
+
+    def __init__(self, kind: int, index: int):
+        self.kind = kind
+        self.index = index
+
+
+class Monitor:
+    """
+    リンク・アドレス・経路の変化の通知を購読する
+    """
+
+    def __init__(self, groups: int = RTMGRP_LINK | RTMGRP_IPV4_IFADDR | RTMGRP_IPV4_ROUTE):
+        self.sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, NETLINK_ROUTE)
+        self.sock.bind((0, groups))  # ポートIDはカーネルに割り当てさせる
+
+    def events(self):
+        """
+        通知をLinkEvent/AddrEvent/RouteEventとして順に返す(ブロックする)
+        """
+        while True:
+            data = self.sock.recv(65536)
+            for (kind, body) in parse_messages(data):
+                if kind in (RTM_NEWLINK, RTM_DELLINK) and len(body) >= IFINFOMSG.size:
+                    (_, _, index, flags, _) = IFINFOMSG.unpack_from(body)
+                    attrs = parse_attrs(body, IFINFOMSG.size)
+                    ifname = attrs.get(IFLA_IFNAME, b"").rstrip(b"\0").decode(errors="replace")
+                    yield LinkEvent(kind, index, ifname, flags)
+                elif kind in (RTM_NEWADDR, RTM_DELADDR) and len(body) >= IFADDRMSG.size:
+                    (family, _, _, _, index) = IFADDRMSG.unpack_from(body)
+                    if family == socket.AF_INET:
+                        yield AddrEvent(kind, index)
+                elif kind in (RTM_NEWROUTE, RTM_DELROUTE) and len(body) >= RTMSG.size:
+                    (family, dst_len, _, _, table, _, _, _, _) = RTMSG.unpack_from(body)
+                    if family != socket.AF_INET:
+                        continue
+                    attrs = parse_attrs(body, RTMSG.size)
+                    oif = struct.unpack("=i", attrs[RTA_OIF])[0] if RTA_OIF in attrs else None
+                    gateway = socket.inet_ntoa(attrs[RTA_GATEWAY]) if RTA_GATEWAY in attrs else None
+                    yield RouteEvent(kind, dst_len, table, oif, gateway)
+
+    def close(self):
+        self.sock.close()
+
+
+class RtNetlink:
+    """
+    rtnetlinkへの要求を送り，応答を受け取る
+    失敗した場合はカーネルが返したerrnoでOSErrorを送出する
+    """
+
+    def __init__(self):
+        self.sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, NETLINK_ROUTE)
+        self.sock.bind((0, 0))
+        self.seq = 0
+        self.lock = Lock()
+
+    def request(self, kind: int, flags: int, body: bytes) -> list[tuple[int, bytes]]:
+        """
+        要求を送り，ダンプ要求なら応答メッセージの一覧を，それ以外なら空のリストを返す
+        """
+        with self.lock:
+            self.seq += 1
+            seq = self.seq
+            header = NLMSGHDR.pack(NLMSGHDR.size + len(body), kind, flags | NLM_F_REQUEST, seq, 0)
+            self.sock.send(header + body)
+            res = []
+            while True:
+                data = self.sock.recv(65536)
+                offset = 0
+                while offset + NLMSGHDR.size <= len(data):
+                    (length, r_kind, _, r_seq, _) = NLMSGHDR.unpack_from(data, offset)
+                    if length < NLMSGHDR.size:
+                        break
+                    r_body = data[offset + NLMSGHDR.size:offset + length]
+                    offset += align(length)
+                    if r_seq != seq:
+                        continue
+                    if r_kind == NLMSG_DONE:
+                        return res
+                    if r_kind == NLMSG_ERROR:
+                        errno = -struct.unpack_from("=i", r_body)[0]
+                        if errno != 0:
+                            raise OSError(errno, os.strerror(errno))
+                        return res  # ACK
+                    res.append((r_kind, r_body))
+
+    def get_addrs(self, index: int = None) -> list[tuple[int, str, int]]:
+        """
+        IPv4アドレスの一覧を(NIC番号, アドレス, プレフィックス長)で返す
+        """
+        res = []
+        body = IFADDRMSG.pack(socket.AF_INET, 0, 0, 0, 0)
+        for (_, r_body) in self.request(RTM_GETADDR, NLM_F_DUMP, body):
+            (_, prefixlen, _, _, r_index) = IFADDRMSG.unpack_from(r_body)
+            if index is not None and r_index != index:
+                continue
+            attrs = parse_attrs(r_body, IFADDRMSG.size)
+            addr = attrs.get(IFA_LOCAL) or attrs.get(IFA_ADDRESS)
+            if addr is not None:
+                res.append((r_index, socket.inet_ntoa(addr), prefixlen))
+        return res
+
+    def addr_add(self, index: int, addr: str, prefixlen: int, noprefixroute: bool = False):
+        body = IFADDRMSG.pack(socket.AF_INET, prefixlen, 0, RT_SCOPE_UNIVERSE, index)
+        body += pack_attr(IFA_LOCAL, socket.inet_aton(addr))
+        body += pack_attr(IFA_ADDRESS, socket.inet_aton(addr))
+        if noprefixroute:
+            body += pack_attr(IFA_FLAGS, struct.pack("=I", IFA_F_NOPREFIXROUTE))
+        self.request(RTM_NEWADDR, NLM_F_ACK | NLM_F_CREATE | NLM_F_EXCL, body)
+
+    def addr_del(self, index: int, addr: str, prefixlen: int):
+        body = IFADDRMSG.pack(socket.AF_INET, prefixlen, 0, 0, index)
+        body += pack_attr(IFA_LOCAL, socket.inet_aton(addr))
+        body += pack_attr(IFA_ADDRESS, socket.inet_aton(addr))
+        self.request(RTM_DELADDR, NLM_F_ACK, body)
+
+    def addr_flush(self, index: int):
+        for (_, addr, prefixlen) in self.get_addrs(index):
+            self.addr_del(index, addr, prefixlen)
+
+    def get_routes(self, table: int = RT_TABLE_MAIN) -> list[RouteEvent]:
+        """
+        IPv4の経路の一覧を返す．宛先はRouteEvent.dst_lenのみ保持する
+        """
+        res = []
+        body = RTMSG.pack(socket.AF_INET, 0, 0, 0, 0, 0, 0, 0, 0)
+        for (r_kind, r_body) in self.request(RTM_GETROUTE, NLM_F_DUMP, body):
+            (_, dst_len, _, _, r_table, _, _, _, _) = RTMSG.unpack_from(r_body)
+            if r_table != table:
+                continue
+            attrs = parse_attrs(r_body, RTMSG.size)
+            oif = struct.unpack("=i", attrs[RTA_OIF])[0] if RTA_OIF in attrs else None
+            gateway = socket.inet_ntoa(attrs[RTA_GATEWAY]) if RTA_GATEWAY in attrs else None
+            res.append(RouteEvent(r_kind, dst_len, r_table, oif, gateway))
+        return res
+
+    def route_add(
+        self,
+        dst: str,
+        dst_len: int,
+        gateway: str,
+        index: int,
+        table: int = RT_TABLE_MAIN,
+        onlink: bool = False,
+        replace: bool = False,
+    ):
+        flags = NLM_F_ACK | NLM_F_CREATE | (NLM_F_REPLACE if replace else NLM_F_EXCL)
+        (r_table, table_attr) = pack_table(table)
+        body = RTMSG.pack(
+            socket.AF_INET, dst_len, 0, 0, r_table, RTPROT_BOOT, RT_SCOPE_UNIVERSE,
+            RTN_UNICAST, RTNH_F_ONLINK if onlink else 0,
+        )
+        body += table_attr
+        if dst_len > 0:
+            body += pack_attr(RTA_DST, socket.inet_aton(dst))
+        body += pack_attr(RTA_GATEWAY, socket.inet_aton(gateway))
+        body += pack_attr(RTA_OIF, struct.pack("=i", index))
+        self.request(RTM_NEWROUTE, flags, body)
+
+    def route_multipath(
+        self,
+        dst: str,
+        dst_len: int,
+        nexthops: list[tuple[str, int]],
+        table: int = RT_TABLE_MAIN,
+        onlink: bool = False,
+    ):
+        """
+        (ゲートウェイ, NIC番号)の各経路にフロー単位で振り分ける経路(ECMP)を設定する．既存の経路は置き換える
+        """
+        hops = b""
+        for (gateway, index) in nexthops:
+            attr = pack_attr(RTA_GATEWAY, socket.inet_aton(gateway))
+            hops += RTNEXTHOP.pack(RTNEXTHOP.size + len(attr), RTNH_F_ONLINK if onlink else 0, 0, index) + attr
+        (r_table, table_attr) = pack_table(table)
+        body = RTMSG.pack(socket.AF_INET, dst_len, 0, 0, r_table, RTPROT_BOOT, RT_SCOPE_UNIVERSE, RTN_UNICAST, 0)
+        body += table_attr
+        if dst_len > 0:
+            body += pack_attr(RTA_DST, socket.inet_aton(dst))
+        body += pack_attr(RTA_MULTIPATH, hops)
+        self.request(RTM_NEWROUTE, NLM_F_ACK | NLM_F_CREATE | NLM_F_REPLACE, body)
+
+    def route_del(self, dst: str, dst_len: int, table: int = RT_TABLE_MAIN):
+        """
+        ゲートウェイ経由の経路(scope universe)を削除する
+        """
+        (r_table, table_attr) = pack_table(table)
+        body = RTMSG.pack(socket.AF_INET, dst_len, 0, 0, r_table, 0, RT_SCOPE_UNIVERSE, RTN_UNICAST, 0)
+        body += table_attr
+        if dst_len > 0:
+            body += pack_attr(RTA_DST, socket.inet_aton(dst))
+        self.request(RTM_DELROUTE, NLM_F_ACK, body)
+
+    def rule(
+        self,
+        kind: int,
+        priority: int,
+        table: int,
+        iif: str = None,
+        oif: str = None,
+        src: str = None,
+        fwmark: int = None,
+        suppress_prefixlength: int = None,
+    ):
+        """
+        条件に合う通信でtableを引く規則(ip rule)を追加(RTM_NEWRULE)・削除(RTM_DELRULE)する
+        """
+        (r_table, _) = pack_table(table)
+        body = FIBRULEHDR.pack(socket.AF_INET, 0, 32 if src else 0, 0, r_table, 0, 0, FR_ACT_TO_TBL, 0)
+        body += pack_attr(FRA_PRIORITY, struct.pack("=I", priority))
+        body += pack_attr(FRA_TABLE, struct.pack("=I", table))
+        if iif is not None:
+            body += pack_attr(FRA_IIFNAME, iif.encode() + b"\0")
+        if oif is not None:
+            body += pack_attr(FRA_OIFNAME, oif.encode() + b"\0")
+        if src is not None:
+            body += pack_attr(FRA_SRC, socket.inet_aton(src))
+        if fwmark is not None:
+            body += pack_attr(FRA_FWMARK, struct.pack("=I", fwmark))
+        if suppress_prefixlength is not None:
+            body += pack_attr(FRA_SUPPRESS_PREFIXLEN, struct.pack("=i", suppress_prefixlength))
+        flags = NLM_F_ACK | (NLM_F_CREATE | NLM_F_EXCL if kind == RTM_NEWRULE else 0)
+        self.request(kind, flags, body)
+
+    def close(self):
+        self.sock.close()
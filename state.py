@@ -0,0 +1,106 @@
+"""
+main.pyの状態をepd.pyなど他のプロセスに配信する
+Unixソケットで待ち受け，接続直後と状態が変わるたびに状態全体をJSONの1行として送る
+"""
+
+import os
+import json
+import time
+import socket
+from threading import Thread, Lock
+
+SOCKET_PATH = "/run/vpngate-state.sock"
+
+
+class Publisher:
+    """
+    状態を保持し，購読者に配信する
+    送信はブロックしない．受け取らずに送信バッファがあふれた購読者は切断する
+    """
+
+    def __init__(self, path: str = SOCKET_PATH):
+        self.path = path
+        self.state: dict = {}
+        self.clients: list[socket.socket] = []
+        self.lock = Lock()
+        try:
+            os.unlink(path)  # 前回の実行で残ったソケット
+        except FileNotFoundError:
+            pass
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.bind(path)
+        self.sock.listen()
+        Thread(target=self.accept_worker, daemon=True).start()
+
+    def accept_worker(self):
+        while True:
+            try:
+                (conn, _) = self.sock.accept()
+            except OSError:
+                return  # close済み
+            conn.setblocking(False)
+            with self.lock:
+                if self.send(conn, self.encode()):
+                    self.clients.append(conn)
+
+    def update(self, **values) -> bool:
+        """
+        状態を更新し，変わった場合は購読者に配信する
+
+        Returns:
+            bool: 状態が変わったか
+        """
+        with self.lock:
+            if all(self.state.get(k) == v for (k, v) in values.items()):
+                return False
+            self.state.update(values)
+            line = self.encode()
+            self.clients = [c for c in self.clients if self.send(c, line)]
+        return True
+
+    def encode(self) -> bytes:
+        return json.dumps(self.state, ensure_ascii=False).encode() + b"\n"
+
+    def send(self, conn: socket.socket, line: bytes) -> bool:
+        try:
+            conn.sendall(line)
+            return True
+        except OSError:
+            conn.close()
+            return False
+
+    def close(self):
+        with self.lock:
+            for c in self.clients:
+                c.close()
+            self.clients = []
+        self.sock.close()
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+
+
+def subscribe(path: str = SOCKET_PATH, retry: float = 1.0):
+    """
+    状態を受け取るたびにdictを返す(ブロックする)
+    配信元に接続できない・切断された場合はNoneを1回返し，retry秒ごとに接続し直す
+    """
+    connected = None
+    while True:
+        try:
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+                sock.connect(path)
+                connected = True
+                with sock.makefile("r", encoding="utf-8") as f:
+                    for line in f:
+                        try:
+                            yield json.loads(line)
+                        except json.decoder.JSONDecodeError:
+                            continue
+        except OSError:
+            pass
+        if connected is not False:
+            connected = False
+            yield None
+        time.sleep(retry)